@@ -0,0 +1,481 @@
+import os
+import sys
+import time
+import json
+import glob
+import shutil
+import argparse
+import tempfile
+import contextlib
+import numpy as np
+import cv2
+from main import blend_image, blend_image_pil, warp_object, transform, make_image_classes, make_training_data
+from util import getContour
+from cutout import object_rect
+from placement import PlacementEngine
+from geometry import random_transforms
+from bgbank import BackgroundBank
+from odtk import ODTK
+
+work_dir = None
+"""合成した動画ファイルと背景画像のフォルダのパス"""
+
+synthetic_classes = [ ('red', (40, 40, 210)), ('yellow', (30, 200, 230)), ('blue', (200, 90, 30)) ]
+"""合成する動画ファイルのクラス名と物体の色(BGR)"""
+
+def time_it(func, repeat : int) -> dict:
+    """関数の実行時間を測る。
+
+    Args:
+        func : 引数なしの関数
+        repeat : 繰り返し回数
+
+    Returns: 平均と最小の実行時間(ミリ秒)
+    """
+    # 最初の1回は計測しない。
+    func()
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    return { "mean_ms" : 1000 * float(np.mean(times)), "min_ms" : 1000 * float(np.min(times)) }
+
+def make_blend_inputs(img_size : int, rng : np.random.Generator):
+    """貼り付けのベンチマークの入力を作る。
+
+    Args:
+        img_size : 画像サイズ
+        rng : 乱数生成器
+
+    Returns: 背景画像, 座標変換後の画像, 座標変換後のマスク画像
+    """
+    bg_img  = rng.integers(0, 256, (img_size, img_size, 3), dtype=np.uint8)
+    aug_img = rng.integers(0, 256, (img_size, img_size, 3), dtype=np.uint8)
+
+    # 画像サイズの25%程度の回転した楕円のマスク画像
+    mask_img = np.zeros((img_size, img_size), dtype=np.uint8)
+    center = (img_size // 2, img_size // 2)
+    cv2.ellipse(mask_img, center, (img_size // 8, img_size // 12), 30, 0, 360, 255, -1)
+
+    return bg_img, aug_img, mask_img
+
+def bench_blend(img_size : int, repeat : int) -> list:
+    """PILを使う実装とOpenCVの実装の貼り付けの時間と差を測る。
+
+    Args:
+        img_size : 画像サイズ
+        repeat : 繰り返し回数
+
+    Returns: 計測結果のリスト
+    """
+    bg_img, aug_img, mask_img = make_blend_inputs(img_size, np.random.default_rng(0))
+
+    # 2つの実装の画素値の差
+    ref_img = blend_image_pil(bg_img, aug_img, mask_img)
+    new_img = blend_image(bg_img.copy(), aug_img, mask_img)
+    diff = np.abs(ref_img.astype(np.int16) - new_img.astype(np.int16))
+
+    results = []
+    for impl, func in [ ('pil', lambda: blend_image_pil(bg_img, aug_img, mask_img)), ('cv2', lambda: blend_image(bg_img.copy(), aug_img, mask_img)) ]:
+        result = { "stage" : "blend", "impl" : impl, "img_size" : img_size, "repeat" : repeat }
+        result.update(time_it(func, repeat))
+        results.append(result)
+
+    results[-1].update({ "max_diff" : int(diff.max()), "mean_diff" : float(diff.mean()) })
+
+    return results
+
+def make_frame(rng : np.random.Generator, width : int = 1920, height : int = 1080) -> np.ndarray:
+    """白い背景の上に物体がある原画を作る。
+
+    Args:
+        rng : 乱数生成器
+        width : 原画の幅
+        height : 原画の高さ
+
+    Returns: 原画
+    """
+    frame = np.full((height, width, 3), 255, dtype=np.uint8)
+
+    # 原画の中心にある、短辺の1/3程度の楕円の物体
+    color = tuple(int(x) for x in rng.integers(0, 200, 3))
+    cv2.ellipse(frame, (width // 2, height // 2), (height // 6, height // 9), 20, 0, 360, color, -1)
+
+    return frame
+
+def make_synthetic_video(video_path : str, color : tuple, rng : np.random.Generator, frames : int = 60, width : int = 1280, height : int = 720):
+    """camera.pyで撮影したような、白い背景の上で物体が動く動画ファイルを作る。
+
+    Args:
+        video_path : 動画ファイルのパス
+        color : 物体の色(BGR)
+        rng : 乱数生成器
+        frames : フレーム数
+        width : 動画の幅
+        height : 動画の高さ
+    """
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*'MJPG'), 30, (width, height))
+
+    for i in range(frames):
+        # 少しむらのある白い背景
+        frame = rng.integers(252, 256, (height, width, 3), dtype=np.uint8)
+
+        # 背景の小さなゴミ
+        for x, y in rng.integers(0, min(width, height), (5, 2)):
+            cv2.circle(frame, (int(x), int(y)), 2, (120, 120, 120), -1)
+
+        # 回転しながら動く楕円の物体
+        cx = int(width  / 2 + width  / 8 * np.sin(i / 10))
+        cy = int(height / 2 + height / 8 * np.cos(i / 13))
+        cv2.ellipse(frame, (cx, cy), (height // 5, height // 8), 3 * i, 0, 360, color, -1)
+
+        writer.write(frame)
+
+    writer.release()
+
+def make_synthetic_data(data_dir : str, videos : int = 2, frames : int = 60, backgrounds : int = 16):
+    """ベンチマーク用の動画ファイルと背景画像を作る。
+
+    Args:
+        data_dir : 出力先のフォルダのパス
+        videos : 1クラスあたりの動画ファイルの数
+        frames : 動画ファイルのフレーム数
+        backgrounds : 背景画像の数
+    """
+    rng = np.random.default_rng(0)
+
+    for class_name, color in synthetic_classes:
+        os.makedirs(f'{data_dir}/videos/{class_name}', exist_ok=True)
+
+        for video_idx in range(videos):
+            make_synthetic_video(f'{data_dir}/videos/{class_name}/{video_idx}.avi', color, rng, frames)
+
+    os.makedirs(f'{data_dir}/bg', exist_ok=True)
+    for idx in range(backgrounds):
+        # ぼかしたノイズの背景画像。サイズは背景画像ごとに変える。
+        bg_img = rng.integers(0, 256, (600 + 20 * idx, 900, 3), dtype=np.uint8)
+        cv2.imwrite(f'{data_dir}/bg/{idx}.jpg', cv2.GaussianBlur(bg_img, (21, 21), 0))
+
+def get_work_dir() -> str:
+    """合成した動画ファイルと背景画像のフォルダのパスを返す。まだなければ作る。
+    """
+    global work_dir
+
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='auto-img-tag-bench-')
+
+    if not os.path.isdir(f'{work_dir}/videos'):
+        make_synthetic_data(work_dir)
+
+    return work_dir
+
+def bench_decode(img_size : int, repeat : int) -> list:
+    """合成した動画ファイルの全フレームをデコードする時間を測る。
+
+    Args:
+        img_size : 画像サイズ (この計測では使わない)
+        repeat : 繰り返し回数
+
+    Returns: 計測結果のリスト
+    """
+    video_path = sorted(glob.glob(f'{get_work_dir()}/videos/*/*.avi'))[0]
+
+    # 読んだフレーム数
+    counts = []
+
+    def read_all(decode : bool):
+        cap = cv2.VideoCapture(video_path)
+        cnt = 0
+        while cap.grab():
+            if decode:
+                cap.retrieve()
+            cnt += 1
+
+        cap.release()
+        counts.append(cnt)
+
+    results = []
+    for impl, func in [ ('read', lambda: read_all(True)), ('grab', lambda: read_all(False)) ]:
+        result = { "stage" : "decode", "impl" : impl, "img_size" : img_size, "repeat" : repeat }
+        result.update(time_it(func, repeat))
+        result["per_frame_ms"] = result["mean_ms"] / counts[-1]
+        results.append(result)
+
+    return results
+
+def bench_threshold(img_size : int, repeat : int) -> list:
+    """原画をグレー画像にして二値化する時間を測る。
+
+    Args:
+        img_size : 画像サイズ (この計測では使わない)
+        repeat : 繰り返し回数
+
+    Returns: 計測結果のリスト
+    """
+    frame = make_frame(np.random.default_rng(0))
+
+    def threshold():
+        gray_img = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return 255 - cv2.inRange(gray_img, 250, 255)
+
+    result = { "stage" : "threshold", "impl" : "inRange", "img_size" : img_size, "repeat" : repeat }
+    result.update(time_it(threshold, repeat))
+
+    return [ result ]
+
+def bench_contour(img_size : int, repeat : int) -> list:
+    """二値画像から物体の輪郭を得る時間を、ゴミのない原画とゴミの多い原画で測る。
+
+    Args:
+        img_size : 画像サイズ (この計測では使わない)
+        repeat : 繰り返し回数
+
+    Returns: 計測結果のリスト
+    """
+    rng = np.random.default_rng(0)
+
+    clean = make_frame(rng)
+
+    # 小さなゴミが多い原画
+    noisy = clean.copy()
+    for x, y in rng.integers(0, noisy.shape[0], (2000, 2)):
+        cv2.circle(noisy, (int(x) * noisy.shape[1] // noisy.shape[0], int(y)), 1, (100, 100, 100), -1)
+
+    results = []
+    for impl, frame in [ ('clean', clean), ('noisy', noisy) ]:
+        bin_img = 255 - cv2.inRange(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), 250, 255)
+
+        # 輪郭ごとに調べる場合と、連結成分の統計からまとめて選ぶ場合
+        for segment, downscale in [ ('contours', 1), ('components', 1), ('components', 4) ]:
+            result = { "stage" : "contour", "impl" : impl, "segment" : segment, "downscale" : downscale, "img_size" : img_size, "repeat" : repeat }
+            result.update(time_it(lambda: getContour(bin_img, segment, downscale), repeat))
+            result["msg"] = getContour(bin_img, segment, downscale)[0]
+            results.append(result)
+
+    return results
+
+def bench_warp(img_size : int, repeat : int) -> list:
+    """画像全体の座標変換と、物体の外接矩形の内部だけの座標変換の時間を測る。
+
+    Args:
+        img_size : 画像サイズ
+        repeat : 繰り返し回数
+
+    Returns: 計測結果のリスト
+    """
+    frame = make_frame(np.random.default_rng(0))
+
+    gray_img = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    msg, contour, mask_img = getContour(255 - cv2.inRange(gray_img, 250, 255))
+
+    # 回転・拡大/縮小・平行移動の変換行列
+    M = random_transforms(contour, img_size, 1)[0]
+
+    ox, oy, ow, oh = object_rect(contour, frame.shape)
+    src_roi = frame[oy:(oy+oh), ox:(ox+ow)]
+    mask_roi = mask_img[oy:(oy+oh), ox:(ox+ow)]
+
+    def warp_full():
+        cv2.warpAffine(frame, M, (img_size, img_size))
+        cv2.warpAffine(mask_img, M, (img_size, img_size))
+
+    results = []
+    for impl, func in [ ('full', warp_full), ('roi', lambda: warp_object(src_roi, [ mask_roi ], (ox, oy), M, img_size)) ]:
+        result = { "stage" : "warp", "impl" : impl, "img_size" : img_size, "repeat" : repeat }
+        result.update(time_it(func, repeat))
+        results.append(result)
+
+    return results
+
+def bench_color(img_size : int, repeat : int) -> list:
+    """原画全体と物体の外接矩形の内部だけの、色のデータ拡張の時間を測る。
+
+    Args:
+        img_size : 画像サイズ (この計測では使わない)
+        repeat : 繰り返し回数
+
+    Returns: 計測結果のリスト
+    """
+    frame = make_frame(np.random.default_rng(0))
+
+    gray_img = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    msg, contour, mask_img = getContour(255 - cv2.inRange(gray_img, 250, 255))
+
+    ox, oy, ow, oh = object_rect(contour, frame.shape)
+    src_roi = frame[oy:(oy+oh), ox:(ox+ow)]
+
+    results = []
+    for impl, func in [ ('frame', lambda: transform(image=frame)), ('roi', lambda: transform(image=src_roi)) ]:
+        result = { "stage" : "color", "impl" : impl, "img_size" : img_size, "repeat" : repeat }
+        result.update(time_it(func, repeat))
+        results.append(result)
+
+    return results
+
+def bench_placement(img_size : int, repeat : int) -> list:
+    """5個の物体の配置の時間を測る。
+
+    Args:
+        img_size : 画像サイズ
+        repeat : 繰り返し回数
+
+    Returns: 計測結果のリスト
+    """
+    frame = make_frame(np.random.default_rng(0))
+
+    gray_img = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    msg, contour, mask_img = getContour(255 - cv2.inRange(gray_img, 250, 255))
+    box = cv2.boxPoints(cv2.minAreaRect(contour))
+
+    # 配置できた物体の数
+    counts = []
+
+    def place():
+        counts.append(len(PlacementEngine(img_size).place(contour, box, 5)))
+
+    result = { "stage" : "placement", "impl" : "grid", "img_size" : img_size, "repeat" : repeat }
+    result.update(time_it(place, repeat))
+    result["mean_objects"] = float(np.mean(counts))
+
+    return [ result ]
+
+def bench_encode(img_size : int, repeat : int) -> list:
+    """合成画像をJPEGに圧縮する時間を測る。
+
+    Args:
+        img_size : 画像サイズ
+        repeat : 繰り返し回数
+
+    Returns: 計測結果のリスト
+    """
+    bg_img, aug_img, mask_img = make_blend_inputs(img_size, np.random.default_rng(0))
+
+    # 背景画像をぼかして、実際の合成画像に近い圧縮率にする。
+    compo_img = blend_image(cv2.GaussianBlur(bg_img, (21, 21), 0), aug_img, mask_img)
+
+    result = { "stage" : "encode", "impl" : "jpg", "img_size" : img_size, "repeat" : repeat }
+    result.update(time_it(lambda: cv2.imencode('.jpg', compo_img), repeat))
+    result["bytes"] = len(cv2.imencode('.jpg', compo_img)[1])
+
+    return [ result ]
+
+def bench_json(img_size : int, repeat : int, images : int = 1000, objects : int = 5) -> list:
+    """train.jsonを書く時間を測る。
+
+    Args:
+        img_size : 画像サイズ
+        repeat : 繰り返し回数
+        images : 画像の数
+        objects : 1枚の画像の物体の数
+
+    Returns: 計測結果のリスト
+    """
+    output_dir = tempfile.mkdtemp(prefix='auto-img-tag-bench-json-')
+
+    class_names = [ x for x, _ in synthetic_classes ]
+    network = ODTK(output_dir, [ type('ImageClass', (), { "name" : x })() for x in class_names ], writers=0)
+
+    for image_id in range(1, images + 1):
+        network.AnnoObj["images"].append({ "id" : image_id, "width" : img_size, "height" : img_size, "file_name" : f'0-0-0-{image_id}.jpg' })
+
+        for _ in range(objects):
+            network.AnnoObj["annotations"].append({
+                "id" : len(network.AnnoObj["annotations"]) + 1,
+                "image_id" : image_id,
+                "category_id" : image_id % len(class_names),
+                "bbox" : [ 0.25 * img_size, 0.25 * img_size, 0.1 * img_size, 0.1 * img_size, 0.5 ],
+                "segmentation" : [ [ 0.25 * img_size, 0.25 * img_size ] ] * 4,
+                "area" : 0.01 * img_size * img_size,
+                "iscrowd" : 0
+            })
+
+    result = { "stage" : "json", "impl" : "save", "img_size" : img_size, "repeat" : repeat, "images" : images }
+    result.update(time_it(network.save, repeat))
+
+    shutil.rmtree(output_dir)
+
+    return [ result ]
+
+def bench_end_to_end(img_size : int, repeat : int) -> list:
+    """合成した動画ファイルと背景画像から学習データを作る時間を測る。
+
+    Args:
+        img_size : 画像サイズ
+        repeat : 1クラスあたりの学習データの数
+
+    Returns: 計測結果のリスト
+    """
+    data_dir = get_work_dir()
+    output_dir = f'{data_dir}/out-{img_size}'
+
+    # main.pyの表示は計測結果のJSONに混ざらないようにする。
+    with contextlib.redirect_stdout(sys.stderr):
+        image_classes = make_image_classes(f'{data_dir}/videos')
+        bg_img_paths = sorted(glob.glob(f'{data_dir}/bg/*.jpg'))
+        bank = BackgroundBank(f'{data_dir}/bg', bg_img_paths, img_size)
+
+        start = time.perf_counter()
+        cnt = sum(1 for _ in make_training_data(output_dir, image_classes, bg_img_paths, repeat, img_size, 250, seed=0, bank=bank, checkpoint_interval=0))
+        seconds = time.perf_counter() - start
+
+    shutil.rmtree(output_dir)
+
+    result = { "stage" : "end_to_end", "impl" : "main", "img_size" : img_size, "repeat" : repeat, "images" : cnt }
+    result.update({ "seconds" : seconds, "images_per_sec" : cnt / seconds, "mean_ms" : 1000 * seconds / max(1, cnt) })
+
+    return [ result ]
+
+benchmarks = {
+    'decode' : bench_decode,
+    'threshold' : bench_threshold,
+    'contour' : bench_contour,
+    'blend' : bench_blend,
+    'warp'  : bench_warp,
+    'color' : bench_color,
+    'placement' : bench_placement,
+    'encode' : bench_encode,
+    'json' : bench_json,
+    'end_to_end' : bench_end_to_end
+}
+"""ステージ名からベンチマークの関数への辞書"""
+
+def parse():
+    """コマンドライン引数を解析する。
+
+    Returns: 引数のリスト
+    """
+    parser = argparse.ArgumentParser(description='学習データ作成の処理時間を測る。')
+    parser.add_argument('-s', '--stages', type=str, nargs='+', help='測るステージのリスト。デフォルトはすべて。', default=list(benchmarks.keys()))
+    parser.add_argument('-imsz', '--img_size', type=int, nargs='+', help='出力画像のサイズのリスト。デフォルトは 360 720。', default=[360, 720])
+    parser.add_argument('-r', '--repeat', type=int, help='繰り返し回数。デフォルトは20。', default=20)
+    parser.add_argument('-o', '--output', type=str, help='計測結果のJSONファイルのパス。指定しなければ標準出力に書く。', default=None)
+    parser.add_argument('--work_dir', type=str, help='合成した動画ファイルと背景画像のフォルダのパス。指定すれば次回も再利用する。指定しなければ一時フォルダに作って最後に削除する。', default=None)
+
+    return parser.parse_args(sys.argv[1:])
+
+if __name__ == '__main__':
+    args = parse()
+
+    work_dir = args.work_dir
+
+    results = []
+    try:
+        for stage in args.stages:
+            for img_size in args.img_size:
+                for result in benchmarks[stage](img_size, args.repeat):
+                    print(result, file=sys.stderr)
+                    results.append(result)
+
+    finally:
+        if args.work_dir is None and work_dir is not None:
+            # 一時フォルダに作った動画ファイルと背景画像を削除する。(マニフェストと背景画像のバンクもこのフォルダの中にある)
+            shutil.rmtree(work_dir)
+
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=4)
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
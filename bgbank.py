@@ -0,0 +1,158 @@
+import os
+import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+from util import resize_bg_img
+
+class BackgroundBank:
+    """リサイズ済みの背景画像のバンク
+
+    背景画像は画像サイズごとに1回だけデコードとリサイズをして、ディスク上のメモリマップ配列に保存する。
+    次回の実行ではその配列を再利用し、最近使った背景画像は枚数を制限してメモリに置く。
+    """
+    def __init__(self, bg_img_dir : str, bg_img_paths : list, img_size : int, ram_size : int = 256, threads : int = 8):
+        self.bgImgDir = bg_img_dir
+        """背景画像ファイルのフォルダのパス"""
+
+        self.imgSize = img_size
+        """画像サイズ"""
+
+        self.ramSize = ram_size
+        """メモリに置く背景画像の最大枚数"""
+
+        bank_dir = os.path.normpath(os.path.abspath(bg_img_dir)).replace('\\', '/') + '.bgbank'
+
+        self.dataPath = f'{bank_dir}/bg-{img_size}.npy'
+        """背景画像の配列のファイルのパス"""
+
+        self.indexPath = f'{bank_dir}/bg-{img_size}.json'
+        """背景画像ファイルと配列の行の対応表のファイルのパス"""
+
+        self.rows = {}
+        """背景画像ファイルの相対パスから配列の行への辞書 (読めない画像は-1)"""
+
+        self.images = None
+        """背景画像のメモリマップ配列"""
+
+        self.cache = OrderedDict()
+        """最近使った背景画像のキャッシュ"""
+
+        os.makedirs(bank_dir, exist_ok=True)
+        self.build(bg_img_paths, threads)
+
+    def __getstate__(self):
+        # ワーカー プロセスに渡すときは、配列とキャッシュは渡さずに開き直す。
+        state = self.__dict__.copy()
+        state['images'] = None
+        state['cache'] = OrderedDict()
+
+        return state
+
+    def rel_path(self, bg_img_path : str) -> str:
+        """背景画像ファイルのフォルダからの相対パスを返す。
+        """
+        return os.path.relpath(bg_img_path, self.bgImgDir).replace('\\', '/')
+
+    def build(self, bg_img_paths : list, threads : int):
+        """保存済みのバンクを読み、足りない背景画像だけをデコードしてバンクを作り直す。
+
+        Args:
+            bg_img_paths : 背景画像ファイルのパスのリスト
+            threads : デコードするスレッドの数
+        """
+        # 相対パスから(行, ファイルサイズ, 更新日時)への辞書
+        old_index = {}
+        if os.path.isfile(self.indexPath) and os.path.isfile(self.dataPath):
+            with open(self.indexPath) as f:
+                old_index = { x["path"] : (x["row"], x["size"], x["mtime"]) for x in json.load(f)["images"] }
+
+        index = []
+        for path in bg_img_paths:
+            st = os.stat(path)
+            index.append({ "path" : self.rel_path(path), "size" : st.st_size, "mtime" : st.st_mtime_ns })
+
+        # 保存済みで変更されていない背景画像の古い行
+        old_rows = [ old_index[x["path"]][0] if old_index.get(x["path"], (None,))[1:] == (x["size"], x["mtime"]) else None for x in index ]
+
+        if len(old_index) == len(index) and all(row is not None for row in old_rows):
+            # バンクをそのまま使える場合
+
+            self.rows = { x["path"] : row for x, row in zip(index, old_rows) }
+            return
+
+        old_images = np.load(self.dataPath, mmap_mode='r') if len(old_index) != 0 else None
+
+        tmp_path = f'{self.dataPath}.tmp.npy'
+        images = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(max(1, len(index)), self.imgSize, self.imgSize, 3))
+
+        def load(i):
+            if old_rows[i] is not None:
+                # 保存済みの場合は古い配列からコピーする。
+
+                if old_rows[i] < 0:
+                    return -1
+
+                images[i] = old_images[old_rows[i]]
+                return i
+
+            # 背景画像ファイルを読む。
+            bg_img = cv2.imread(bg_img_paths[i])
+            if bg_img is None:
+                return -1
+
+            # 背景画像を指定したサイズにする。
+            images[i] = resize_bg_img(bg_img, self.imgSize)
+            return i
+
+        # デコードとリサイズはGILを解放するので、スレッドで並列に処理する。
+        with ThreadPoolExecutor(threads) as executor:
+            rows = list(executor.map(load, range(len(index))))
+
+        images.flush()
+        del images, old_images
+
+        for x, row in zip(index, rows):
+            x["row"] = row
+
+        # 配列を書き終えてから、配列と対応表を置き換える。
+        os.replace(tmp_path, self.dataPath)
+        with open(f'{self.indexPath}.tmp', 'w') as f:
+            json.dump({ "img_size" : self.imgSize, "images" : index }, f)
+        os.replace(f'{self.indexPath}.tmp', self.indexPath)
+
+        self.rows = { x["path"] : row for x, row in zip(index, rows) }
+
+    def get(self, bg_img_path : str) -> np.ndarray:
+        """指定したサイズの背景画像を返す。
+
+        Args:
+            bg_img_path : 背景画像ファイルのパス
+
+        Returns: 背景画像 (読めない画像の場合はNone)
+        """
+        row = self.rows[self.rel_path(bg_img_path)]
+        if row < 0:
+            return None
+
+        bg_img = self.cache.get(row)
+        if bg_img is not None:
+            # キャッシュにある場合
+
+            self.cache.move_to_end(row)
+            return bg_img
+
+        if self.images is None:
+            self.images = np.load(self.dataPath, mmap_mode='r')
+
+        # メモリマップ配列からメモリにコピーする。
+        bg_img = np.array(self.images[row])
+
+        self.cache[row] = bg_img
+        if self.ramSize < len(self.cache):
+            # 最も長く使っていない背景画像を捨てる。
+
+            self.cache.popitem(last=False)
+
+        return bg_img
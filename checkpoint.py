@@ -0,0 +1,85 @@
+import os
+import json
+import shutil
+
+class Checkpoint:
+    """学習データの作成を途中から再開するためのチェックポイント
+
+    出力先の checkpoint フォルダに、チェックポイントごとに増えた画像とアノテーションを追記するログ(anno.jsonl)と、
+    作成の状態(state.json)を置く。state.json にはログの有効なバイト数も入れるので、ログの書き込みの途中で止まった部分は読まない。
+    """
+    def __init__(self, output_dir : str):
+        self.dir = f'{output_dir}/checkpoint'
+        """チェックポイントのフォルダのパス"""
+
+        self.logPath = f'{self.dir}/anno.jsonl'
+        """画像とアノテーションのログのパス"""
+
+        self.statePath = f'{self.dir}/state.json'
+        """作成の状態のファイルのパス"""
+
+        self.logSize = 0
+        """ログの有効なバイト数"""
+
+    def load(self) -> dict:
+        """保存された状態を読む。
+
+        Returns: 作成の状態 (チェックポイントがない場合はNone)。"images" と "annotations" にはログのすべての要素が入る。
+        """
+        if not os.path.isfile(self.statePath):
+            return None
+
+        with open(self.statePath) as f:
+            state = json.load(f)
+
+        self.logSize = state["log_size"]
+
+        images, annotations = [], []
+        with open(self.logPath, 'rb') as f:
+            for line in f.read(self.logSize).splitlines():
+                entry = json.loads(line)
+                images += entry["images"]
+                annotations += entry["annotations"]
+
+        state["images"], state["annotations"] = images, annotations
+
+        return state
+
+    def save(self, state : dict, images : list, annotations : list):
+        """前回のチェックポイントから増えた画像とアノテーションをログに追記して、作成の状態を書く。
+
+        Args:
+            state : 作成の状態
+            images : 増えた画像の情報のリスト
+            annotations : 増えたアノテーションのリスト
+        """
+        os.makedirs(self.dir, exist_ok=True)
+
+        line = json.dumps({ "images" : images, "annotations" : annotations }).encode() + b'\n'
+
+        with open(self.logPath, 'ab') as f:
+            # 前回のチェックポイントの後で書きかけた部分を捨てる。
+            f.truncate(self.logSize)
+            f.seek(self.logSize)
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.logSize += len(line)
+
+        tmp_path = f'{self.statePath}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(state, log_size=self.logSize), f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        # 書き込みの途中で止まっても壊れないように、書き終えてから置き換える。
+        os.replace(tmp_path, self.statePath)
+
+    def remove(self):
+        """チェックポイントを削除する。
+        """
+        if os.path.isdir(self.dir):
+            shutil.rmtree(self.dir)
+
+        self.logSize = 0
@@ -0,0 +1,523 @@
+import os
+import sys
+import math
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import cv2
+from tqdm import tqdm
+from util import getContour
+from manifest import VideoManifest
+from quality import QualityFilter
+import profiler
+
+class Cutout:
+    """原画から切り抜いた物体
+    """
+    def __init__(self, image : np.ndarray, mask : np.ndarray, x : int, y : int, contour : np.ndarray, rect : tuple):
+        self.image = image
+        """物体の外接矩形の内部の原画"""
+
+        self.mask = mask
+        """物体の外接矩形の内部のマスク画像"""
+
+        self.x = x
+        """外接矩形の原画でのX座標"""
+
+        self.y = y
+        """外接矩形の原画でのY座標"""
+
+        self.contour = contour
+        """原画の座標での輪郭"""
+
+        self.rect = rect
+        """回転を考慮した外接矩形 (cv2.minAreaRectの値)"""
+
+def object_rect(contour : np.ndarray, shape : tuple, pad : int = 2) -> tuple:
+    """輪郭の外接矩形を、補間のために少し広げて画像の内部に収めたものを返す。
+
+    Args:
+        contour : 輪郭
+        shape : 原画の形
+        pad : 広げる画素数
+
+    Returns: 外接矩形の位置とサイズ
+    """
+    x, y, w, h = cv2.boundingRect(contour)
+
+    x1, y1 = max(0, x - pad), max(0, y - pad)
+    x2, y2 = min(shape[1], x + w + pad), min(shape[0], y + h + pad)
+
+    return x1, y1, x2 - x1, y2 - y1
+
+def segment_frame(frame : np.ndarray, v_min : int, segment : str = 'contours', downscale : int = 1, quality : QualityFilter = None):
+    """原画を二値化して、物体の輪郭とマスク画像を得る。
+
+    Args:
+        frame : 原画
+        v_min : 明度の閾値
+        segment : 物体を選ぶ方法 ('contours' または 'components')
+        downscale : segmentが'components'の場合に、物体を選ぶ画像の縮小率の逆数
+        quality : 画質の悪いフレームを棄却するフィルター
+
+    Returns: 二値画像, getContourのメッセージ(または画質のメッセージ), 輪郭, マスク画像
+    """
+    with profiler.Stage('threshold'):
+        # グレー画像
+        gray_img = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+        # 二値画像
+        bin_img = 255 - cv2.inRange(gray_img, v_min, 255)
+
+    if quality is not None:
+        with profiler.Stage('quality'):
+            # 輪郭を探す前に、ぼけているか露出が合っていないフレームを棄却する。
+            msg = quality.check(gray_img)
+
+        if msg != '':
+            return bin_img, msg, None, None
+
+    with profiler.Stage('contour'):
+        # 二値画像から輪郭とマスク画像を得る。
+        msg, contour, mask_img = getContour(bin_img, segment, downscale)
+
+    return bin_img, msg, contour, mask_img
+
+def cutout_contour(frame : np.ndarray, contour : np.ndarray, mask_img : np.ndarray) -> Cutout:
+    """輪郭の内部の物体を切り抜く。
+
+    Args:
+        frame : 原画
+        contour : 原画の座標での輪郭
+        mask_img : 原画と同じサイズのマスク画像
+
+    Returns: 切り抜いた物体
+    """
+    # 物体の外接矩形
+    x, y, w, h = object_rect(contour, frame.shape)
+
+    # 回転を考慮した外接矩形を得る。
+    rect = cv2.minAreaRect(contour)
+
+    return Cutout(frame[y:(y+h), x:(x+w)], mask_img[y:(y+h), x:(x+w)], x, y, contour, rect)
+
+def make_cutout(frame : np.ndarray, v_min : int, segment : str = 'contours', downscale : int = 1, quality : QualityFilter = None):
+    """原画を二値化して物体を切り抜く。
+
+    Args:
+        frame : 原画
+        v_min : 明度の閾値
+        segment : 物体を選ぶ方法 ('contours' または 'components')
+        downscale : segmentが'components'の場合に、物体を選ぶ画像の縮小率の逆数
+        quality : 画質の悪いフレームを棄却するフィルター
+
+    Returns: 二値画像, getContourのメッセージ(または画質のメッセージ), マスク画像, 切り抜いた物体 (切り抜けない場合はマスク画像と物体はNone)
+    """
+    bin_img, msg, contour, mask_img = segment_frame(frame, v_min, segment, downscale, quality)
+
+    if msg != '':
+        # フレームを棄却した理由を数える。
+        profiler.count(f'フレーム: {msg}')
+
+        return bin_img, msg, None, None
+
+    return bin_img, msg, mask_img, cutout_contour(frame, contour, mask_img)
+
+class ObjectTracker:
+    """前のフレームの物体の外接矩形を広げた範囲だけを二値化して、物体を切り抜く。
+
+    ターンテーブルの動画のように物体がほとんど動かない場合は、画像全体を二値化して探すより速い。
+    範囲の中で物体が見つからないか、範囲の端にかかるか、範囲の外にも大きな物体があるかも知れない場合は、画像全体で探し直す。
+    followで前のフレームと同じ動画の続きのフレームか調べて、そうでなければ画像全体で探す。
+    """
+    def __init__(self, v_min : int, segment : str = 'contours', downscale : int = 1, quality : QualityFilter = None, pad_ratio : float = 0.25, check_step : int = 8):
+        """
+        Args:
+            v_min : 明度の閾値
+            segment : 物体を選ぶ方法 ('contours' または 'components')
+            downscale : segmentが'components'の場合に、物体を選ぶ画像の縮小率の逆数
+            quality : 画質の悪いフレームを棄却するフィルター。追跡中も画質は画像全体で調べる。
+            pad_ratio : 前のフレームの外接矩形を、幅と高さのこの割合だけ広げて探す。
+            check_step : 範囲の外を調べるときに、縦横をこの画素ごとに間引く。
+        """
+        self.vMin = v_min
+        """明度の閾値"""
+
+        self.segment = segment
+        """物体を選ぶ方法"""
+
+        self.downscale = downscale
+        """物体を選ぶ画像の縮小率の逆数"""
+
+        self.quality = quality
+        """画質の悪いフレームを棄却するフィルター"""
+
+        self.padRatio = pad_ratio
+        """前のフレームの外接矩形を広げる割合"""
+
+        self.checkStep = check_step
+        """範囲の外を調べるときに間引く画素数"""
+
+        self.rect = None
+        """前のフレームの物体の外接矩形 (見失った場合はNone)"""
+
+        self.lastKey = None
+        """前のフレームのキー"""
+
+    def reset(self):
+        """追跡をやめて、次のフレームは画像全体で探す。
+        """
+        self.rect = None
+
+    def follow(self, key : tuple):
+        """次のフレームのキーを調べて、前のフレームと同じ動画の続きのフレームでなければ追跡をやめる。
+
+        ワーカー プロセスや複数のスレッドで処理する場合は、前に処理したフレームが別の動画か、間のフレームを別のプロセスで処理したことがある。
+
+        Args:
+            key : クラスのインデックス, 動画ファイルのインデックス, クラス内のフレームの通し番号, フレームのインデックス (不明ならNone)
+        """
+        last_key, self.lastKey = self.lastKey, key
+
+        if key is None or last_key is None or key[:2] != last_key[:2] or key[2] != last_key[2] + 1 or key[3] <= last_key[3]:
+            self.reset()
+
+    def search_window(self, shape : tuple) -> tuple:
+        """前のフレームの物体の外接矩形を広げた範囲を返す。
+
+        Args:
+            shape : 原画の形
+
+        Returns: 範囲の左上と右下のXY座標
+        """
+        x, y, w, h = self.rect
+        pad_x = int(self.padRatio * w) + 16
+        pad_y = int(self.padRatio * h) + 16
+
+        return max(0, x - pad_x), max(0, y - pad_y), min(shape[1], x + w + pad_x), min(shape[0], y + h + pad_y)
+
+    def outside_is_empty(self, frame : np.ndarray, window : tuple) -> bool:
+        """範囲の外に、物体の候補になる大きさの明るくない部分がなければTrueを返す。
+
+        Args:
+            frame : 原画
+            window : 範囲の左上と右下のXY座標
+
+        Returns: 範囲の外に物体の候補がなければTrue
+        """
+        step = self.checkStep
+
+        # 間引いた原画の二値画像
+        small = 255 - cv2.inRange(cv2.cvtColor(np.ascontiguousarray(frame[::step, ::step]), cv2.COLOR_BGR2GRAY), self.vMin, 255)
+
+        # 範囲の内部を除く。
+        x0, y0, x1, y1 = window
+        small[-(-y0 // step):-(-y1 // step), -(-x0 // step):-(-x1 // step)] = 0
+
+        # 物体の候補は画像全体の1%より大きいので、その半分より少なければ候補はない。
+        return cv2.countNonZero(small) < 0.005 * small.size
+
+    def track(self, frame : np.ndarray):
+        """前のフレームの物体の周りだけで物体を探す。
+
+        Args:
+            frame : 原画
+
+        Returns: 二値画像, 輪郭, マスク画像 (見失った場合はNone)
+        """
+        img_height, img_width = frame.shape[:2]
+
+        window = self.search_window(frame.shape)
+        x0, y0, x1, y1 = window
+
+        # 画質は make_cutout で画像全体で調べたので、範囲の中では調べない。
+        bin_roi, msg, contour, mask_roi = segment_frame(frame[y0:y1, x0:x1], self.vMin, self.segment, self.downscale)
+
+        bin_img = np.zeros((img_height, img_width), dtype=np.uint8)
+        bin_img[y0:y1, x0:x1] = bin_roi
+
+        if msg != '':
+            # 範囲の中に物体がないか、範囲の端にかかる場合
+            return None
+
+        # 面積が画像全体の10%以上か確かめる。(範囲の中では範囲の面積と比べている)
+        if math.sqrt(cv2.contourArea(contour) / (img_width * img_height)) <= 0.10:
+            return None
+
+        if not self.outside_is_empty(frame, window):
+            return None
+
+        # 原画の座標にする。
+        contour = contour + np.array([x0, y0], dtype=contour.dtype)
+
+        mask_img = np.zeros((img_height, img_width), dtype=np.uint8)
+        mask_img[y0:y1, x0:x1] = mask_roi
+
+        return bin_img, contour, mask_img
+
+    def make_cutout(self, frame : np.ndarray):
+        """原画を二値化して物体を切り抜く。前のフレームで物体を切り抜いた場合は、その周りだけを二値化する。
+
+        Args:
+            frame : 原画
+
+        Returns: make_cutoutと同じ
+        """
+        quality = self.quality
+        if self.rect is not None and quality is not None and quality.is_enabled():
+            # 追跡中も、画質は範囲の中ではなく画像全体で調べる。
+            with profiler.Stage('quality'):
+                gray_img = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+                msg = quality.check(gray_img)
+
+            if msg != '':
+                # 画質が悪い場合は、物体の位置は前のフレームのままにする。
+                profiler.count(f'フレーム: {msg}')
+
+                return 255 - cv2.inRange(gray_img, self.vMin, 255), msg, None, None
+
+            # 画像全体で探し直す場合も、同じフレームの画質は調べ直さない。
+            quality = None
+
+        ret = self.track(frame) if self.rect is not None else None
+        if ret is None:
+            # 前のフレームがないか、見失った場合は画像全体で探す。
+
+            if self.rect is not None:
+                profiler.count('追跡: 見失った')
+
+            bin_img, msg, mask_img, cutout = make_cutout(frame, self.vMin, self.segment, self.downscale, quality)
+
+            self.rect = cv2.boundingRect(cutout.contour) if cutout is not None else None
+
+            return bin_img, msg, mask_img, cutout
+
+        bin_img, contour, mask_img = ret
+
+        self.rect = cv2.boundingRect(contour)
+
+        return bin_img, '', mask_img, cutout_contour(frame, contour, mask_img)
+
+class CutoutStore:
+    """動画ファイルから切り抜いた物体の保存先
+
+    明度の閾値ごとのフォルダに、動画ファイルごとの索引(JSON)と、物体の画像とマスクをBGRAのPNGにしたものを連結したファイルを置く。
+    """
+    def __init__(self, store_dir : str, v_min : int):
+        self.vMin = v_min
+        """明度の閾値"""
+
+        self.dir = f'{store_dir}/vmin-{v_min}'
+        """明度の閾値ごとのフォルダのパス"""
+
+        self.indexes = {}
+        """動画ファイルのパスから索引への辞書"""
+
+        self.files = {}
+        """動画ファイルのパスから連結したファイルのディスクリプタへの辞書"""
+
+    def __getstate__(self):
+        # ワーカー プロセスに渡すときは、ファイルは開き直す。
+        state = self.__dict__.copy()
+        state['files'] = {}
+
+        return state
+
+    def base_path(self, video_path : str) -> str:
+        """動画ファイルの索引と連結したファイルのパスから拡張子を除いたものを返す。
+
+        Args:
+            video_path : 動画ファイルのパス
+
+        Returns: 拡張子を除いたパス
+        """
+        class_name, file_name = video_path.replace('\\', '/').split('/')[-2:]
+
+        return f'{self.dir}/{class_name}/{file_name}'
+
+    def get_index(self, video_path : str) -> dict:
+        """動画ファイルの索引を返す。
+
+        Args:
+            video_path : 動画ファイルのパス
+
+        Returns: 索引 (保存されていない場合はNone)
+        """
+        if video_path not in self.indexes:
+            index_path = f'{self.base_path(video_path)}.json'
+
+            if os.path.isfile(index_path):
+                with open(index_path) as f:
+                    self.indexes[video_path] = json.load(f)
+            else:
+                self.indexes[video_path] = None
+
+        return self.indexes[video_path]
+
+    def is_valid(self, video_path : str, info : dict) -> bool:
+        """動画ファイルの物体が保存されていて、動画ファイルが変更されていなければTrueを返す。
+
+        Args:
+            video_path : 動画ファイルのパス
+            info : 動画ファイルの情報 (マニフェストの値)
+
+        Returns: 保存された物体を使えればTrue
+        """
+        index = self.get_index(video_path)
+
+        return index is not None and index["size"] == info["size"] and index["mtime"] == info["mtime"]
+
+    def get_counts(self, image_class) -> list:
+        """クラスの動画ファイルごとの物体の数を返す。
+
+        Args:
+            image_class : 画像のクラス
+
+        Returns: 物体の数のリスト
+        """
+        return [ len(self.get_index(x)["cutouts"]) for x in image_class.videoPathes ]
+
+    def read(self, video_path : str, idx : int):
+        """保存された物体を読む。
+
+        Args:
+            video_path : 動画ファイルのパス
+            idx : 動画ファイルの中の物体のインデックス
+
+        Returns: 動画の位置, 切り抜いた物体
+        """
+        entry = self.get_index(video_path)["cutouts"][idx]
+
+        fd = self.files.get(video_path)
+        if fd is None:
+            fd = os.open(f'{self.base_path(video_path)}.bin', os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+            self.files[video_path] = fd
+
+        # PNGのバイト列を1回の読み込みで得る。
+        data = os.pread(fd, entry["length"], entry["offset"])
+        bgra = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+
+        contour = np.array(entry["contour"], dtype=np.int32).reshape(-1, 1, 2)
+        (cx, cy), (w, h), angle = entry["rect"]
+
+        cutout = Cutout(bgra[:, :, :3], bgra[:, :, 3], entry["x"], entry["y"], contour, ((cx, cy), (w, h), angle))
+
+        return entry["pos"], cutout
+
+    def close(self):
+        """開いているファイルを閉じる。
+        """
+        for fd in self.files.values():
+            os.close(fd)
+
+        self.files = {}
+
+def build_video(store : CutoutStore, video_path : str, info : dict) -> int:
+    """動画ファイルのすべてのフレームから物体を切り抜いて保存する。
+
+    Args:
+        store : 切り抜いた物体の保存先
+        video_path : 動画ファイルのパス
+        info : 動画ファイルの情報 (マニフェストの値)
+
+    Returns: 保存した物体の数
+    """
+    base_path = store.base_path(video_path)
+    os.makedirs(os.path.dirname(base_path), exist_ok=True)
+
+    cutouts = []
+    offset = 0
+
+    cap = cv2.VideoCapture(video_path)
+    with open(f'{base_path}.bin.tmp', 'wb') as f:
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+
+            # 動画の現在位置
+            pos = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+
+            bin_img, msg, mask_img, cutout = make_cutout(frame, store.vMin)
+            if cutout is None:
+                continue
+
+            # 物体の画像とマスクをBGRAのPNGにする。
+            bgra = np.dstack([cutout.image, cutout.mask])
+            data = cv2.imencode('.png', bgra)[1].tobytes()
+            f.write(data)
+
+            (cx, cy), (w, h), angle = cutout.rect
+            cutouts.append({
+                "pos" : pos,
+                "offset" : offset,
+                "length" : len(data),
+                "x" : cutout.x,
+                "y" : cutout.y,
+                "contour" : cutout.contour.reshape(-1).tolist(),
+                "rect" : [ [cx, cy], [w, h], angle ]
+            })
+
+            offset += len(data)
+
+    cap.release()
+
+    index = { "video" : video_path, "size" : info["size"], "mtime" : info["mtime"], "cutouts" : cutouts }
+
+    # 古い索引を消してから索引を最後に書くので、途中で止まった場合は保存されていないことになる。
+    if os.path.isfile(f'{base_path}.json'):
+        os.remove(f'{base_path}.json')
+    os.replace(f'{base_path}.bin.tmp', f'{base_path}.bin')
+    with open(f'{base_path}.json.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(f'{base_path}.json.tmp', f'{base_path}.json')
+
+    return len(cutouts)
+
+def build_store(video_dir : str, store_dir : str, v_min : int, workers : int = 0):
+    """新しいか変更された動画ファイルから物体を切り抜いて保存する。
+
+    Args:
+        video_dir : 動画ファイルのフォルダのパス
+        store_dir : 切り抜いた物体の保存先のフォルダのパス
+        v_min : 明度の閾値
+        workers : ワーカー プロセスの数
+    """
+    manifest = VideoManifest(video_dir)
+    classes = manifest.scan()
+    manifest.save()
+
+    store = CutoutStore(store_dir, v_min)
+
+    # 保存されていないか、変更された動画ファイルのリスト
+    videos = [ (video_path, info) for _, _, class_videos in classes for video_path, info in class_videos if not store.is_valid(video_path, info) ]
+
+    if workers == 0:
+        for video_path, info in tqdm(videos):
+            build_video(store, video_path, info)
+    else:
+        with ProcessPoolExecutor(workers) as executor:
+            futures = [ executor.submit(build_video, store, video_path, info) for video_path, info in videos ]
+            for future in tqdm(futures):
+                future.result()
+
+def parse():
+    """コマンドライン引数を解析する。
+
+    Returns: 引数のリスト
+    """
+    parser = argparse.ArgumentParser(description='動画ファイルから物体を切り抜いて保存する。')
+    parser.add_argument('-i','--input', type=str, help='動画ファイルのフォルダのパス')
+    parser.add_argument('-o','--output', type=str, help='切り抜いた物体の保存先のフォルダのパス')
+    parser.add_argument('-v', '--v_min', type=int, help='明度の閾値。デフォルトは250。', default=250)
+    parser.add_argument('-w', '--workers', type=int, help='ワーカー プロセスの数。デフォルトは0。', default=0)
+
+    args = parser.parse_args(sys.argv[1:])
+
+    return args.input.replace('\\', '/'), args.output.replace('\\', '/'), args.v_min, args.workers
+
+if __name__ == '__main__':
+    video_dir, store_dir, v_min, workers = parse()
+
+    build_store(video_dir, store_dir, v_min, workers)
@@ -0,0 +1,350 @@
+import os
+import glob
+import json
+import queue
+import threading
+from collections import OrderedDict
+import cv2
+from main import make_image_classes, generate_samples, open_cutout_store, set_compose_args, compose_task
+from bgbank import BackgroundBank
+from cutout import CutoutStore
+from recipe import RECIPE_VERSION
+
+def make_annotations(class_idx : int, box_infos : list) -> list:
+    """バウンディングボックス情報からアノテーションのリストを作る。
+
+    各アノテーションは train.json の "annotations" の要素から id と image_id を除いたもの。
+
+    Args:
+        class_idx : クラスのインデックス
+        box_infos : バウンディングボックス情報
+
+    Returns: アノテーションのリスト
+    """
+    return [ {
+        "category_id" : class_idx,
+        "bbox" : bounding_box,
+        "segmentation" : corners2,
+        "area" : bounding_box[2] * bounding_box[3]
+    } for box, corners2, bounding_box in box_infos ]
+
+def prefetch(iterator, size : int):
+    """別のスレッドでイテレータを先に進めて、最大size個の結果をキューに溜めておく。
+
+    イテレータで起きた例外は、呼び出し側のスレッドで起こし直す。
+    途中でループを抜けた場合は、スレッドを止めてイテレータを閉じる。
+
+    Args:
+        iterator : 先に進めるイテレータ
+        size : キューに溜める結果の最大数
+
+    Returns: イテレータと同じ結果を返すジェネレータ
+    """
+    items = queue.Queue(size)
+    stop = threading.Event()
+
+    # イテレータの終わりを表す値
+    end = object()
+
+    def put(item) -> bool:
+        # キューに空きができるか、止められるまで待つ。
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def run():
+        try:
+            for item in iterator:
+                if not put((item, None)):
+                    break
+            else:
+                put((end, None))
+
+        except BaseException as e:
+            put((end, e))
+
+        finally:
+            # ジェネレータを作ったスレッドで閉じる。
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+
+            if item is end:
+                break
+
+            yield item
+
+    finally:
+        stop.set()
+        thread.join()
+
+class CompositeDataset:
+    """動画ファイルと背景画像から、合成画像をその場で作るデータセット
+
+    画像ファイルとtrain.jsonは書かずに、(合成画像, アノテーションのリスト) を1個ずつ返す。
+    合成画像はBGRのnumpy配列で、JPEGの圧縮と展開はしない。
+    エポックごとに set_epoch を呼ぶと、エポックごとに違う合成画像を作る。
+    """
+    def __init__(self, video_dir : str, bg_img_dir : str, data_size : int = 1000, img_size : int = 720, v_min : int = 250, workers : int = 0, seed : int = None, bg_cache : int = 256, color_aug : str = 'object', cutouts : str = None, objects : int = 5, prefetch : int = 0):
+        """
+        Args:
+            video_dir : 動画ファイルのフォルダのパス
+            bg_img_dir : 背景画像ファイルのフォルダのパス
+            data_size : 1エポックでの1クラスあたりの合成画像の数
+            img_size : 画像サイズ
+            v_min : 明度の閾値
+            workers : 合成処理のワーカー プロセスの数
+            seed : 乱数のシード。指定しなければエポックごとに変わる。
+            bg_cache : メモリに置く背景画像の最大枚数
+            color_aug : 色のデータ拡張の方法 ('object' または 'frame')
+            cutouts : cutout.pyで切り抜いた物体の保存先のフォルダのパス
+            objects : 1枚の画像に貼り付ける物体の数
+            prefetch : 別のスレッドで先に作っておく合成画像の数。0なら呼び出し側のスレッドで作る。
+        """
+        self.dataSize = data_size
+        """1エポックでの1クラスあたりの合成画像の数"""
+
+        self.imgSize = img_size
+        """画像サイズ"""
+
+        self.vMin = v_min
+        """明度の閾値"""
+
+        self.workers = workers
+        """合成処理のワーカー プロセスの数"""
+
+        self.seed = seed
+        """乱数のシード"""
+
+        self.colorAug = color_aug
+        """色のデータ拡張の方法"""
+
+        self.objects = objects
+        """1枚の画像に貼り付ける物体の数"""
+
+        self.prefetch = prefetch
+        """別のスレッドで先に作っておく合成画像の数"""
+
+        self.epoch = 0
+        """エポックの番号"""
+
+        self.imageClasses = make_image_classes(video_dir)
+        """画像のクラスのリスト"""
+
+        self.bgImgPaths = [ x for x in glob.glob(f'{bg_img_dir}/*') if os.path.splitext(x)[1] in [ '.jpg', '.png' ] ]
+        """背景画像ファイルのパスのリスト"""
+
+        self.bank = BackgroundBank(bg_img_dir, self.bgImgPaths, img_size, ram_size=bg_cache)
+        """リサイズ済みの背景画像のバンク"""
+
+        self.store = open_cutout_store(cutouts, v_min, self.imageClasses) if cutouts is not None else None
+        """切り抜いた物体の保存先"""
+
+    @property
+    def categories(self) -> list:
+        """クラスの名前のリスト。アノテーションの category_id はこのリストのインデックス。"""
+        return [ x.name for x in self.imageClasses ]
+
+    def __len__(self):
+        # 使えるフレームが足りないクラスでは、これより少なくなる。
+        return len(self.imageClasses) * self.dataSize
+
+    def set_epoch(self, epoch : int):
+        """エポックの番号をセットする。
+
+        seedを指定した場合、同じエポックの番号なら同じ合成画像を作る。
+        エポック0の合成画像は、同じseedでmain.pyが作る学習データと同じになる。
+
+        Args:
+            epoch : エポックの番号
+        """
+        self.epoch = epoch
+
+    def epoch_seed(self):
+        """現在のエポックの乱数のシードを返す。
+        """
+        if self.seed is None or self.epoch == 0:
+            return self.seed
+
+        return [ self.seed, self.epoch ]
+
+    def samples(self):
+        """合成画像とアノテーションのリストを1個作るごとにyieldする。
+        """
+        samples = generate_samples(self.imageClasses, self.bgImgPaths, self.dataSize, self.imgSize, self.vMin, self.workers, self.epoch_seed(), self.bank, self.colorAug, self.store, self.objects)
+        for class_idx, video_idx, pos, compo_img, box_infos, recipe in samples:
+            yield compo_img, make_annotations(class_idx, box_infos)
+
+    def __iter__(self):
+        if self.prefetch == 0:
+            return self.samples()
+
+        return prefetch(self.samples(), self.prefetch)
+
+class RecipeDataset:
+    """main.py --virtual で書いたレシピから、合成画像を作り直すデータセット
+
+    同じレシピからは、main.pyで画像を書いた場合と同じ合成画像とアノテーションを作る。
+    最近使ったフレーム(または保存された物体)と背景画像はメモリに置くので、エポックを繰り返しても動画ファイルを読み直さない。
+    """
+    def __init__(self, recipe_dir : str, video_dir : str = None, bg_img_dir : str = None, cutouts : str = None, frame_cache : int = 64, bg_cache : int = 256, seek_distance : int = 32):
+        """
+        Args:
+            recipe_dir : recipes.json のフォルダのパス
+            video_dir : 動画ファイルのフォルダのパス。指定しなければレシピを書いたときのパス。
+            bg_img_dir : 背景画像ファイルのフォルダのパス。指定しなければレシピを書いたときのパス。
+            cutouts : cutout.pyで切り抜いた物体の保存先のフォルダのパス。指定しなければレシピを書いたときのパス。
+            frame_cache : メモリに置くフレームの最大数
+            bg_cache : メモリに置く背景画像の最大枚数
+            seek_distance : この数より先のフレームは、読み飛ばさずにシークする。
+        """
+        with open(f'{recipe_dir}/recipes.json') as f:
+            obj = json.load(f)
+
+        if obj.get("version") != RECIPE_VERSION:
+            raise ValueError(f'レシピ ファイルの形式が違います。{recipe_dir}/recipes.json')
+
+        config = obj["config"]
+
+        self.categories = obj["categories"]
+        """カテゴリーのリスト"""
+
+        self.recipes = obj["recipes"]
+        """レシピのリスト"""
+
+        self.videoDir = video_dir if video_dir is not None else config["video_dir"]
+        """動画ファイルのフォルダのパス"""
+
+        self.bgImgDir = bg_img_dir if bg_img_dir is not None else config["bg_img_dir"]
+        """背景画像ファイルのフォルダのパス"""
+
+        # 物体を探す方法がないレシピは、デフォルトの方法で書いたもの
+        # フレームを順に読まないので、前のフレームの物体の位置を使う追跡はしない。
+        self.composeArgs = { "img_size" : config["img_size"], "v_min" : config["v_min"], "color_aug" : config["color_aug"], "objects" : config["objects"],
+            "segment" : config.get("segment", 'contours'), "downscale" : config.get("downscale", 1), "track" : False }
+        """make_img_tagに渡す引数"""
+
+        bg_img_paths = [ x for x in glob.glob(f'{self.bgImgDir}/*') if os.path.splitext(x)[1] in [ '.jpg', '.png' ] ]
+
+        self.bank = BackgroundBank(self.bgImgDir, bg_img_paths, config["img_size"], ram_size=bg_cache)
+        """リサイズ済みの背景画像のバンク"""
+
+        store_dir = cutouts if cutouts is not None else config["cutouts"]
+
+        self.store = CutoutStore(store_dir, config["v_min"]) if config["cutouts"] else None
+        """切り抜いた物体の保存先"""
+
+        self.frameCache = frame_cache
+        """メモリに置くフレームの最大数"""
+
+        self.frames = OrderedDict()
+        """最近使ったフレームのキャッシュ"""
+
+        self.seekDistance = seek_distance
+        """この数より先のフレームは、読み飛ばさずにシークする。"""
+
+        self.caps = {}
+        """動画ファイルのパスから、開いた動画と次に読むフレームのインデックスへの辞書"""
+
+    def __len__(self):
+        return len(self.recipes)
+
+    def read_video_frame(self, video_path : str, idx : int):
+        """動画ファイルのフレームを読む。
+
+        Args:
+            video_path : 動画ファイルのパス
+            idx : フレームのインデックス
+
+        Returns: 原画 (読めない場合はNone)
+        """
+        cap, next_idx = self.caps.get(video_path, (None, 0))
+        if cap is None:
+            cap = cv2.VideoCapture(video_path)
+
+        if idx < next_idx or next_idx + self.seekDistance < idx:
+            # 前のフレームか、離れたフレームの場合はシークする。
+            cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
+            next_idx = idx
+
+        # 近いフレームはデコードせずに読み飛ばす。
+        while next_idx < idx and cap.grab():
+            next_idx += 1
+
+        ret, frame = cap.read()
+        self.caps[video_path] = (cap, idx + 1)
+
+        return frame if ret else None
+
+    def read_frame(self, recipe : dict):
+        """レシピのフレーム(または保存された物体)を読む。
+
+        Args:
+            recipe : レシピ
+
+        Returns: 原画(または切り抜いた物体)
+        """
+        key = (recipe["video"], recipe["idx"])
+
+        frame = self.frames.get(key)
+        if frame is not None:
+            # キャッシュにある場合
+
+            self.frames.move_to_end(key)
+            return frame
+
+        video_path = f'{self.videoDir}/{recipe["video"]}'
+        if self.store is not None:
+            # 保存された物体の場合
+
+            pos, frame = self.store.read(video_path, recipe["idx"])
+        else:
+            frame = self.read_video_frame(video_path, recipe["idx"])
+
+        self.frames[key] = frame
+        if self.frameCache < len(self.frames):
+            # 最も長く使っていないフレームを捨てる。
+
+            self.frames.popitem(last=False)
+
+        return frame
+
+    def __getitem__(self, idx : int):
+        """レシピから合成画像とアノテーションのリストを作り直す。
+        """
+        recipe = self.recipes[idx]
+
+        frame = self.read_frame(recipe)
+
+        set_compose_args(self.bank, self.composeArgs)
+        compo_img, box_infos, stats = compose_task((recipe["seed"], frame, f'{self.bgImgDir}/{recipe["bg"]}', None))
+
+        return compo_img, make_annotations(recipe["category_id"], box_infos)
+
+    def __iter__(self):
+        for idx in range(len(self.recipes)):
+            yield self[idx]
+
+    def close(self):
+        """開いている動画ファイルと保存された物体のファイルを閉じる。
+        """
+        for cap, next_idx in self.caps.values():
+            cap.release()
+
+        self.caps = {}
+
+        if self.store is not None:
+            self.store.close()
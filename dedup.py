@@ -0,0 +1,72 @@
+import numpy as np
+import cv2
+
+popcount = np.array([ bin(i).count('1') for i in range(256) ], dtype=np.uint8)
+"""バイトの値から1のビットの数への表"""
+
+def frame_hash(img : np.ndarray) -> int:
+    """画像の差分ハッシュ(dHash)を返す。
+
+    画像を横9×縦8に縮小して、横に隣り合う画素の明るさの大小を64ビットにする。
+    ほとんど同じ画像のハッシュは、違うビットの数が少なくなる。
+
+    Args:
+        img : BGRの画像
+
+    Returns: 64ビットのハッシュ
+    """
+    small = cv2.cvtColor(cv2.resize(img, (9, 8), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+
+    bits = (small[:, 1:] > small[:, :-1]).reshape(-1)
+
+    return int(np.packbits(bits).view('>u8')[0])
+
+class FrameIndex:
+    """使ったフレームのハッシュを溜めて、ほとんど同じフレームを探す。
+    """
+    def __init__(self, hashes : list = None):
+        """
+        Args:
+            hashes : 溜めておくハッシュのリスト
+        """
+        self.hashes = np.zeros(max(64, len(hashes or [])), dtype=np.uint64)
+        """ハッシュの配列 (先頭のcount個が有効)"""
+
+        self.count = 0
+        """溜めたハッシュの数"""
+
+        for h in hashes or []:
+            self.add(h)
+
+    def add(self, h : int):
+        """ハッシュを溜める。
+
+        Args:
+            h : ハッシュ
+        """
+        if self.count == len(self.hashes):
+            # 配列がいっぱいの場合は2倍にする。
+            self.hashes = np.concatenate([ self.hashes, np.zeros_like(self.hashes) ])
+
+        self.hashes[self.count] = h
+        self.count += 1
+
+    def nearest(self, h : int) -> int:
+        """溜めたハッシュとの違うビットの数の最小値を返す。
+
+        Args:
+            h : ハッシュ
+
+        Returns: 違うビットの数の最小値 (ハッシュを溜めていない場合は65)
+        """
+        if self.count == 0:
+            return 65
+
+        diff = self.hashes[:self.count] ^ np.uint64(h)
+
+        return int(popcount[diff.view(np.uint8)].reshape(-1, 8).sum(axis=1).min())
+
+    def to_list(self) -> list:
+        """溜めたハッシュのリストを返す。
+        """
+        return [ int(x) for x in self.hashes[:self.count] ]
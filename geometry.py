@@ -0,0 +1,147 @@
+import math
+import numpy as np
+import cv2
+
+rad45 = math.radians(45)
+rad90 = math.radians(90)
+
+def rotation_matrices(center : tuple, angles : np.ndarray, scales : np.ndarray) -> np.ndarray:
+    """回転とスケールの変換行列をまとめて作る。cv2.getRotationMatrix2Dと同じ行列になる。
+
+    Args:
+        center : 回転の中心
+        angles : 回転角(度)の配列
+        scales : 拡大率の配列
+
+    Returns: (K, 2, 3)の変換行列の配列
+    """
+    cx, cy = center
+    rad = np.radians(np.asarray(angles, dtype=np.float64))
+    alpha = np.asarray(scales, dtype=np.float64) * np.cos(rad)
+    beta  = np.asarray(scales, dtype=np.float64) * np.sin(rad)
+
+    M = np.empty(rad.shape + (2, 3), dtype=np.float64)
+    M[..., 0, 0] = alpha
+    M[..., 0, 1] = beta
+    M[..., 0, 2] = (1 - alpha) * cx - beta * cy
+    M[..., 1, 0] = -beta
+    M[..., 1, 1] = alpha
+    M[..., 1, 2] = beta * cx + (1 - alpha) * cy
+
+    return M
+
+def transform_points(M : np.ndarray, points : np.ndarray) -> np.ndarray:
+    """複数の変換行列を点の列に作用させる。
+
+    Args:
+        M : (K, 2, 3)の変換行列の配列
+        points : (N, 2)の点の配列
+
+    Returns: (K, N, 2)の変換後の点の配列
+    """
+    points = np.asarray(points, dtype=np.float64)
+
+    return points @ M[:, :, :2].transpose(0, 2, 1) + M[:, np.newaxis, :, 2]
+
+def random_transforms(contour : np.ndarray, img_size : int, k : int) -> np.ndarray:
+    """回転・拡大/縮小・平行移動の変換行列をK個まとめて作る。
+
+    物体の最小外接円が貼り付け先の画像の内部に収まるように、拡大率は画像の短辺の20%から30%、回転角と位置は一様乱数で決める。
+
+    Args:
+        contour : 輪郭
+        img_size : 貼り付け先の画像のサイズ
+        k : 変換行列の数
+
+    Returns: (K, 2, 3)の変換行列の配列
+    """
+    # 最小外接円の中心と半径
+    (cx, cy), radius = cv2.minEnclosingCircle(contour)
+
+    # 物体の直径
+    diameter = 2 * radius
+
+    # 乱数でスケールを決める。
+    scales = np.random.uniform((0.2 * img_size) / diameter, (0.3 * img_size) / diameter, k)
+
+    # スケール変換後の半径
+    radius2 = scales * radius
+
+    # 乱数で移動量を決める。
+    margin = 1
+    dx = radius2 - cx + margin + np.random.random(k) * (img_size - 2 * radius2 - 2 * margin)
+    dy = radius2 - cy + margin + np.random.random(k) * (img_size - 2 * radius2 - 2 * margin)
+
+    # 乱数で回転量を決める。
+    angles = np.random.uniform(-180, 180, k)
+
+    # 回転とスケールに平行移動を加える。
+    M = rotation_matrices((cx, cy), angles, scales)
+    M[:, 0, 2] += dx
+    M[:, 1, 2] += dy
+
+    return M
+
+def nor_thetas(theta : np.ndarray) -> np.ndarray:
+    """角度を90°の倍数だけずらして、-45°より大きく45°以下にする。
+
+    Args:
+        theta : 角度(ラジアン)の配列
+
+    Returns: 正規化した角度の配列
+    """
+    theta = np.asarray(theta, dtype=np.float64)
+
+    return theta - rad90 * np.ceil((theta - rad45) / rad90)
+
+def rotate_corners_batch(corners : np.ndarray):
+    """最初の頂点から2番目の頂点へ向かう辺の角度が±45°以下になるように、頂点の順番をまとめて変える。
+
+    Args:
+        corners : (K, 4, 2)の頂点の配列
+
+    Returns: 頂点の順番を変えた配列, 条件を満たす辺があればTrueの配列
+    """
+    corners = np.asarray(corners, dtype=np.float64)
+
+    # 各頂点から次の頂点へ向かう辺の角度
+    d = np.roll(corners, -1, axis=1) - corners
+    theta = np.arctan2(d[..., 1], d[..., 0])
+
+    ok = np.abs(theta) <= rad45
+
+    # 条件を満たす最初の頂点のインデックス
+    first = np.argmax(ok, axis=1)
+
+    idx = (first[:, np.newaxis] + np.arange(4)) % 4
+    rotated = np.take_along_axis(corners, idx[:, :, np.newaxis], axis=1)
+
+    return rotated, ok.any(axis=1)
+
+def corners2rotatedbbox_batch(corners : np.ndarray) -> np.ndarray:
+    """頂点からバウンディングボックスと回転角をまとめて計算する。
+
+    Args:
+        corners : (K, 4, 2)の頂点の配列
+
+    Returns: (K, 5)の x, y, w, h, theta の配列
+    """
+    corners = np.asarray(corners, dtype=np.float64)
+    center = corners.mean(axis=1, keepdims=True)
+
+    d = corners[:, 1] - corners[:, 0]
+    theta = nor_thetas(np.arctan2(d[:, 1], d[:, 0]))
+
+    cos, sin = np.cos(theta), np.sin(theta)
+    rotation = np.empty((len(theta), 2, 2), dtype=np.float64)
+    rotation[:, 0, 0] = cos
+    rotation[:, 0, 1] = -sin
+    rotation[:, 1, 0] = sin
+    rotation[:, 1, 1] = cos
+
+    out_points = (corners - center) @ rotation + center
+
+    x, y = out_points[:, 0, 0], out_points[:, 0, 1]
+    w, h = (out_points[:, 2] - out_points[:, 0]).T
+
+    return np.stack([x, y, w, h, theta], axis=1)
@@ -7,7 +7,12 @@ import PySimpleGUI as sg
 from util import show_image
 from odtk import ODTK
 from main import parse
-from main import make_img_tag, make_image_classes, make_training_data, get_video_capture
+from main import make_img_tag, make_image_classes, make_training_data, get_video_capture, open_cutout_store
+from bgbank import BackgroundBank
+from quality import QualityFilter, measure
+from prefetch import VideoPrefetcher
+import prefetch
+import profiler
 
 iterator = None
 cap = None
@@ -52,20 +57,30 @@ def init_capture(class_idx, video_Idx):
     Returns:
         VideoCapture: キャプチャー オブジェクト
     """
-    global playing
+    global playing, cap
 
     # 動画ファイルのパス
     video_path = image_classes[class_idx].videoPathes[video_Idx]
 
-    # 動画のキャプチャー オブジェクト
-    cap = get_video_capture(video_path)    
+    if 0 < args.prefetch:
+        # バックグラウンドのスレッドでデコードして先読みする場合
 
-    if not cap.isOpened():
-        print("動画再生エラー")
-        sys.exit()
+        if isinstance(cap, VideoPrefetcher):
+            # 前の動画ファイルのデコードを止める。
+            cap.release()
+
+        cap = VideoPrefetcher(video_path, size=args.prefetch)
+
+    else:
+        # 動画のキャプチャー オブジェクト
+        cap = get_video_capture(video_path)    
+
+        if not cap.isOpened():
+            print("動画再生エラー")
+            sys.exit()
 
     # 動画ファイルのフレーム数
-    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    frame_count = image_classes[class_idx].videoInfos[video_Idx]["frame_count"]
 
     # 再生位置のスライダーの値の範囲を更新する。
     window['-img-pos-'].update(range=(0, frame_count - 1))
@@ -105,14 +120,18 @@ def show_videos(class_idx, video_Idx):
                     bg_img = prev_bg_img
 
                 else:
-                    # 背景画像ファイルを読む。
-                    bg_img = cv2.imread(bg_img_paths[bg_img_idx])
+                    # 背景画像のバンクから読む。
+                    bg_img = bank.get(bg_img_paths[bg_img_idx])
                     bg_img_idx = (bg_img_idx + 1) % len(bg_img_paths)
 
                 prev_bg_img = bg_img
 
+                # フレームのシャープさと明るさを表示する。
+                sharpness, brightness = measure(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+                window['-msg-'].update(value=f'シャープさ {sharpness:.0f}  明るさ {brightness:.0f}')
+
                 # 二値画像, マスク, 合成画像, バウンディングボックス情報 
-                bin_img, mask_img, compo_img, box_infos = make_img_tag(frame, bg_img, img_size, v_min)
+                bin_img, mask_img, compo_img, box_infos = make_img_tag(frame, bg_img, img_size, v_min, args.color_aug, args.objects, args.segment, args.downscale, args.track, quality_filter, (class_idx, video_Idx, pos, pos))
                 if mask_img is None:
 
                     black_img = np.zeros(frame.shape, dtype=np.uint8)
@@ -236,10 +255,16 @@ def update_one_frame(event : str):
 
 
 if __name__ == '__main__':
-    video_dir, bg_img_dir, output_dir, data_size, img_size, v_min = parse()
+    video_dir, bg_img_dir, output_dir, data_size, img_size, v_min, args = parse()
 
     print(cv2.getBuildInformation())
 
+    # 動画の表示で作った合成画像の処理時間も記録する。
+    profiler.enabled = args.profile
+
+    # 画質の悪いフレームを棄却するフィルター
+    quality_filter = QualityFilter(args.min_sharpness, args.min_brightness, args.max_brightness)
+
     # 出力先フォルダを作る。
     os.makedirs(output_dir, exist_ok=True)
 
@@ -248,6 +273,9 @@ if __name__ == '__main__':
 
     # 画像のクラスのリスト
     image_classes = make_image_classes(video_dir)
+
+    # リサイズ済みの背景画像のバンク
+    bank = BackgroundBank(bg_img_dir, bg_img_paths, img_size, ram_size=args.bg_cache)
     
     # ツリー表示のデータを作る。
     treedata = get_tree_data()
@@ -275,6 +303,14 @@ if __name__ == '__main__':
                     ],  expand_x=True, pad=((0,0),(10,10)) )
                 ]
                 ,
+                [  
+                    sg.Frame('画質', [
+                        spin('シャープさの下限', '-min-sharpness-', int(quality_filter.minSharpness), 0, 2000),
+                        spin('明るさの下限', '-min-brightness-', quality_filter.minBrightness, 0, 255),
+                        spin('明るさの上限', '-max-brightness-', quality_filter.maxBrightness, 0, 255)
+                    ],  expand_x=True, pad=((0,0),(10,10)) )
+                ]
+                ,
                 [  
                     sg.Frame('学習データ', [
                         [
@@ -384,6 +420,16 @@ if __name__ == '__main__':
             # 現在のフレームの表示を更新する。
             update_one_frame(event)
 
+        elif event in [ '-min-sharpness-', '-min-brightness-', '-max-brightness-' ]:
+            # 画質の閾値のスピン
+
+            quality_filter.minSharpness  = int(values['-min-sharpness-'])
+            quality_filter.minBrightness = int(values['-min-brightness-'])
+            quality_filter.maxBrightness = int(values['-max-brightness-'])
+
+            # 現在のフレームの表示を更新する。
+            update_one_frame(event)
+
         elif event == '-show-rect-':
             # 矩形の表示/非表示のチェックボックス
 
@@ -420,7 +466,10 @@ if __name__ == '__main__':
             # 全クラスの学習データ数
             total_data_size = data_size * len(image_classes)
 
-            for idx, ret in enumerate( make_training_data(output_dir, image_classes, bg_img_paths, data_size, img_size, v_min) ):
+            # 切り抜いた物体の保存先
+            store = open_cutout_store(args.cutouts, v_min, image_classes) if args.cutouts is not None else None
+
+            for idx, ret in enumerate( make_training_data(output_dir, image_classes, bg_img_paths, data_size, img_size, v_min, workers=args.workers, seed=args.seed, bank=bank, color_aug=args.color_aug, store=store, objects=args.objects, writers=args.writers, shard_size=args.shard_size * 1024 * 1024, checkpoint_interval=args.checkpoint, resume=args.resume, extend=args.extend, virtual=args.virtual, profile=args.profile, segment=args.segment, downscale=args.downscale, track=args.track, dedup=args.dedup, quality_filter=quality_filter, prefetch=args.prefetch, decode_threads=args.decode_threads, stage_threads=args.stage_threads, shared_memory=args.shared_memory) ):
                 if not sg.one_line_progress_meter('学習データ作成', idx+1, total_data_size, orientation='h'):
                     # Cancelボタンがクリックされた場合
 
@@ -436,3 +485,12 @@ if __name__ == '__main__':
             print('You entered ', event)
 
     window.close()
+
+    if cap is not None and 0 < args.prefetch:
+        # デコードを止めて、動画の表示で先読みしたフレームの統計を表示する。
+        cap.release()
+        print(prefetch.format_stats(prefetch.take_stats()))
+
+    if args.profile:
+        # 動画の表示で作った合成画像の処理時間と棄却の回数
+        print(profiler.format_report(profiler.take()))
@@ -4,17 +4,63 @@ import math
 import random
 import argparse
 import glob
+import json
+import time
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future, wait
 import cv2
 from PIL import Image, ImageFilter
 import numpy as np
 from tqdm import tqdm
 import albumentations as A
-from odtk import _corners2rotatedbbox, ODTK
-from util import getContour
+from odtk import ODTK
+from geometry import corners2rotatedbbox_batch
+from util import resize_bg_img
+from manifest import VideoManifest
+from cutout import Cutout, CutoutStore, ObjectTracker, make_cutout
+from bgbank import BackgroundBank
+from placement import PlacementEngine
+from checkpoint import Checkpoint
+from recipe import RecipeWriter
+from dedup import FrameIndex, frame_hash
+from quality import QualityFilter
+from prefetch import prefetch_videos
+import placement
+import profiler
+import quality
+import prefetch as prefetch_module
+import pipeline
+from pipeline import Pipeline
+from shmring import FrameRing, FrameDesc
 
 cap = None
 """動画ファイルのキャプチャ オブジェクト"""
 
+bg_bank = None
+"""リサイズ済みの背景画像のバンク"""
+
+compose_args = {}
+"""make_img_tagに渡す、実行中は変わらない引数"""
+
+tracker = None
+"""前のフレームの物体の周りだけで物体を探すオブジェクト"""
+
+frame_rings = None
+"""ワーカー プロセスとの間で原画と合成画像を受け渡す、共有メモリの枠のリング (Noneなら画像をpickleで送る)"""
+
+segment_local = threading.local()
+"""パイプラインのsegmentのステージの、スレッドごとの物体を探すオブジェクト"""
+
+erode_kernel = np.ones((3, 3), dtype=np.uint8)
+"""マスク画像を収縮(erosion)するカーネル"""
+
+feather_kernel = np.array([5 / 12, 1, 1, 1, 1, 1, 5 / 12], dtype=np.float32) / np.float32(5 + 10 / 12)
+"""マスク画像の輪郭の周辺部分をぼかすボックス カーネル
+
+PILの GaussianBlur(3) と同じく、3回かけると標準偏差3のガウシアンに近くなる幅のボックス カーネル。
+"""
+
 transform = A.Compose([
     A.CLAHE(),
     # A.Blur(),
@@ -35,88 +81,386 @@ class ImageClass:
         self.videoPathes = []
         """動画ファイルのパスのリスト"""
 
+        self.videoInfos = []
+        """動画ファイルの情報(フレーム数・FPS・解像度など)のリスト"""
+
+    def get_frame_counts(self) -> list:
+        """クラスに属する動画ファイルごとのフレーム数を返す。
+
+        Returns: フレーム数のリスト
+        """
+        return [ info["frame_count"] for info in self.videoInfos ]
+
     def get_total_frame_count(self) -> int:
         """クラスに属する動画ファイルの全フレーム数を返す。
 
         Returns: 全フレーム数
         """
-        cnt = 0
+        return sum(self.get_frame_counts())
 
-        # すべての動画ファイルに対して
-        for video_path in self.videoPathes:
 
-            # 動画ファイルのキャプチャ オブジェクト
-            cap = get_video_capture(video_path)    
+class FrameSampler:
+    """クラスの動画ファイルから使うフレームを選んで読む。
 
-            # 動画ファイルのフレーム数
-            n = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-            cnt += n
+    フレームの位置は動画ファイルごとに前もって選び、使わないフレームはデコードせずに grab() で読み飛ばす。
+    使えなかったフレームは次のラウンドでは選ばない。
+    切り抜いた物体の保存先がある場合は、動画ファイルは読まずに保存された物体から選ぶ。
+    dedupを指定した場合は、前に読んだフレームとほとんど同じフレームは読み飛ばして、使えなかったフレームとする。
+    prefetchを指定した場合は、動画ファイルをバックグラウンドのスレッドでデコードして先読みする。読むフレームは先読みしない場合と同じ。
+    """
+    def __init__(self, image_class : ImageClass, rng : np.random.Generator, store : CutoutStore = None, dedup : int = 0, prefetch : int = 0, decode_threads : int = 1):
+        self.imageClass = image_class
+        """画像のクラス"""
 
-            cap.release()
+        self.rng = rng
+        """フレームを選ぶ乱数生成器"""
 
-        return cnt
+        self.store = store
+        """切り抜いた物体の保存先"""
 
+        frame_counts = image_class.get_frame_counts() if store is None else store.get_counts(image_class)
 
+        self.tried = [ np.zeros(n, dtype=bool) for n in frame_counts ]
+        """動画ファイルごとの、選んだことがあるフレームのフラグ"""
 
-def augment_shape(contour : np.ndarray, img_size : int) -> np.ndarray:
-    """回転・拡大/縮小・平行移動の変換行列を返す。
+        self.rejected = [ np.zeros(n, dtype=bool) for n in frame_counts ]
+        """動画ファイルごとの、使えなかったフレームのフラグ"""
 
-    Args:
-        contour : 輪郭
-        img_size : 貼り付け先の画像のサイズ
+        self.positions = None
+        """現在のラウンドで選んだ、動画ファイルごとのフレームのインデックスの配列のリスト"""
 
-    Returns:
-        変換行列
-    """
+        self.dedup = dedup
+        """前に読んだフレームとハッシュの違うビットの数がこの数より少なければ、重複とみなす。0なら調べない。"""
+
+        self.index = FrameIndex()
+        """重複でなかったフレームのハッシュ"""
+
+        self.seen = {}
+        """調べたフレームの (動画ファイルのインデックス, フレームのインデックス) から、重複ならTrueへの辞書"""
+
+        self.reusing = False
+        """現在のラウンドで、使えたフレームを再利用する場合はTrue"""
+
+        self.prefetch = prefetch
+        """動画ファイルごとに先読みするフレームの最大数。0なら先読みしない。"""
+
+        self.decodeThreads = decode_threads
+        """先読みする場合に、同時にデコードする動画ファイルの数"""
+
+    def reject(self, video_idx : int, idx : int):
+        """フレームが使えなかったことを記録する。
+
+        Args:
+            video_idx : 動画ファイルのインデックス
+            idx : 動画ファイルの中のフレーム(または保存された物体)のインデックス
+        """
+        self.rejected[video_idx][idx] = True
+
+    def select_positions(self, data_size : int) -> list:
+        """動画ファイルの間で層化して、フレームのインデックスを選ぶ。
+
+        まだ選んでいないフレームがあればその中から選び、なければ使えたフレームを再利用する。
+
+        Args:
+            data_size : 選ぶフレームの数
+
+        Returns: 動画ファイルごとのフレームのインデックスの配列のリスト
+        """
+        # 動画ファイルごとの候補のフレームのインデックス
+        candidates = [ np.flatnonzero(~t & ~r) for t, r in zip(self.tried, self.rejected) ]
+        self.reusing = sum(len(c) for c in candidates) == 0
+        if self.reusing:
+            # まだ選んでいないフレームがない場合
+
+            candidates = [ np.flatnonzero(~r) for r in self.rejected ]
+
+        total = sum(len(c) for c in candidates)
+        if total == 0:
+            return None
+
+        if total <= data_size:
+            # 候補が足りない場合は全部使う。
+            return candidates
+
+        # 候補の数に比例して動画ファイルごとのフレーム数を割り当てる。(最大剰余法)
+        quota = np.array([ len(c) for c in candidates ]) * data_size / total
+        counts = np.floor(quota).astype(int)
+        remainder_order = np.argsort(-(quota - counts), kind='stable')
+        counts[ remainder_order[:data_size - counts.sum()] ] += 1
+
+        positions = []
+        for cand, n in zip(candidates, counts):
+            # 候補をn個の区間に分けて、各区間から1個ずつ選ぶ。
+            idx = np.unique(np.floor((np.arange(n) + self.rng.random(n)) * len(cand) / n).astype(int))
+            if len(idx) < n:
+                # 区間の幅が2より小さいと、隣り合う区間で同じフレームを選ぶことがある。足りない分は選ばなかったフレームから選ぶ。
+                rest = np.setdiff1d(np.arange(len(cand)), idx)
+                idx = np.sort(np.concatenate([ idx, self.rng.choice(rest, n - len(idx), replace=False) ]))
+
+            positions.append(cand[idx])
+
+        return positions
+
+    def next_round(self, data_size : int):
+        """次のラウンドで使うフレームを読むジェネレータを返す。
+
+        Args:
+            data_size : 必要なフレームの数
+
+        Returns: フレームを読むジェネレータ (使えるフレームがない場合はNone)
+        """
+        positions = self.select_positions(data_size)
+        if positions is None:
+            return None
+
+        for tried, idx in zip(self.tried, positions):
+            tried[idx] = True
+
+        self.positions = positions
+
+        return self.read_frames(positions)
+
+    def get_state(self) -> dict:
+        """途中から再開するための状態を返す。
+
+        Returns: 乱数生成器の状態と、選んだフレームと使えなかったフレームと現在のラウンドのフレームのインデックスと、読んだフレームのハッシュ
+        """
+        return {
+            "rng" : self.rng.bit_generator.state,
+            "tried" : [ np.flatnonzero(x).tolist() for x in self.tried ],
+            "rejected" : [ np.flatnonzero(x).tolist() for x in self.rejected ],
+            "positions" : [ x.tolist() for x in self.positions ],
+            "reusing" : self.reusing,
+            "hashes" : self.index.to_list(),
+            "seen" : [ [ video_idx, idx, dup ] for (video_idx, idx), dup in self.seen.items() ]
+        }
+
+    def set_state(self, state : dict, video_idx : int, idx : int):
+        """保存した状態に戻して、現在のラウンドの残りのフレームを読むジェネレータを返す。
+
+        Args:
+            state : get_stateで得た状態
+            video_idx : 最後に使ったフレームの動画ファイルのインデックス
+            idx : 最後に使ったフレームのインデックス
+
+        Returns: 最後に使ったフレームより後のフレームを読むジェネレータ
+        """
+        self.rng.bit_generator.state = state["rng"]
+
+        for flags, indexes in zip(self.tried, state["tried"]):
+            flags[indexes] = True
+
+        for flags, indexes in zip(self.rejected, state["rejected"]):
+            flags[indexes] = True
+
+        self.positions = [ np.array(x, dtype=np.int64) for x in state["positions"] ]
+
+        self.reusing = state["reusing"]
+        self.index = FrameIndex(state["hashes"])
+        self.seen = { (video_idx, idx) : dup for video_idx, idx, dup in state["seen"] }
+
+        # 動画ファイルの順、フレームのインデックスの順に読むので、最後に使ったフレームより後のものが残り。
+        remaining = [ x if video_idx < i else x[idx < x] if i == video_idx else x[:0] for i, x in enumerate(self.positions) ]
+
+        return self.read_frames(remaining)
+
+    def is_duplicate(self, video_idx : int, idx : int, img : np.ndarray) -> bool:
+        """前に読んだフレームとほとんど同じならTrueを返す。同じでなければハッシュを溜める。
+
+        Args:
+            video_idx : 動画ファイルのインデックス
+            idx : 動画ファイルの中のフレーム(または保存された物体)のインデックス
+            img : 原画(または切り抜いた物体の画像)
+
+        Returns: 重複ならTrue
+        """
+        if self.dedup == 0 or self.reusing:
+            # 調べない場合か、使えたフレームを再利用する場合
+            return False
+
+        key = (video_idx, int(idx))
+        if key in self.seen:
+            # 先読みしたフレームをチェックポイントから読み直した場合は、前と同じにする。
+            return self.seen[key]
+
+        h = frame_hash(img)
+        dup = self.index.nearest(h) < self.dedup
+        self.seen[key] = dup
+
+        if dup:
+            # 重複の場合は、次のラウンドでは選ばない。
+
+            self.reject(video_idx, idx)
+            profiler.count('フレーム: 重複')
+        else:
+            self.index.add(h)
+
+        return dup
+
+    def get_duplicates(self) -> int:
+        """重複とみなして読み飛ばしたフレームの数を返す。
+        """
+        return sum(self.seen.values())
+
+    def read_frames(self, positions : list):
+        """選んだフレームを順に読む。
+
+        Args:
+            positions : 動画ファイルごとのフレームのインデックスの配列のリスト
+
+        Returns: 動画ファイルのインデックス, フレームのインデックス, 動画の位置, 原画(または切り抜いた物体)
+        """
+        if self.store is None and 0 < self.prefetch:
+            # 動画ファイルを先読みする場合
 
-    # 最小外接円の中心と半径
-    (cx, cy), radius = cv2.minEnclosingCircle(contour)    
+            yield from self.read_prefetched(positions)
+            return
 
-    # 物体の直径
-    diameter = 2 * radius
+        for video_idx, video_positions in enumerate(positions):
+            if len(video_positions) == 0:
+                continue
 
-    # 最大スケール = 画像の短辺の30% ÷ 物体の直径
-    max_scale = (0.3 * img_size) / diameter
+            if self.store is not None:
+                # 保存された物体を読む場合
 
-    # 最小スケール = 画像の短辺の20% ÷ 物体の直径
-    min_scale = (0.2 * img_size) / diameter
+                for idx in video_positions:
+                    with profiler.Stage('read'):
+                        pos, cutout = self.store.read(self.imageClass.videoPathes[video_idx], idx)
 
-    # 乱数でスケールを決める。
-    scale = random.uniform(min_scale, max_scale)
+                    if self.is_duplicate(video_idx, idx, cutout.image):
+                        continue
 
-    # スケール変換後の半径   
-    radius2 = scale * radius
+                    yield video_idx, int(idx), pos, cutout
 
-    # 乱数で移動量を決める。
-    margin = 1
-    dx = random.uniform(radius2 - cx + margin, img_size - radius2 - cx - margin)
-    dy = random.uniform(radius2 - cy + margin, img_size - radius2 - cy - margin)
+                continue
 
-    assert radius2 <= cx + dx and cx + dx <= img_size - radius2
-    assert radius2 <= cy + dy and cy + dy <= img_size - radius2
+            cap = init_cap(self.imageClass, video_idx)
 
-    # 乱数で回転量を決める。
-    angle = random.uniform(-180, 180)
+            # 次に読むフレームのインデックス
+            next_idx = 0
 
-    # 回転とスケール
-    m1 = cv2.getRotationMatrix2D((cx,cy), angle, scale)
-    m1 = np.concatenate((m1, np.array([[0.0, 0.0, 1.0]])))
+            for frame_idx in video_positions:
 
-    # 平行移動
-    m2 = np.array([
-        [ 1, 0, dx], 
-        [ 0, 1, dy], 
-        [ 0, 0,  1]
-    ], dtype=np.float32)
+                with profiler.Stage('read'):
+                    if frame_idx == next_idx - 1:
+                        # 同じフレームが続く場合は、デコードした原画をもう一度使う。
+                        ret = True
 
-    m3 = np.dot(m2, m1)
-    M = m3[:2,:]
+                    else:
+                        # 使わないフレームはデコードせずに読み飛ばす。
+                        while next_idx < frame_idx and cap.grab():
+                            next_idx += 1
 
-    return M
+                        if next_idx == frame_idx and cap.grab():
+                            ret, frame = cap.retrieve()
+                            next_idx += 1
+                        else:
+                            ret = False
 
-def blend_image(bg_img : np.ndarray, aug_img2 : np.ndarray, mask_img2 : np.ndarray) -> np.ndarray:
+                if not ret:
+                    # 動画ファイルのフレーム数が実際より多い場合
+
+                    profiler.count('フレーム: 動画ファイルの終わりより後')
+
+                    self.rejected[video_idx][frame_idx:] = True
+                    break
+
+                if self.is_duplicate(video_idx, frame_idx, frame):
+                    continue
+
+                yield video_idx, int(frame_idx), int(frame_idx) + 1, frame
+
+    def read_prefetched(self, positions : list):
+        """選んだフレームを、バックグラウンドのスレッドでデコードしながら順に読む。
+
+        Args:
+            positions : 動画ファイルごとのフレームのインデックスの配列のリスト
+
+        Returns: 動画ファイルのインデックス, フレームのインデックス, 動画の位置, 原画
+        """
+        # 読むフレームがある動画ファイルのインデックス
+        video_idxes = [ i for i, x in enumerate(positions) if 0 < len(x) ]
+
+        jobs = [ (self.imageClass.videoPathes[i], positions[i]) for i in video_idxes ]
+
+        for job_idx, frame_idx, frame in prefetch_videos(jobs, self.decodeThreads, self.prefetch):
+            video_idx = video_idxes[job_idx]
+
+            if frame is None:
+                # 動画ファイルのフレーム数が実際より多い場合
+
+                profiler.count('フレーム: 動画ファイルの終わりより後')
+
+                self.rejected[video_idx][frame_idx:] = True
+                continue
+
+            if self.is_duplicate(video_idx, frame_idx, frame):
+                continue
+
+            yield video_idx, frame_idx, frame_idx + 1, frame
+
+
+
+def feather_alpha(mask_img : np.ndarray) -> np.ndarray:
+    """マスク画像を収縮してから輪郭の周辺部分をぼかしたアルファ値を返す。
+
+    Args:
+        mask_img : 0と255のマスク画像
+
+    Returns: 0から1のアルファ値 (float32)
+    """
+    # マスク画像を 収縮(erosion)する。
+    mask_img = cv2.erode(mask_img, erode_kernel, borderType=cv2.BORDER_REPLICATE)
+
+    alpha = mask_img.astype(np.float32) * np.float32(1 / 255)
+
+    # 輪郭の周辺部分にガウシアンでぼかしを入れる。PILと同じく、ボックス ブラーを横と縦に3回ずつかける。
+    one = np.ones(1, dtype=np.float32)
+    for _ in range(3):
+        alpha = cv2.sepFilter2D(alpha, cv2.CV_32F, feather_kernel, one, borderType=cv2.BORDER_REPLICATE)
+    for _ in range(3):
+        alpha = cv2.sepFilter2D(alpha, cv2.CV_32F, one, feather_kernel, borderType=cv2.BORDER_REPLICATE)
+
+    return alpha
+
+def blend_image(bg_img : np.ndarray, aug_img2 : np.ndarray, mask_img2 : np.ndarray, pos : tuple = (0, 0)) -> np.ndarray:
     """マスク画像を使って、画像を背景画像に貼り付ける。
 
+    背景画像はコピーせずに、マスク画像の外接矩形の内部だけを書き換える。
+
+    Args:
+        bg_img : 背景画像 (この画像が書き換えられる)
+        aug_img2 : 入力画像
+        mask_img2 : マスク画像
+        pos : 入力画像とマスク画像の左上の、背景画像での位置
+
+    Returns:
+        貼り付け後の画像 (bg_imgと同じ配列)
+    """
+    # 外接矩形
+    bx, by, bw, bh = cv2.boundingRect(mask_img2)
+    if bw == 0 or bh == 0:
+        return bg_img
+
+    # 背景画像での外接矩形の位置
+    x, y = pos[0] + bx, pos[1] + by
+
+    # 外接矩形の内部のみを抜き出す。
+    aug_roi  = aug_img2[  by:(by+bh), bx:(bx+bw), : ]
+    mask_roi = mask_img2[ by:(by+bh), bx:(bx+bw) ]
+    bg_roi   = bg_img[    y:(y+bh), x:(x+bw), : ]
+
+    # 輪郭の周辺部分をぼかしたアルファ値
+    alpha = feather_alpha(mask_roi)
+
+    # アルファ値を使って、データ拡張後の画像を背景画像の外接矩形の内部に合成する。
+    bg_roi[:] = cv2.blendLinear(aug_roi, bg_roi, alpha, 1 - alpha)
+
+    return bg_img
+
+def blend_image_pil(bg_img : np.ndarray, aug_img2 : np.ndarray, mask_img2 : np.ndarray) -> np.ndarray:
+    """マスク画像を使って、画像を背景画像に貼り付ける。PILを使う以前の実装で、比較のために残している。
+
     Args:
         bg_img : 背景画像
         aug_img2 : 入力画像
@@ -151,185 +495,215 @@ def blend_image(bg_img : np.ndarray, aug_img2 : np.ndarray, mask_img2 : np.ndarr
 
     return compo_img
 
-def rotate_corners(box : list):
-    """最初の頂点から2番目の頂点へ向かう辺の角度が±45°以下になるように、頂点の順番を変える。
+def pyramid_level(M : np.ndarray) -> int:
+    """変換行列の縮小率に合わせて、縮小済みの原画のレベルを返す。
+
+    レベルLの原画は元の原画を 1/2^L に縮小したもので、変換後の縮小率が1/2より大きくなるレベルを選ぶ。
 
     Args:
-        box: 頂点のXY座標のリスト
+        M : 変換行列
 
-    Returns:
-        _type_: _description_
+    Returns: 原画のレベル
     """
-    
-    rad45 = math.radians(45)
-
-    for i1 in range(4):
-        # 次の頂点のインデックス
-        i2 = (i1 + 1) % 4
+    # 変換行列の拡大率
+    scale = math.sqrt(abs(np.linalg.det(M[:, :2])))
 
-        # 次の頂点までのXとYの変位
-        dx = box[i2][0] - box[i1][0]
-        dy = box[i2][1] - box[i1][1]
+    if 0.5 <= scale:
+        return 0
 
-        theta = math.atan2(dy, dx)
-        if abs(theta) <= rad45:
-            # 次の頂点へ向かう辺の角度が±45°以下の場合
+    return int(math.floor(math.log2(1 / scale)))
 
-            # i1が最初の頂点になるようにする。
-            return box[i1:] + box[:i1]
+def warp_object(src_roi : np.ndarray, mask_pyramid : list, src_pos : tuple, M : np.ndarray, img_size : int):
+    """物体の外接矩形の内部だけに変換行列を作用させる。
 
-    return None
-
-def resize_bg_img(bg_img : np.ndarray, img_size : int) -> np.ndarray:
-    """背景画像を指定したサイズの正方形にする。
+    出力は変換後の外接矩形の大きさだけで、画像サイズの画像は作らない。
 
     Args:
-        bg_img : 背景画像
-        img_size : 正方形の辺の長さ
+        src_roi : 原画の外接矩形の内部
+        mask_pyramid : マスク画像の外接矩形の内部を順に1/2に縮小したもののリスト (必要なら追加される)
+        src_pos : 外接矩形の原画での位置
+        M : 原画の座標から貼り付け先の画像の座標への変換行列
+        img_size : 貼り付け先の画像のサイズ
 
-    Returns:
-        指定したサイズの正方形の背景画像
+    Returns: 変換後の画像, 変換後のマスク画像, それらの貼り付け先の画像での位置
     """
-    # 背景画像の高さと幅
-    h, w = bg_img.shape[:2]
+    h, w = src_roi.shape[:2]
+    ox, oy = src_pos
 
-    # 高さと幅の小さい方
-    size = min(h, w)
+    # 外接矩形の頂点を変換して、貼り付け先の画像の中での範囲を得る。
+    corners = np.array([[ox, oy, 1], [ox + w, oy, 1], [ox, oy + h, 1], [ox + w, oy + h, 1]], dtype=np.float64)
+    corners = corners @ M.T
+    x1, y1 = np.floor(corners.min(axis=0)).astype(int)
+    x2, y2 = np.ceil(corners.max(axis=0)).astype(int) + 1
+    x1, y1, x2, y2 = max(0, x1), max(0, y1), min(img_size, x2), min(img_size, y2)
+    if x2 <= x1 or y2 <= y1:
+        return None, None, (0, 0)
 
-    # 正方形の画像の開始位置
-    y = (h - size) // 2
-    x = (w - size) // 2
+    # 大きく縮小する場合は、縮小済みの原画とマスク画像を使う。
+    level = pyramid_level(M)
+    while len(mask_pyramid) <= level:
+        mask_pyramid.append(cv2.pyrDown(mask_pyramid[-1]))
+    for _ in range(level):
+        src_roi = cv2.pyrDown(src_roi)
 
-    # 背景画像を正方形にする。
-    bg_img = bg_img[ y:(y+size), x:(x+size), :]
+    # レベルLの外接矩形の座標から出力の範囲の座標への変換行列
+    A = M[:, :2]
+    t = M[:, 2] + A @ np.array([ox, oy]) - np.array([x1, y1])
+    M2 = np.hstack([A * (2 ** level), t[:, np.newaxis]])
 
-    # 指定したサイズにリサイズする。
-    bg_img = cv2.resize(bg_img, dsize=(img_size, img_size))
+    dsize = (x2 - x1, y2 - y1)
 
-    return bg_img
+    # 外接矩形の外側は、原画の物体の周りの背景に近くなるように端の画素をくり返す。
+    aug_img2  = cv2.warpAffine(src_roi, M2, dsize, borderMode=cv2.BORDER_REPLICATE)
+    mask_img2 = cv2.warpAffine(mask_pyramid[level], M2, dsize)
+
+    return aug_img2, mask_img2, (x1, y1)
 
-def intersect_bounding_box(bounding_box1, bounding_box2, img_size : int) -> bool:
-    """2つのバウンディングボックスが交わればTrueを返す。
+def compose_cutout(cutout : Cutout, bg_img : np.ndarray, img_size : int, color_aug : str = 'object', objects : int = 5):
+    """切り抜いた物体を背景画像に貼り付けて、学習用の画像とタグを作る。
 
     Args:
-        bounding_box1 : バウンディングボックス1
-        bounding_box2 : バウンディングボックス2
+        cutout : 切り抜いた物体
+        bg_img : 背景画像
         img_size : 画像サイズ
+        color_aug : 色のデータ拡張の方法。'object'なら貼り付けるごと、'frame'ならフレームごとに1回、物体の外接矩形の内部の色を変化させる。
+        objects : 1枚の画像に貼り付ける物体の数
 
-    Returns:
-        _type_: _description_
+    Returns: 合成画像, バウンディングボックス情報
     """
-    x1, y1, w1, h1, theta1 = bounding_box1
+    contour = cutout.contour
 
-    x2, y2, w2, h2, theta2 = bounding_box2
+    with profiler.Stage('resize_bg'):
+        # 背景画像を指定したサイズにする。
+        bg_img = resize_bg_img(bg_img, img_size)       
 
-    margin = img_size // 8
+    compo_img = bg_img.copy()      
 
-    # X座標が交わるならTrue
-    x_intersect = (x1 - margin <= x2 and x2 <= x1 + w1 + margin) or (x2 - margin <= x1 and x1 <= x2 + w2 + margin)
+    # 外接矩形の頂点
+    box = cv2.boxPoints(cutout.rect)
 
-    # Y座標が交わるならTrue
-    y_intersect = (y1 - margin <= y2 and y2 <= y1 + h1 + margin) or (y2 - margin <= y1 and y1 <= y2 + h2 + margin)
+    # 座標変換は物体の外接矩形の内部だけにする。
+    ox, oy = cutout.x, cutout.y
 
-    return x_intersect and y_intersect
+    # 原画の外接矩形の内部
+    src_roi = cutout.image
 
+    # マスク画像の外接矩形の内部を順に1/2に縮小したもののリスト
+    mask_pyramid = [ cutout.mask ]
 
-def make_img_tag(frame, bg_img, img_size, v_min):
-    """学習用の画像とタグを作る。
+    # 色を変化させた外接矩形の内部 (フレームごとに1回の場合)
+    frame_aug_roi = None
 
-    Args:
-        frame : 原画
-        bg_img : 背景画像
-        img_size : 画像サイズ
-        v_min : 明度の閾値
+    box_infos = []
 
-    Returns: 二値画像, マスク, 合成画像, バウンディングボックス情報 
-    """
+    # 空き領域を管理して、物体を重ならないように配置する。
+    engine = PlacementEngine(img_size)
 
-    # グレー画像
-    gray_img = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) 
+    with profiler.Stage('placement'):
+        # 回転・拡大/縮小・平行移動の変換行列と、変換後の外接矩形の頂点
+        placements = engine.place(contour, box, objects)
+        if len(placements) == 0:
+            return compo_img, box_infos
 
-    # 二値画像
-    bin_img = 255 - cv2.inRange(gray_img, v_min, 255)
+        # 頂点からバウンディングボックスと回転角をまとめて得る。
+        all_corners = np.array([ corners for _, corners in placements ])
+        all_bounding_boxes = corners2rotatedbbox_batch(all_corners)
 
-    # 二値画像から輪郭とマスク画像を得る。
-    msg, contour, mask_img = getContour(bin_img)
-    if msg != '' or bg_img is None:
-        return [bin_img] + [None] * 3
+    for (M, _), corners2, bounding_box in zip(placements, all_corners, all_bounding_boxes):
+        corners2 = corners2.tolist()
+        bounding_box = bounding_box.tolist()
 
-    # 背景画像を指定したサイズにする。
-    bg_img = resize_bg_img(bg_img, img_size)       
+        with profiler.Stage('color'):
+            # 物体の外接矩形の内部だけ色を変化させてデータ拡張をする。
+            if color_aug == 'frame':
+                # フレームごとに1回の場合
 
-    compo_img = bg_img.copy()      
+                if frame_aug_roi is None:
+                    frame_aug_roi = transform(image=src_roi)['image']
 
-    # 回転を考慮した外接矩形を得る。
-    rect = cv2.minAreaRect(contour)
+                aug_roi = frame_aug_roi
+            else:
+                aug_roi = transform(image=src_roi)['image']
 
-    # 外接矩形の頂点
-    box = cv2.boxPoints(rect)
+        with profiler.Stage('warp'):
+            # 物体の外接矩形の内部に変換行列を作用させる。
+            aug_img2, mask_img2, pos = warp_object(aug_roi, mask_pyramid, (ox, oy), M, img_size)
 
-    box_infos = []
+        if aug_img2 is None:
+            # 変換後の外接矩形が画像の外にある場合
+            profiler.count('配置: 画像の外')
 
-    for _ in range(10):
+            continue
 
-        # 回転・拡大/縮小・平行移動の変換行列
-        M  = augment_shape(contour, img_size)
+        with profiler.Stage('blend'):
+            # マスク画像を使って、画像を背景画像に貼り付ける。
+            compo_img = blend_image(compo_img, aug_img2, mask_img2, pos)
 
-        # 頂点に変換行列をかける。
-        corners2 = [ np.dot(M, np.array(p + [1])).tolist() for p in box.tolist() ]
+        box_infos.append((box, corners2, bounding_box))
 
-        # 最初の頂点から2番目の頂点へ向かう辺の角度が±45°以下になるように、頂点の順番を変える。
-        corners2 = rotate_corners(corners2)
-        if corners2 is None:
-            print('slope is None')
-            
-            continue
+    return compo_img, box_infos
 
-        # バウンディングボックスと回転角を得る。
-        bounding_box = _corners2rotatedbbox(corners2)
+def make_img_tag(frame, bg_img, img_size, v_min, color_aug='object', objects=5, segment='contours', downscale=1, track=False, quality_filter=None, frame_key=None):
+    """学習用の画像とタグを作る。
 
-        x, y, w, h, theta = bounding_box
-        if not (0 <= x and x + w <= img_size and 0 <= y and y + h <= img_size):
-            # print(f'x:{x} x+w:{x+w} y:{y} y+h:{y+h} img-size:{img_size}')
-            
-            continue
+    Args:
+        frame : 原画
+        bg_img : 背景画像
+        img_size : 画像サイズ
+        v_min : 明度の閾値
+        color_aug : 色のデータ拡張の方法。'object'なら貼り付けるごと、'frame'ならフレームごとに1回、物体の外接矩形の内部の色を変化させる。
+        objects : 1枚の画像に貼り付ける物体の数
+        segment : 物体を選ぶ方法。'contours'なら輪郭ごとに調べ、'components'なら連結成分の統計からまとめて選ぶ。
+        downscale : segmentが'components'の場合に、2以上なら縦横を1/downscaleに間引いた画像で物体を選ぶ。
+        track : Trueなら前のフレームの物体の周りだけを二値化して物体を探し、見失った場合は画像全体で探す。
+        quality_filter : 輪郭を探す前に、画質の悪いフレームを棄却するフィルター
+        frame_key : クラスのインデックス, 動画ファイルのインデックス, クラス内のフレームの通し番号, フレームのインデックス。
+            trackの場合に、前のフレームと同じ動画の続きのフレームでなければ画像全体で探す。Noneなら常に画像全体で探す。
 
-        if any(intersect_bounding_box(bounding_box, bounding_box2, img_size) for _, _, bounding_box2 in box_infos):
-            continue
+    Returns: 二値画像, マスク, 合成画像, バウンディングボックス情報 
+    """
+    global tracker
 
-        # 画像の色を変化させてデータ拡張をする。
-        aug_img = transform(image=frame)['image']
+    if track:
+        if tracker is None or (tracker.vMin, tracker.segment, tracker.downscale) != (v_min, segment, downscale):
+            tracker = ObjectTracker(v_min, segment, downscale)
 
-        # 画像に変換行列を作用させる。
-        aug_img2  = cv2.warpAffine(aug_img , M, (img_size, img_size))
-        mask_img2 = cv2.warpAffine(mask_img, M, (img_size, img_size))
+        tracker.quality = quality_filter
 
-        # マスク画像を使って、画像を背景画像に貼り付ける。
-        compo_img = blend_image(compo_img, aug_img2, mask_img2)
+        # 前のフレームと同じ動画の続きのフレームでなければ、追跡をやめる。
+        tracker.follow(frame_key)
 
-        box_infos.append((box, corners2, bounding_box))
+        # 前のフレームの物体の周りを二値化して物体を切り抜く。
+        bin_img, msg, mask_img, cutout = tracker.make_cutout(frame)
+    else:
+        # 原画を二値化して物体を切り抜く。
+        bin_img, msg, mask_img, cutout = make_cutout(frame, v_min, segment, downscale, quality_filter)
+    if cutout is None or bg_img is None:
+        return [bin_img] + [None] * 3
 
-        if len(box_infos) == 5:
-            break
+    # 切り抜いた物体を背景画像に貼り付ける。
+    compo_img, box_infos = compose_cutout(cutout, bg_img, img_size, color_aug, objects)
 
     return bin_img, mask_img, compo_img, box_infos
 
 def make_image_classes(video_dir : str):
     """画像のクラスのリストを作る。
 
+    動画ファイルの情報はマニフェストから読み、新しいか変更された動画ファイルだけを調べる。
+
     Args:
         video_dir : 動画ファイルのフォルダのパス
 
     Returns: 画像のクラスのリスト
     """
+    # 動画ファイルの情報のキャッシュ
+    manifest = VideoManifest(video_dir)
+
     # 画像のクラスのリスト
     image_classes = []
 
     # すべてのクラスのフォルダに対して
-    for class_dir in glob.glob(f'{video_dir}/*'):
-
-        # クラス名(カテゴリ名)
-        category_name = os.path.basename(class_dir)
+    for category_name, class_dir, videos in manifest.scan():
 
         # 画像のクラス
         img_class = ImageClass(category_name, class_dir)
@@ -338,20 +712,20 @@ def make_image_classes(video_dir : str):
         image_classes.append(img_class)
 
         # クラスのフォルダ内の動画ファイルに対し
-        for video_path in glob.glob(f'{class_dir}/*'):
+        for video_path, info in videos:
 
-            # パスの区切り文字をUNIX形式に統一する。
-            video_path_str = str(video_path).replace('\\', '/')
+            # 動画ファイルのパスと情報のリストに追加する。
+            img_class.videoPathes.append(video_path)
+            img_class.videoInfos.append(info)
 
-            # 動画ファイルのパスのリストに追加する。
-            img_class.videoPathes.append(video_path_str)
+    manifest.save()
 
     return image_classes
 
 def parse():
     """コマンドライン引数を解析する。
 
-    Returns: 引数のリスト
+    Returns: 引数のリスト (最後の要素はその他のオプション)
     """
     parser = argparse.ArgumentParser(description='動画ファイルから学習データを作る。')
     parser.add_argument('-i','--input', type=str, help='動画ファイルのフォルダのパス')
@@ -360,9 +734,40 @@ def parse():
     parser.add_argument('-dtsz', '--data_size', type=int, help='1クラスあたりの学習データの数。デフォルトは1000。', default=1000)
     parser.add_argument('-imsz', '--img_size', type=int, help='出力画像のサイズ。 デフォルトは720。', default=720)
     parser.add_argument('-v', '--v_min', type=int, help='明度の閾値。デフォルトは250。', default=250)
+    parser.add_argument('-w', '--workers', type=int, help='合成処理のワーカー プロセスの数。0ならメイン プロセスで処理する。デフォルトは0。', default=0)
+    parser.add_argument('--seed', type=int, help='乱数のシード。指定しなければ実行ごとに変わる。', default=None)
+    parser.add_argument('--bg_cache', type=int, help='メモリに置く背景画像の最大枚数。デフォルトは256。', default=256)
+    parser.add_argument('--color_aug', type=str, choices=['object', 'frame'], help='色のデータ拡張の方法。objectなら貼り付けるごと、frameならフレームごとに1回。デフォルトはobject。', default='object')
+    parser.add_argument('--objects', type=int, help='1枚の画像に貼り付ける物体の数。デフォルトは5。', default=5)
+    parser.add_argument('--writers', type=int, help='画像ファイルを書くスレッドの数。0なら合成処理と同じスレッドで書く。デフォルトは4。', default=4)
+    parser.add_argument('--shard_size', type=int, help='シャード ファイルの最大のサイズ(MB)。指定した場合は画像ごとのファイルを作らずにシャード ファイルに追記する。デフォルトは0。', default=0)
+    parser.add_argument('--checkpoint', type=int, help='チェックポイントを保存する間隔 (学習データの数)。0なら保存しない。デフォルトは1000。', default=1000)
+    parser.add_argument('--resume', action='store_true', help='出力先のチェックポイントから再開する。')
+    parser.add_argument('--extend', action='store_true', help='既存の学習データに、新しいか変更されたクラスの学習データを追加する。')
+    parser.add_argument('--virtual', action='store_true', help='画像は書かずに、合成画像を作り直すためのレシピを recipes.json に書く。')
+    parser.add_argument('--segment', type=str, choices=['contours', 'components'], help='物体を選ぶ方法。contoursなら輪郭ごとに調べ、componentsなら連結成分の統計からまとめて選ぶ。デフォルトはcontours。', default='contours')
+    parser.add_argument('--downscale', type=int, help='--segment components の場合に、縦横を1/downscaleに間引いた画像で物体を選ぶ。デフォルトは1。', default=1)
+    parser.add_argument('--track', action='store_true', help='前のフレームの物体の周りだけを二値化して物体を探す。見失った場合や、前のフレームが同じ動画の続きのフレームでない場合は画像全体で探す。')
+    parser.add_argument('--dedup', type=int, help='前に読んだフレームと差分ハッシュ(64ビット)の違うビットの数がこの数より少ないフレームは、重複として読み飛ばす。0なら調べない。デフォルトは0。', default=0)
+    parser.add_argument('--min_sharpness', type=float, help='シャープさ(長辺512画素以下に縮小したグレー画像のラプラシアンの分散)がこれより小さいフレームは、ぼけているとして棄却する。デフォルトは0。', default=0)
+    parser.add_argument('--min_brightness', type=int, help='明るさ(グレー画像の平均)がこれより小さいフレームは棄却する。デフォルトは0。', default=0)
+    parser.add_argument('--max_brightness', type=int, help='明るさ(グレー画像の平均)がこれより大きいフレームは棄却する。デフォルトは255。', default=255)
+    parser.add_argument('--prefetch', type=int, help='動画ファイルをバックグラウンドのスレッドでデコードして、動画ファイルごとにこの数のフレームまで先読みする。0なら先読みしない。デフォルトは0。', default=0)
+    parser.add_argument('--decode_threads', type=int, help='先読みする場合に、同時にデコードする動画ファイルの数。デフォルトは1。', default=1)
+    parser.add_argument('--stage_threads', type=int, nargs=5, metavar=('DECODE', 'SEGMENT', 'COMPOSE', 'ENCODE', 'WRITE'), help='パイプラインの デコード, 物体の切り抜き, 合成, JPEGの圧縮, 画像ファイルの書き込み のステージのスレッドの数。指定した場合は最後にステージの使用率を表示する。', default=None)
+    parser.add_argument('--shared_memory', action='store_true', help='ワーカー プロセスとの間の原画と合成画像を、pickleで送らずに共有メモリの枠で受け渡す。')
+    parser.add_argument('--profile', action='store_true', help='処理ごとの時間のヒストグラムと棄却の回数を表示して、出力先の profile.json に書く。')
+    parser.add_argument('--cutouts', type=str, help='cutout.pyで切り抜いた物体の保存先のフォルダのパス。指定した場合は動画ファイルは読まない。', default=None)
 
     args = parser.parse_args(sys.argv[1:])
 
+    if args.downscale < 1:
+        parser.error('--downscale は1以上にしてください。')
+
+    if args.cutouts is not None and (0 < args.min_sharpness or 0 < args.min_brightness or args.max_brightness < 255):
+        # 保存された物体は画質を調べずに切り抜いたものなので、画質の閾値は使えない。
+        parser.error('--cutouts と画質の閾値 (--min_sharpness, --min_brightness, --max_brightness) は同時に指定できません。')
+
     # 動画ファイルのフォルダのパス
     video_dir = args.input.replace('\\', '/')
 
@@ -372,7 +777,7 @@ def parse():
     # 出力先フォルダのパス
     output_dir = args.output.replace('\\', '/')
 
-    return video_dir, bg_img_dir, output_dir, args.data_size, args.img_size, args.v_min
+    return video_dir, bg_img_dir, output_dir, args.data_size, args.img_size, args.v_min, args
 
 def get_video_capture(video_path : str):
     """動画ファイルのキャプチャ オブジェクトを返す。
@@ -416,63 +821,720 @@ def init_cap(image_class : ImageClass, video_idx : int):
 
     return cap
 
-def make_training_data(output_dir, image_classes, bg_img_paths, data_size, img_size, v_min):
-    # ODTKの学習データ作成のオブジェクト
-    network = ODTK(output_dir, image_classes)
+def seed_random(seed : int):
+    """乱数のシードをセットする。
+
+    Args:
+        seed : 乱数のシード
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+
+    # albumentationsの乱数のシード
+    if hasattr(transform, 'set_random_seed'):
+        transform.set_random_seed(seed)
+
+def task_seed(base_seed : int, class_idx : int, frame_cnt : int) -> int:
+    """フレームごとの乱数のシードを返す。
+
+    どのワーカーで処理しても同じ結果になるように、シードはクラスとフレームの通し番号だけから決める。
+
+    Args:
+        base_seed : 全体の乱数のシード
+        class_idx : クラスのインデックス
+        frame_cnt : クラス内のフレームの通し番号
+
+    Returns: 乱数のシード
+    """
+    return int(np.random.SeedSequence([base_seed, class_idx, frame_cnt]).generate_state(1)[0])
+
+def init_worker(bank : BackgroundBank, args : dict, profile : bool = False, rings : tuple = None):
+    """ワーカー プロセスの初期処理をする。
+
+    Args:
+        bank : リサイズ済みの背景画像のバンク
+        args : make_img_tagに渡す、実行中は変わらない引数
+        profile : Trueなら処理時間と棄却の回数を記録する。
+        rings : 原画と合成画像の共有メモリの枠のリング
+    """
+    global frame_rings
+
+    # ワーカーごとにOpenCVのスレッドを増やさないようにする。
+    cv2.setNumThreads(1)
+
+    profiler.enabled = profile
+
+    # forkで引き継いだメイン プロセスの記録は捨てる。
+    profiler.take()
+    quality.take_stats()
+
+    frame_rings = rings
+
+    set_compose_args(bank, args)
+
+def set_compose_args(bank : BackgroundBank, args : dict):
+    """compose_taskで使う背景画像のバンクと引数をセットする。
+
+    Args:
+        bank : リサイズ済みの背景画像のバンク
+        args : make_img_tagに渡す、実行中は変わらない引数
+    """
+    global bg_bank, compose_args
+
+    bg_bank = bank
+    compose_args = args
+
+def compose_task(task):
+    """1フレームから学習用の画像とタグを作る。ワーカー プロセスで実行される。
+
+    原画が共有メモリの枠の記述子の場合は、枠の原画をそのまま使い、合成画像は同じ枠のインデックスの合成画像の枠にコピーして記述子を返す。
+
+    Args:
+        task : 乱数のシード, 原画(または切り抜いた物体か、原画の記述子), 背景画像ファイルのパス, フレームのキー (make_img_tagのframe_key)
+
+    Returns: 合成画像(または合成画像の記述子), バウンディングボックス情報 (フレームが使えない場合はNone, None), 配置と画質の統計と処理時間の記録
+    """
+    seed, frame, bg_img_path, frame_key = task
+
+    desc = None
+    if isinstance(frame, FrameDesc):
+        # 共有メモリの枠の原画の場合
+        desc = frame
+        frame = frame_rings[0].view(desc)
+
+    # フレームごとの乱数のシードをセットする。
+    seed_random(seed)
+
+    with profiler.Stage('background'):
+        if bg_bank is not None:
+            # 背景画像のバンクから読む。
+            bg_img = bg_bank.get(bg_img_path)
+        else:
+            # 背景画像ファイルを読む。
+            bg_img = cv2.imread(bg_img_path)
+
+    if bg_img is None:
+        profiler.count('背景画像: 読めない')
+
+    compo_img, box_infos = None, None
+
+    if isinstance(frame, Cutout):
+        # 保存された物体の場合
+
+        if bg_img is not None:
+            compo_img, box_infos = compose_cutout(frame, bg_img, compose_args["img_size"], compose_args["color_aug"], compose_args["objects"])
+
+    else:
+        # 二値画像, マスク, 合成画像, バウンディングボックス情報
+        bin_img, mask_img, compo_img, box_infos = make_img_tag(frame, bg_img, **compose_args, frame_key=frame_key)
+
+    if desc is not None and compo_img is not None and frame_rings[1].fits(compo_img):
+        # 合成画像を共有メモリの枠に書く。
+        compo_img = frame_rings[1].put(desc.slot, compo_img, desc.classIdx, desc.videoIdx, desc.pos)
+
+    # このタスクでの配置と画質の統計と処理時間の記録も返す。
+    return compo_img, box_infos, { "placement" : placement.take_stats(), "quality" : quality.take_stats(), "profile" : profiler.take() }
+
+def segment_task(task):
+    """原画を二値化して物体を切り抜く。パイプラインのsegmentのステージのスレッドで実行される。
+
+    切り抜いた物体だけをcomposeのステージに渡すので、ワーカー プロセスに送る画像も小さくなる。
+
+    Args:
+        task : 乱数のシード, 原画(または切り抜いた物体), 背景画像ファイルのパス, フレームのキー (make_img_tagのframe_key)
+
+    Returns: 乱数のシード, 切り抜いた物体 (使えない場合はNone), 背景画像ファイルのパス と、このフレームの画質の統計
+    """
+    seed, frame, bg_img_path, frame_key = task
+
+    if isinstance(frame, Cutout):
+        # 保存された物体の場合
+        return (seed, frame, bg_img_path), {}
+
+    if compose_args["track"]:
+        if not hasattr(segment_local, "tracker"):
+            segment_local.tracker = ObjectTracker(compose_args["v_min"], compose_args["segment"], compose_args["downscale"], compose_args["quality_filter"])
+
+        # 同じ動画の続きのフレームが別のスレッドで処理された場合は、追跡をやめる。
+        segment_local.tracker.follow(frame_key)
+
+        # 前のフレームの物体の周りを二値化して物体を切り抜く。
+        bin_img, msg, mask_img, cutout = segment_local.tracker.make_cutout(frame)
+    else:
+        # 原画を二値化して物体を切り抜く。
+        bin_img, msg, mask_img, cutout = make_cutout(frame, compose_args["v_min"], compose_args["segment"], compose_args["downscale"], compose_args["quality_filter"])
+
+    return (seed, cutout, bg_img_path), quality.take_stats()
+
+def compose_stage(task, executor : ProcessPoolExecutor = None):
+    """切り抜いた物体を背景画像に貼り付ける。パイプラインのcomposeのステージのスレッドで実行される。
+
+    Args:
+        task : segment_taskの戻り値
+        executor : ワーカー プロセスのプール。Noneならこのスレッドで処理する。
+
+    Returns: compose_taskと同じ (executorを指定した場合は、その結果のFuture)
+    """
+    (seed, cutout, bg_img_path), quality_stats = task
+
+    if cutout is None:
+        # 物体を切り抜けなかった場合
+        return None, None, { "placement" : {}, "quality" : quality_stats, "profile" : { "timings" : {}, "counts" : {} } }
+
+    if executor is None:
+        compo_img, box_infos, stats = compose_task((seed, cutout, bg_img_path, None))
+
+        quality.add_stats(stats["quality"], quality_stats)
+
+        return compo_img, box_infos, stats
+
+    # ワーカー プロセスの合成の終わりは待たずにFutureを返して、このスレッドは次の物体を送る。
+    future = executor.submit(compose_task, (seed, cutout, bg_img_path, None))
+
+    def add_quality_stats(done : Future):
+        # 合成が終わったら、切り抜いたときの画質の統計を足す。
+        if not done.cancelled() and done.exception() is None:
+            quality.add_stats(done.result()[2]["quality"], quality_stats)
+
+    future.add_done_callback(add_quality_stats)
+
+    return future
+
+def open_cutout_store(store_dir : str, v_min : int, image_classes : list) -> CutoutStore:
+    """切り抜いた物体の保存先を開く。
+
+    Args:
+        store_dir : 切り抜いた物体の保存先のフォルダのパス
+        v_min : 明度の閾値
+        image_classes : 画像のクラスのリスト
+
+    Returns: 切り抜いた物体の保存先
+    """
+    store = CutoutStore(store_dir, v_min)
+
+    for img_class in image_classes:
+        for video_path, info in zip(img_class.videoPathes, img_class.videoInfos):
+            if not store.is_valid(video_path, info):
+                # 保存されていないか、動画ファイルが変更された場合
+
+                print(f'切り抜いた物体が保存されていません。 cutout.py で保存してください。 {video_path}')
+                sys.exit()
+
+    return store
+
+def generate_samples(image_classes, bg_img_paths, data_size, img_size, v_min, workers=0, seed=None, bank=None, color_aug='object', store=None, objects=5, placement_stats=None, progress=None, segment='contours', downscale=1, track=False, dedup=0, quality_filter=None, quality_stats=None, prefetch=0, decode_threads=1, stage_threads=None, shared_memory=False):
+    """合成画像とバウンディングボックス情報を1個作るごとにyieldする。
+
+    workersが1以上の場合は、フレームの合成をプロセスプールで並列に処理する。
+    フレームごとの乱数のシードは処理するワーカーによらないので、結果は workers=0 の場合と同じになる。
+
+    Args:
+        image_classes : 画像のクラスのリスト
+        bg_img_paths : 背景画像ファイルのパスのリスト
+        data_size : 1クラスあたりの学習データの数
+        img_size : 画像サイズ
+        v_min : 明度の閾値
+        workers : ワーカー プロセスの数
+        seed : 乱数のシード
+        bank : リサイズ済みの背景画像のバンク。Noneなら背景画像ファイルを毎回読む。
+        color_aug : 色のデータ拡張の方法 ('object' または 'frame')
+        store : 切り抜いた物体の保存先。指定した場合は動画ファイルは読まない。
+        objects : 1枚の画像に貼り付ける物体の数
+        placement_stats : 配置の統計を足し合わせる辞書
+        progress : 途中から再開するための状態の辞書。学習データを1個作るごとに更新する。"class_idx"があれば、その状態から再開する。
+        segment : 物体を選ぶ方法 ('contours' または 'components')
+        downscale : segmentが'components'の場合に、物体を選ぶ画像の縮小率の逆数
+        track : Trueなら前のフレームの物体の周りだけを二値化して物体を探す。
+        dedup : 前に読んだフレームとハッシュの違うビットの数がこの数より少ないフレームは、重複として読み飛ばす。0なら調べない。
+        quality_filter : 輪郭を探す前に、画質の悪いフレームを棄却するフィルター
+        quality_stats : 画質の統計を足し合わせる辞書
+        prefetch : 動画ファイルごとに先読みするフレームの最大数。0なら先読みしない。
+        decode_threads : 先読みする場合に、同時にデコードする動画ファイルの数
+        stage_threads : パイプラインのsegmentとcomposeのステージのスレッドの数。Noneならパイプラインを使わない。
+        shared_memory : Trueなら、ワーカー プロセスとの間の原画と合成画像を、pickleで送らずに共有メモリの枠で受け渡す。
+
+    Returns: クラスのインデックス, 動画ファイルのインデックス, 動画の位置, 合成画像, バウンディングボックス情報, レシピ を返すジェネレータ。
+        レシピは合成画像を作り直すための フレーム(または保存された物体)のインデックス, 乱数のシード, 背景画像ファイルのパス
+    """
+    global bg_bank, compose_args
+
+    bg_bank = bank
+
+    # make_img_tagに渡す、実行中は変わらない引数
+    compose_args = { "img_size" : img_size, "v_min" : v_min, "color_aug" : color_aug, "objects" : objects, "segment" : segment, "downscale" : downscale, "track" : track, "quality_filter" : quality_filter }
+
+    if placement_stats is None:
+        placement_stats = {}
+
+    if quality_stats is None:
+        quality_stats = {}
+
+    # 再開する状態
+    resume = dict(progress) if progress is not None and "class_idx" in progress else None
+
+    if progress is None:
+        progress = {}
+
+    # 全体の乱数のシード
+    seed_seq = np.random.SeedSequence(seed)
+    base_seed = int(seed_seq.generate_state(1)[0])
 
     # 背景画像ファイルのリストをシャッフル
-    random.shuffle(bg_img_paths)
+    bg_img_paths = list(bg_img_paths)
+    np.random.default_rng(seed_seq).shuffle(bg_img_paths)
 
     # 背景画像ファイルのインデックス
     bg_img_idx = 0
 
-    for class_idx, image_class in enumerate(image_classes):
-        total_frame_cnt = image_class.get_total_frame_count()
+    # 原画と合成画像の共有メモリの枠のリング
+    rings = None
+    if shared_memory and 0 < workers and store is None and stage_threads is None:
+        # 枠の数は同時に処理するフレームの最大数で、原画の枠は最も解像度の高い動画ファイルに合わせる。
+        frame_bytes = max(info["width"] * info["height"] * 3 for x in image_classes for info in x.videoInfos)
+        rings = (FrameRing(2 * workers, frame_bytes), FrameRing(2 * workers, img_size * img_size * 3))
+
+    # ワーカー プロセスのプール
+    executor = ProcessPoolExecutor(workers, initializer=init_worker, initargs=(bank, compose_args, profiler.enabled, rings)) if 0 < workers else None
+
+    if executor is not None and (0 < prefetch or stage_threads is not None):
+        # デコードやパイプラインのスレッドを開始する前に、ワーカー プロセスを起動しておく。(スレッドが動いているプロセスをforkしない)
+        executor.submit(int).result()
+
+    # 物体の切り抜きと合成のパイプライン
+    pipe = None
+
+    # 同時に処理するフレームの最大数
+    max_pending = max(1, 2 * workers)
+
+    if stage_threads is not None:
+        segment_threads, compose_threads = stage_threads
+        if executor is None:
+            # 合成はグローバルな乱数を使うので、メイン プロセスでは1個のスレッドで処理する。
+            compose_threads = 1
+
+        pipe = Pipeline([ ("segment", segment_task, segment_threads), ("compose", lambda task: compose_stage(task, executor), compose_threads) ])
+
+        # composeのスレッドは合成の終わりを待たないので、ワーカー プロセスで処理中のフレームも数える。
+        max_pending = 2 * (max(1, segment_threads) + max(1, compose_threads) + workers)
+
+    try:
+        for class_idx, image_class in enumerate(image_classes):
+            if resume is not None and class_idx < resume["class_idx"]:
+                # 作り終えたクラスの場合
+                continue
+
+            # クラスごとのフレームを選ぶ乱数生成器
+            rng = np.random.default_rng([base_seed, class_idx])
+
+            # フレームを選んで読むオブジェクト
+            sampler = FrameSampler(image_class, rng, store, dedup, prefetch, decode_threads)
+
+            # 処理中のフレームのキュー
+            pending = deque()
+
+            if resume is not None:
+                # 途中から再開する場合
+
+                # 現在のラウンドの残りのフレームを読むジェネレータ
+                frames = sampler.set_state(resume["sampler"], *resume["last"])
+
+                # クラス内のフレームの通し番号
+                frame_cnt = resume["frame_cnt"]
+
+                class_data_cnt = resume["class_data_cnt"]
+
+                bg_img_idx = resume["bg_img_idx"]
+
+                resume = None
+
+            else:
+                # 現在のラウンドのフレームを読むジェネレータ
+                frames = sampler.next_round(data_size)
+
+                # クラス内のフレームの通し番号
+                frame_cnt = 0
+
+                class_data_cnt = 0
+
+            # 次のクラスで使う背景画像ファイルのインデックス
+            next_bg_img_idx = bg_img_idx
+
+            while class_data_cnt < data_size:
+
+                while len(pending) < max_pending and frames is not None:
+                    # キューに空きがある場合
+
+                    item = next(frames, None)
+                    if item is None:
+                        # ラウンドの終わりの場合
 
-        class_data_cnt = 0
+                        frames = None
+                        break
+
+                    video_idx, idx, pos, frame = item
+
+                    # 原画を書いた共有メモリの枠のインデックス
+                    slot = None
+                    if rings is not None and isinstance(frame, np.ndarray) and rings[0].fits(frame):
+                        slot = rings[0].acquire()
+                        frame = rings[0].put(slot, frame, class_idx, video_idx, pos)
+
+                    task = (task_seed(base_seed, class_idx, frame_cnt), frame, bg_img_paths[bg_img_idx], (class_idx, video_idx, frame_cnt, idx))
+                    if pipe is not None:
+                        task = pipe.submit(task)
+                    elif executor is not None:
+                        task = executor.submit(compose_task, task)
+
+                    pending.append((video_idx, idx, pos, frame_cnt, bg_img_idx, slot, task))
+
+                    frame_cnt += 1
+                    bg_img_idx = (bg_img_idx + 1) % len(bg_img_paths)
 
-        video_idx = 0
-        cap = init_cap(image_class, video_idx)
-        while class_data_cnt < data_size:
+                if len(pending) == 0:
+                    # ラウンドのすべての結果が出た場合
 
-            ret, frame = cap.read()
-            if ret:
-                # 画像が取得できた場合
+                    # 足りない数のフレームを次のラウンドで選ぶ。
+                    frames = sampler.next_round(data_size - class_data_cnt)
+                    if frames is None:
+                        # 使えるフレームがない場合
+
+                        print(f'{image_class.name}: 使えるフレームが足りないので、学習データは{class_data_cnt}個です。')
+                        break
 
-                if data_size < total_frame_cnt and data_size / total_frame_cnt < np.random.rand():
                     continue
 
-                # 動画の現在位置
-                pos = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+                # フレームを投入した順に結果を取り出す。
+                video_idx, idx, pos, used_frame_cnt, used_bg_img_idx, slot, task = pending.popleft()
+                with profiler.Stage('compose'):
+                    if executor is None and pipe is None:
+                        compo_img, box_infos, stats = compose_task(task)
+                    else:
+                        compo_img, box_infos, stats = task.result()
+
+                if slot is not None:
+                    if isinstance(compo_img, FrameDesc):
+                        # 合成画像の枠は次のフレームで使うので、コピーする。
+                        compo_img = rings[1].view(compo_img).copy()
 
-                # 背景画像ファイルを読む。
-                bg_img = cv2.imread(bg_img_paths[bg_img_idx])
-                bg_img_idx = (bg_img_idx + 1) % len(bg_img_paths)
+                    rings[0].release(slot)
 
-                # 二値画像, マスク, 合成画像, バウンディングボックス情報
-                bin_img, mask_img, compo_img, box_infos = make_img_tag(frame, bg_img, img_size, v_min)
+                placement.add_stats(placement_stats, stats["placement"])
+                quality.add_stats(quality_stats, stats["quality"])
+                profiler.merge(stats["profile"])
 
-                if mask_img is not None:
-                    network.add_image(class_idx, video_idx, pos, compo_img, box_infos)
+                next_bg_img_idx = (used_bg_img_idx + 1) % len(bg_img_paths)
 
+                if compo_img is not None:
                     class_data_cnt += 1
 
-                    yield
+                    # このフレームまで使ったときの状態。フレームを選ぶ状態は、保存するときにsamplerから得る。
+                    progress.update({ "class_idx" : class_idx, "class_data_cnt" : class_data_cnt, "frame_cnt" : used_frame_cnt + 1, "bg_img_idx" : next_bg_img_idx, "last" : [ video_idx, idx ], "sampler" : sampler })
 
-                    if data_size <= class_data_cnt:
-                        # 現在のクラスのテータ数が指定値に達した場合
+                    yield class_idx, video_idx, pos, compo_img, box_infos, (idx, task_seed(base_seed, class_idx, used_frame_cnt), bg_img_paths[used_bg_img_idx])
 
-                        break
+                else:
+                    # フレームが使えなかった場合
+
+                    sampler.reject(video_idx, idx)
+
+            if frames is not None:
+                # 先読みしているフレームを捨てる。
+                frames.close()
+
+            # 現在のクラスのテータ数が指定値に達したので、先行して投入したフレームは捨てる。
+            for *_, slot, task in pending:
+                if executor is not None or pipe is not None:
+                    task.cancel()
+
+                if slot is not None:
+                    # 処理中のワーカーが枠を使い終わるのを待ってから返す。
+                    wait([ task ])
+                    rings[0].release(slot)
+
+            if 0 < dedup:
+                print(f'{image_class.name}: 重複として読み飛ばしたフレームは{sampler.get_duplicates()}個です。')
+
+            # 背景画像ファイルのインデックスを、最後に使ったフレームの次に戻す。
+            bg_img_idx = next_bg_img_idx
+
+    finally:
+        if pipe is not None:
+            pipe.close()
+
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+        if rings is not None:
+            for ring in rings:
+                ring.close()
+
+def class_sources(image_class : ImageClass, params : dict) -> dict:
+    """クラスの学習データを作った動画ファイルと引数を返す。
+
+    Args:
+        image_class : 画像のクラス
+        params : 学習データを作った引数
 
+    Returns: 引数と、動画ファイルの相対パスからファイルサイズと更新日時への辞書
+    """
+    videos = { '/'.join(path.split('/')[-2:]) : [ info["size"], info["mtime"] ] for path, info in zip(image_class.videoPathes, image_class.videoInfos) }
+
+    return { "params" : params, "videos" : videos }
+
+def plan_extension(output_dir : str, image_classes : list, params : dict):
+    """既存の学習データに追加するときに、学習データを作るクラスを決める。
+
+    新しいクラスと、動画ファイルか引数が変わったクラスだけを作り直し、それ以外のクラスの画像とアノテーションはそのまま使う。
+    動画ファイルのフォルダから消えたクラスの学習データも残す。
+
+    Args:
+        output_dir : 学習データの出力先のパス
+        image_classes : 画像のクラスのリスト
+        params : 学習データを作る引数
+
+    Returns: 学習データを作るクラスのリスト, 既存の学習データから作り直すクラスの画像とアノテーションを除いたもの, 除いた画像の情報のリスト, 既存のクラスごとの動画ファイルと引数 (既存の学習データがない場合は image_classes, None, [], {})
+    """
+    train_path   = f'{output_dir}/train.json'
+    sources_path = f'{output_dir}/sources.json'
+
+    if not os.path.isfile(train_path) or not os.path.isfile(sources_path):
+        return image_classes, None, [], {}
+
+    with open(train_path) as f:
+        base = json.load(f)
+
+    with open(sources_path) as f:
+        sources = json.load(f)
+
+    # 新しいクラスと、動画ファイルか引数が変わったクラス
+    changed = [ x for x in image_classes if sources.get(x.name) != class_sources(x, params) ]
+
+    # 作り直すクラスのカテゴリーのid
+    changed_names = set(x.name for x in changed)
+    changed_ids = set(x["id"] for x in base["categories"] if x["name"] in changed_names)
+
+    # 作り直すクラスの画像のid。物体を置けなかった画像にはアノテーションがないので、ファイル名の先頭のカテゴリーのidで調べる。
+    removed_ids = set(x["id"] for x in base["images"] if int(x["file_name"].split('-')[0]) in changed_ids)
+
+    removed = [ x for x in base["images"] if x["id"] in removed_ids ]
+    base["images"] = [ x for x in base["images"] if x["id"] not in removed_ids ]
+    base["annotations"] = [ x for x in base["annotations"] if x["image_id"] not in removed_ids ]
+
+    return changed, base, removed, sources
+
+def make_training_data(output_dir, image_classes, bg_img_paths, data_size, img_size, v_min, workers=0, seed=None, bank=None, color_aug='object', store=None, objects=5, writers=4, shard_size=0, checkpoint_interval=1000, resume=False, extend=False, virtual=False, profile=False, segment='contours', downscale=1, track=False, dedup=0, quality_filter=None, prefetch=0, decode_threads=1, stage_threads=None, shared_memory=False):
+    """学習データを作る。学習データを1個作るごとにyieldする。
+
+    合成画像とアノテーションはODTK形式で出力先のフォルダに書く。
+
+    Args:
+        output_dir : 学習データの出力先のパス
+        image_classes : 画像のクラスのリスト
+        bg_img_paths : 背景画像ファイルのパスのリスト
+        data_size : 1クラスあたりの学習データの数
+        img_size : 画像サイズ
+        v_min : 明度の閾値
+        workers : ワーカー プロセスの数
+        seed : 乱数のシード
+        bank : リサイズ済みの背景画像のバンク。Noneなら背景画像ファイルを毎回読む。
+        color_aug : 色のデータ拡張の方法 ('object' または 'frame')
+        store : 切り抜いた物体の保存先。指定した場合は動画ファイルは読まない。
+        objects : 1枚の画像に貼り付ける物体の数
+        writers : 画像ファイルを書くスレッドの数。0なら合成処理と同じスレッドで書く。
+        shard_size : シャード ファイルの最大のバイト数。0なら画像ごとにファイルを書く。
+        checkpoint_interval : チェックポイントを保存する間隔 (学習データの数)。0なら保存しない。
+        resume : Trueならチェックポイントから再開する。
+        extend : Trueなら既存の学習データに、新しいか変更されたクラスの学習データを追加する。
+        virtual : Trueなら画像は書かずに、合成画像を作り直すためのレシピを recipes.json に書く。
+        profile : Trueなら処理ごとの時間と棄却の回数を記録して、表示して profile.json に書く。
+        segment : 物体を選ぶ方法 ('contours' または 'components')
+        downscale : segmentが'components'の場合に、物体を選ぶ画像の縮小率の逆数
+        track : Trueなら前のフレームの物体の周りだけを二値化して物体を探す。
+        dedup : 前に読んだフレームとハッシュの違うビットの数がこの数より少ないフレームは、重複として読み飛ばす。0なら調べない。
+        quality_filter : 輪郭を探す前に、画質の悪いフレームを棄却するフィルター
+        prefetch : 動画ファイルごとに先読みするフレームの最大数。0なら先読みしない。
+        decode_threads : 先読みする場合に、同時にデコードする動画ファイルの数
+        stage_threads : パイプラインの decode, segment, compose, encode, write のステージのスレッドの数のリスト。
+            Noneならパイプラインを使わない。指定した場合はwritersとdecode_threadsの代わりに使い、最後にステージの使用率を表示する。
+        shared_memory : Trueなら、ワーカー プロセスとの間の原画と合成画像を、pickleで送らずに共有メモリの枠で受け渡す。
+    """
+    # 開始した時刻
+    start_time = time.perf_counter()
+
+    if stage_threads is not None:
+        # decodeのステージは動画ファイルを先読みするスレッド
+        decode_threads = stage_threads[0]
+        prefetch = prefetch if 0 < prefetch else 8
+
+    if profile:
+        # 前に記録したものは捨てて、この実行の分だけ記録する。
+        profiler.enabled = True
+        profiler.take()
+
+    prefetch_module.take_stats()
+    pipeline.take_stats()
+
+    # 学習データの内容を変える引数
+    params = { "data_size" : data_size, "img_size" : img_size, "v_min" : v_min, "color_aug" : color_aug, "cutouts" : store is not None, "objects" : objects }
+    if 0 < dedup:
+        # 調べない場合は、以前に作った学習データの引数と同じにする。
+        params["dedup"] = dedup
+
+    if quality_filter is not None and quality_filter.is_enabled():
+        if store is not None:
+            print('切り抜いた物体を使う場合は、画質の閾値は指定できません。')
+            sys.exit()
+
+        params["quality"] = [ quality_filter.minSharpness, quality_filter.minBrightness, quality_filter.maxBrightness ]
+
+    # 既存の学習データ, 既存の学習データから除いた画像の情報のリスト, 既存のクラスごとの動画ファイルと引数
+    base, removed, sources = None, [], {}
+
+    if virtual and extend:
+        print('レシピを書く場合は、既存の学習データに追加できません。')
+        sys.exit()
+
+    if extend:
+        # 既存の学習データに追加する場合
+
+        image_classes, base, removed, sources = plan_extension(output_dir, image_classes, params)
+        if len(image_classes) == 0:
+            print('新しいか変更されたクラスはありません。')
+            return
+
+        print(f'学習データを作るクラス: {" ".join(x.name for x in image_classes)}')
+
+        for img_inf in removed:
+            # 作り直すクラスの画像ファイルを削除する。(シャード ファイルの中の画像は使われなくなるだけ)
+            img_path = f'{output_dir}/img/{img_inf["file_name"]}'
+            if "shard" not in img_inf and os.path.isfile(img_path):
+                os.remove(img_path)
+
+    # 途中から再開するためのチェックポイント
+    checkpoint = Checkpoint(output_dir)
+
+    # チェックポイントと一致しなければならない引数
+    config = dict(params, classes=[ [ x.name, x.videoPathes ] for x in image_classes ], bg_img_paths=list(bg_img_paths), shard_size=shard_size, extend=extend, virtual=virtual)
+
+    state = checkpoint.load() if resume else None
+    if state is not None:
+        # チェックポイントがある場合
+
+        if state["config"] != config or (seed is not None and seed != state["seed"]):
+            print(f'引数か動画ファイルがチェックポイントと違うので再開できません。 {checkpoint.dir}')
+            sys.exit()
+
+        seed = state["seed"]
+        print(f'チェックポイントから再開します。学習データ: {len(state["images"])}個')
+
+    else:
+        if resume:
+            print('チェックポイントがないので最初から作ります。')
+
+        checkpoint.remove()
+
+        if seed is None:
+            # 再開するときに同じ乱数を使えるように、シードを決めておく。
+            seed = int(np.random.SeedSequence().entropy)
+
+    if virtual:
+        # 合成画像を作り直すための引数とフォルダのパス。物体を探す方法も、作り直すときに同じにする。
+        recipe_config = dict(params, segment=segment, downscale=downscale, track=track,
+            video_dir=os.path.abspath(os.path.dirname(image_classes[0].classDir)).replace('\\', '/'),
+            bg_img_dir=os.path.abspath(os.path.dirname(bg_img_paths[0])).replace('\\', '/'),
+            cutouts=os.path.abspath(os.path.dirname(store.dir)).replace('\\', '/') if store is not None else None)
+
+        # レシピを記録するオブジェクト
+        network = RecipeWriter(output_dir, image_classes, recipe_config, resume=state)
+
+    else:
+        # ODTKの学習データ作成のオブジェクト
+        network = ODTK(output_dir, image_classes, writers, shard_size=shard_size, resume=state, base=base, stage_threads=stage_threads[3:] if stage_threads is not None else None)
+
+    # 配置の統計
+    placement_stats = state["placement_stats"] if state is not None else {}
+
+    # 画質の統計
+    quality_stats = state.get("quality_stats", {}) if state is not None else {}
+
+    # 途中から再開するための状態
+    progress = state["progress"] if state is not None else {}
+
+    # チェックポイントの後に作った学習データの数
+    since_checkpoint = 0
+
+    try:
+        samples = generate_samples(image_classes, bg_img_paths, data_size, img_size, v_min, workers, seed, bank, color_aug, store, objects, placement_stats, progress, segment, downscale, track, dedup, quality_filter, quality_stats, prefetch, decode_threads, stage_threads[1:3] if stage_threads is not None else None, shared_memory)
+        for class_idx, video_idx, pos, compo_img, box_infos, recipe in samples:
+            if virtual:
+                network.add_recipe(class_idx, image_classes[class_idx].videoPathes[video_idx], pos, recipe)
             else:
+                network.add_image(class_idx, video_idx, pos, compo_img, box_infos)
+
+            since_checkpoint += 1
+            if 0 < checkpoint_interval and checkpoint_interval <= since_checkpoint:
+                # 書き込み中の画像を待ってから、チェックポイントを保存する。
+                images, annotations, shard = network.take_checkpoint()
+
+                checkpoint.save({
+                    "config" : config,
+                    "seed" : seed,
+                    "shard" : shard,
+                    "placement_stats" : placement_stats,
+                    "quality_stats" : quality_stats,
+                    "progress" : dict(progress, sampler=progress["sampler"].get_state())
+                }, images, annotations)
+
+                since_checkpoint = 0
+
+            yield
+
+        # 書き込み中の画像を待ってから、アノテーションを書く。
+        with profiler.Stage('save'):
+            network.save()
 
-                video_idx = (video_idx + 1) % len(image_class.videoPathes)
-                cap = init_cap(image_class, video_idx)
+    finally:
+        network.close()
 
-    network.save()
+    # 次に追加するときのために、クラスごとに学習データを作った動画ファイルと引数を書く。
+    for img_class in image_classes:
+        sources[img_class.name] = class_sources(img_class, params)
+
+    with open(f'{output_dir}/sources.json', 'w') as f:
+        json.dump(sources, f, indent=4)
+
+    # 作り終えたので、チェックポイントは要らない。
+    checkpoint.remove()
+
+    print(placement.format_stats(placement_stats))
+
+    if "quality" in params:
+        print(quality.format_stats(quality_stats))
+
+    prefetch_stats = prefetch_module.take_stats()
+    if 0 < prefetch:
+        print(prefetch_module.format_stats(prefetch_stats))
+
+    if stage_threads is not None:
+        # デコードの統計をパイプラインのdecodeのステージとして、ステージの使用率を表示する。
+        stage_stats = pipeline.take_stats()
+        pipeline.add_stats("decode", decode_threads, prefetch_stats["frames"], prefetch_stats["decode"], prefetch_stats["producer_stall"])
+        for name in [ "segment", "compose", "encode", "write" ]:
+            if name in stage_stats:
+                st = stage_stats[name]
+                pipeline.add_stats(name, st["threads"], st["items"], st["busy"], st["blocked"])
+
+        print(pipeline.format_stats(pipeline.take_stats(), time.perf_counter() - start_time))
+
+    if profile:
+        data = profiler.take()
+        print(profiler.format_report(data))
+
+        with open(f'{output_dir}/profile.json', 'w') as f:
+            json.dump(profiler.to_json(data), f, indent=4)
 
 if __name__ == '__main__':
-    video_dir, bg_img_dir, output_dir, data_size, img_size, v_min = parse()
+    video_dir, bg_img_dir, output_dir, data_size, img_size, v_min, args = parse()
 
     # 出力先フォルダを作る。
     os.makedirs(output_dir, exist_ok=True)
@@ -483,6 +1545,12 @@ if __name__ == '__main__':
     # 画像のクラスのリスト
     image_classes = make_image_classes(video_dir)
 
-    iterator = make_training_data(output_dir, image_classes, bg_img_paths, data_size, img_size, v_min)
+    # リサイズ済みの背景画像のバンク
+    bank = BackgroundBank(bg_img_dir, bg_img_paths, img_size, ram_size=args.bg_cache)
+
+    # 切り抜いた物体の保存先
+    store = open_cutout_store(args.cutouts, v_min, image_classes) if args.cutouts is not None else None
+
+    iterator = make_training_data(output_dir, image_classes, bg_img_paths, data_size, img_size, v_min, workers=args.workers, seed=args.seed, bank=bank, color_aug=args.color_aug, store=store, objects=args.objects, writers=args.writers, shard_size=args.shard_size * 1024 * 1024, checkpoint_interval=args.checkpoint, resume=args.resume, extend=args.extend, virtual=args.virtual, profile=args.profile, segment=args.segment, downscale=args.downscale, track=args.track, dedup=args.dedup, quality_filter=QualityFilter(args.min_sharpness, args.min_brightness, args.max_brightness), prefetch=args.prefetch, decode_threads=args.decode_threads, stage_threads=args.stage_threads, shared_memory=args.shared_memory)
     for _ in tqdm(iterator, total=len(image_classes) * data_size):
         pass
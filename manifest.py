@@ -0,0 +1,150 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+
+MANIFEST_VERSION = 1
+"""マニフェスト ファイルの形式のバージョン"""
+
+def manifest_path(video_dir : str) -> str:
+    """マニフェスト ファイルのパスを返す。
+
+    マニフェスト ファイルは動画ファイルのフォルダの横に置く。
+
+    Args:
+        video_dir : 動画ファイルのフォルダのパス
+
+    Returns: マニフェスト ファイルのパス
+    """
+    video_dir = os.path.normpath(os.path.abspath(video_dir)).replace('\\', '/')
+
+    return f'{video_dir}.manifest.json'
+
+def probe_video(video_path : str) -> dict:
+    """動画ファイルを開いて、フレーム数・FPS・解像度を調べる。
+
+    Args:
+        video_path : 動画ファイルのパス
+
+    Returns: 動画ファイルの情報 (動画として開けない場合はフレーム数が0)
+    """
+    cap = cv2.VideoCapture(video_path)
+
+    if cap.isOpened():
+        info = {
+            "frame_count" : int(cap.get(cv2.CAP_PROP_FRAME_COUNT)),
+            "fps"         : float(cap.get(cv2.CAP_PROP_FPS)),
+            "width"       : int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            "height"      : int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        }
+    else:
+        info = { "frame_count" : 0, "fps" : 0.0, "width" : 0, "height" : 0 }
+
+    cap.release()
+
+    return info
+
+class VideoManifest:
+    """動画ファイルの情報のキャッシュ
+
+    動画ファイルごとにフレーム数・FPS・解像度・ファイルサイズ・更新日時を保存し、
+    新しいか変更された動画ファイルだけを開いて調べる。
+    """
+    def __init__(self, video_dir : str, probe_threads : int = 8):
+        self.videoDir = video_dir
+        """動画ファイルのフォルダのパス"""
+
+        self.path = manifest_path(video_dir)
+        """マニフェスト ファイルのパス"""
+
+        self.probeThreads = probe_threads
+        """動画ファイルを調べるスレッドの数"""
+
+        self.videos = {}
+        """動画ファイルの相対パスから情報への辞書"""
+
+        self.changed = False
+        """保存されていない変更があればTrue"""
+
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path) as f:
+                    obj = json.load(f)
+
+                if obj.get("version") == MANIFEST_VERSION:
+                    self.videos = obj["videos"]
+
+            except (OSError, ValueError) as e:
+                print(f'マニフェストを読めません。{self.path} {e}')
+
+    def scan(self) -> list:
+        """動画ファイルのフォルダを調べて、マニフェストを更新する。
+
+        Returns: クラス名, クラスのフォルダのパス, 動画ファイルのパスと情報のペアのリスト のリスト
+        """
+        # クラス名, クラスのフォルダのパス, 動画ファイルの相対パスのリスト
+        classes = []
+
+        # 相対パスから(ファイルサイズ, 更新日時)への辞書
+        stats = {}
+
+        # すべてのクラスのフォルダに対して
+        for class_entry in sorted(os.scandir(self.videoDir), key=lambda x: x.name):
+            if not class_entry.is_dir():
+                continue
+
+            rel_paths = []
+
+            # クラスのフォルダ内のファイルに対し
+            for entry in sorted(os.scandir(class_entry.path), key=lambda x: x.name):
+                if not entry.is_file():
+                    continue
+
+                rel_path = f'{class_entry.name}/{entry.name}'
+
+                st = entry.stat()
+                stats[rel_path] = (st.st_size, st.st_mtime_ns)
+
+                rel_paths.append(rel_path)
+
+            classes.append((class_entry.name, f'{self.videoDir}/{class_entry.name}', rel_paths))
+
+        # 削除された動画ファイルの情報を取り除く。
+        for rel_path in [ x for x in self.videos if x not in stats ]:
+            del self.videos[rel_path]
+            self.changed = True
+
+        # 新しいか変更された動画ファイルのリスト
+        new_paths = [ x for x, (size, mtime) in stats.items() if self.videos.get(x, {}).get("size") != size or self.videos.get(x, {}).get("mtime") != mtime ]
+
+        if len(new_paths) != 0:
+            # 動画ファイルを開く処理はGILを解放するので、スレッドで並列に調べる。
+            with ThreadPoolExecutor(self.probeThreads) as executor:
+                infos = list(executor.map(probe_video, [ f'{self.videoDir}/{x}' for x in new_paths ]))
+
+            for rel_path, info in zip(new_paths, infos):
+                info["size"], info["mtime"] = stats[rel_path]
+                self.videos[rel_path] = info
+
+            self.changed = True
+
+        return [ (name, class_dir, [ (f'{self.videoDir}/{x}', self.videos[x]) for x in rel_paths if 0 < self.videos[x]["frame_count"] ]) for name, class_dir, rel_paths in classes ]
+
+    def save(self):
+        """変更があれば、マニフェスト ファイルに書く。
+        """
+        if not self.changed:
+            return
+
+        tmp_path = f'{self.path}.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({ "version" : MANIFEST_VERSION, "videos" : self.videos }, f, indent=4)
+
+            # 書き込みの途中で止まっても壊れないように、書き終えてから置き換える。
+            os.replace(tmp_path, self.path)
+
+            self.changed = False
+
+        except OSError as e:
+            print(f'マニフェストを書けません。{self.path} {e}')
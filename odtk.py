@@ -4,34 +4,96 @@ import numpy as np
 import json
 import cv2
 import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from geometry import corners2rotatedbbox_batch, nor_thetas
+from shard import ShardWriter
+from pipeline import Pipeline
+import profiler
 
 class ODTK:
-    def __init__(self, output_dir, image_classes):
+    def __init__(self, output_dir, image_classes, writers=4, max_queue=64, shard_size=0, resume=None, base=None, stage_threads=None):
         self.output_dir = output_dir
 
-        img_dir = f'{output_dir}/img'
-        if os.path.isdir(img_dir):
-            # フォルダがすでにある場合
+        # 画像ファイルを書くスレッドのプール。JPEGの圧縮とファイルの書き込みはGILを解放するので、合成処理と並行に動く。
+        self.executor = ThreadPoolExecutor(writers) if 0 < writers and stage_threads is None else None
+
+        # stage_threadsを指定した場合は、JPEGの圧縮とファイルの書き込みを、それぞれのスレッドの数のステージに分ける。
+        self.pipeline = None
+        if stage_threads is not None:
+            encode_threads, write_threads = stage_threads
+            self.pipeline = Pipeline([ ("encode", self.encode, encode_threads), ("write", self.write_data, write_threads) ])
+
+        # 書き込み中の画像の最大数。メモリに溜まる画像の数はこれで抑えられる。
+        self.max_queue = max(1, max_queue)
+
+        # 書き込み中の画像のキュー
+        self.pending = deque()
+
+        # shard_sizeが0なら画像ごとにファイルを書き、1以上ならシャード ファイルに追記する。
+        img_dir = f'{output_dir}/img' if shard_size == 0 else f'{output_dir}/shards'
+        if os.path.isdir(img_dir) and resume is None and base is None:
+            # フォルダがすでにあって、途中から再開するのでも既存の学習データに追加するのでもない場合
 
             # フォルダを削除する。
             shutil.rmtree(img_dir)
 
         os.makedirs(img_dir, exist_ok=True)
 
+        self.shards = ShardWriter(img_dir, shard_size) if 0 < shard_size else None
+
+        if self.shards is not None:
+            if resume is not None:
+                # チェックポイントの後で追記した部分を捨てる。
+                self.shards.resume(*resume["shard"])
+
+            elif base is not None:
+                # 既存の学習データの最後のシャード ファイルに追記する。
+                last = max([ (x["shard"], x["offset"] + x["length"]) for x in base["images"] if "shard" in x ], default=(-1, 0))
+                self.shards.resume(*last)
+
         self.AnnoObj = {
             "annotations":[],
             "images":[],
             "categories":[]
         }
 
-        for idx, img_class in enumerate(image_classes):
+        if base is not None:
+            # 既存の学習データに追加する場合は、既存のカテゴリーのidは変えない。
+            self.AnnoObj["annotations"] = list(base["annotations"])
+            self.AnnoObj["images"] = list(base["images"])
+            self.AnnoObj["categories"] = list(base["categories"])
+
+        # カテゴリーの名前からidへの辞書
+        category_ids = { x["name"] : x["id"] for x in self.AnnoObj["categories"] }
+
+        for img_class in image_classes:
+            if img_class.name in category_ids:
+                continue
+
             o = {
                 "supercategory": f'super-{img_class.name}',
-                "id": idx,
+                "id": max(category_ids.values(), default=-1) + 1,
                 "name": img_class.name
             }
 
             self.AnnoObj["categories"].append(o)
+            category_ids[img_class.name] = o["id"]
+
+        # クラスのインデックスからカテゴリーのidへのリスト
+        self.class_ids = [ category_ids[x.name] for x in image_classes ]
+
+        if resume is not None:
+            # チェックポイントまでに作った画像とアノテーション
+            self.AnnoObj["images"] += resume["images"]
+            self.AnnoObj["annotations"] += resume["annotations"]
+
+        # 次の画像とアノテーションのid
+        self.next_image_id = max([ x["id"] for x in self.AnnoObj["images"] ], default=0) + 1
+        self.next_anno_id  = max([ x["id"] for x in self.AnnoObj["annotations"] ], default=0) + 1
+
+        # チェックポイントに保存した画像とアノテーションの数
+        self.checkpointed = (len(self.AnnoObj["images"]), len(self.AnnoObj["annotations"]))
 
     def images_cnt(self):
         return len(self.AnnoObj["images"])
@@ -39,26 +101,43 @@ class ODTK:
     def add_image(self, class_idx, video_idx, pos, compo_img, box_infos):
         height, width = compo_img.shape[:2]
 
-        image_id = len(self.AnnoObj["images"]) + 1
+        image_id = self.next_image_id
+        self.next_image_id += 1
 
-        file_name = f'{class_idx}-{video_idx}-{pos}-{image_id}.jpg'
+        category_id = self.class_ids[class_idx]
 
-        img_path = f'{self.output_dir}/img/{file_name}'
-        cv2.imwrite(img_path, compo_img)
+        file_name = f'{category_id}-{video_idx}-{pos}-{image_id}.jpg'
 
-        self.AnnoObj["images"].append({
+        img_inf = {
             "id" : image_id,
             "width": width,
             "height": height,
             "file_name" : file_name            
-        })
+        }
+        self.AnnoObj["images"].append(img_inf)
+
+        img_path = f'{self.output_dir}/img/{file_name}'
+        if self.executor is None and self.pipeline is None:
+            self.finish(img_inf, self.write(img_path, compo_img))
+        else:
+            while len(self.pending) >= self.max_queue:
+                # キューが一杯の場合は、最も古い書き込みが終わるのを待つ。(書き込みのエラーはここで起こる)
+                self.wait_oldest()
+
+            if self.pipeline is not None:
+                future = self.pipeline.submit((img_path, compo_img))
+            else:
+                future = self.executor.submit(self.write, img_path, compo_img)
+
+            self.pending.append((future, img_inf))
 
         for box, corners2, bounding_box in box_infos:
-            anno_id = len(self.AnnoObj["annotations"]) + 1
+            anno_id = self.next_anno_id
+            self.next_anno_id += 1
             self.AnnoObj["annotations"].append({
                 "id" : anno_id,
                 "image_id" : image_id, 
-                "category_id" : class_idx,
+                "category_id" : category_id,
                 "bbox" : bounding_box ,
                 "segmentation" : corners2,
                 "area": bounding_box[2] * bounding_box[3],           # w * h. Required for validation scores
@@ -66,24 +145,103 @@ class ODTK:
             })
 
 
+    def write(self, img_path, img):
+        # 画像ごとのファイルの場合は書き込みまでして、シャード ファイルの場合は圧縮だけする。
+        with profiler.Stage('write'):
+            if self.shards is None:
+                write_image(img_path, img)
+                return None
+
+            return encode_image(img)
+
+    def encode(self, item):
+        # パイプラインのencodeのステージで、画像をJPEGに圧縮する。
+        img_path, img = item
+
+        with profiler.Stage('encode'):
+            return img_path, encode_image(img)
+
+    def write_data(self, item):
+        # パイプラインのwriteのステージで、画像ごとのファイルを書く。シャード ファイルにはfinishで画像idの順に追記する。
+        img_path, data = item
+        if self.shards is not None:
+            return data
+
+        with profiler.Stage('write'):
+            write_data(img_path, data)
+
+        return None
+
+    def finish(self, img_inf, data):
+        # シャード ファイルには圧縮が終わった順ではなく、画像idの順に追記する。
+        if self.shards is not None:
+            img_inf["shard"], img_inf["offset"], img_inf["length"] = self.shards.append(data)
+
+    def wait_oldest(self):
+        future, img_inf = self.pending.popleft()
+        self.finish(img_inf, future.result())
+
+    def flush(self):
+        # 書き込み中の画像がすべて書き終わるのを待つ。
+        while len(self.pending) != 0:
+            self.wait_oldest()
+
+    def take_checkpoint(self):
+        # 書き込み中の画像を待ってから、前回のチェックポイントから増えた画像とアノテーションと、シャード ファイルの書き込み位置を返す。
+        self.flush()
+
+        n_images, n_annotations = self.checkpointed
+        self.checkpointed = (len(self.AnnoObj["images"]), len(self.AnnoObj["annotations"]))
+
+        shard = [ self.shards.shard, self.shards.offset ] if self.shards is not None else None
+
+        return self.AnnoObj["images"][n_images:], self.AnnoObj["annotations"][n_annotations:], shard
+
+    def close(self):
+        if self.executor is not None:
+            # 書き込み中の画像は待たずにスレッドを止める。
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+            self.pending.clear()
+
+        if self.pipeline is not None:
+            # 書き込み中の画像は待たずにスレッドを止める。
+            self.pipeline.close()
+            self.pipeline = None
+            self.pending.clear()
+
+        if self.shards is not None:
+            self.shards.close()
+
     def save(self):
+        try:
+            self.flush()
+        finally:
+            self.close()
+
         with open(f'{self.output_dir}/train.json', 'w') as f:
             json.dump(self.AnnoObj, f, indent=4)
 
 
+def write_image(img_path, img):
+    if not cv2.imwrite(img_path, img):
+        raise IOError(f'画像ファイルを書けません。{img_path}')
+
+def write_data(img_path, data):
+    with open(img_path, 'wb') as f:
+        f.write(data)
+
+def encode_image(img):
+    ret, buf = cv2.imencode('.jpg', img)
+    if not ret:
+        raise IOError('画像を圧縮できません。')
+
+    return buf.tobytes()
 
 # how to define theta
 # https://github.com/NVIDIA/retinanet-examples/issues/183#issuecomment-617860660
 def _corners2rotatedbbox(corners):
-    corners = np.array(corners)
-    center = np.mean(np.array(corners), 0)
-    theta = calc_bearing(corners[0], corners[1])
-    rotation = np.array([[np.cos(theta), -np.sin(theta)],
-                         [np.sin(theta), np.cos(theta)]])
-    out_points = np.matmul(corners - center, rotation) + center
-    x, y = list(out_points[0,:])
-    w, h = list(out_points[2, :] - out_points[0, :])
-    return [x, y, w, h, theta]
+    return corners2rotatedbbox_batch(np.array([ corners ]))[0].tolist()
 
 def calc_bearing(point1, point2):
     x1, y1 = point1
@@ -93,10 +251,4 @@ def calc_bearing(point1, point2):
     return theta
 
 def nor_theta(theta):
-    if theta > math.radians(45):
-        theta -= math.radians(90)
-        theta = nor_theta(theta)
-    elif theta <= math.radians(-45):
-        theta += math.radians(90)
-        theta = nor_theta(theta)
-    return theta
+    return float(nor_thetas(theta))
@@ -0,0 +1,207 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future, CancelledError
+
+stats = {}
+"""ステージ名から、スレッドの数と処理した数と処理時間(秒)と次のステージのキューの空きを待った時間(秒)への辞書"""
+
+lock = threading.Lock()
+"""統計を足すためのロック"""
+
+def add_stats(name : str, threads : int, items : int, busy : float, blocked : float = 0.0):
+    """ステージの統計を足す。
+
+    Args:
+        name : ステージ名
+        threads : スレッドの数
+        items : 処理した数
+        busy : 処理時間の合計(秒)
+        blocked : 次のステージのキューの空きを待った時間の合計(秒)
+    """
+    with lock:
+        total = stats.setdefault(name, { "threads" : 0, "items" : 0, "busy" : 0.0, "blocked" : 0.0 })
+
+        total["threads"] = max(total["threads"], threads)
+        total["items"] += items
+        total["busy"] += busy
+        total["blocked"] += blocked
+
+def take_stats() -> dict:
+    """ステージの統計を返して、0に戻す。
+
+    Returns: ステージの統計
+    """
+    global stats
+
+    with lock:
+        ret = stats
+        stats = {}
+
+    return ret
+
+def format_stats(total : dict, elapsed : float) -> str:
+    """ステージの使用率を表示用の文字列にする。
+
+    使用率は 処理時間 / (経過時間 × スレッドの数)。使用率が最も高いステージがボトルネックになる。
+
+    Args:
+        total : ステージの統計
+        elapsed : 経過時間(秒)
+
+    Returns: 表示用の文字列
+    """
+    lines = [ f'{"ステージ":<10} {"スレッド":>6} {"処理数":>8} {"処理(秒)":>9} {"待ち(秒)":>9} {"使用率":>7}' ]
+
+    usage = {}
+    for name, st in total.items():
+        usage[name] = st["busy"] / max(1e-9, elapsed * max(1, st["threads"]))
+        lines.append(f'{name:<10} {st["threads"]:>6} {st["items"]:>8} {st["busy"]:>9.2f} {st["blocked"]:>9.2f} {100 * usage[name]:>6.1f}%')
+
+    if len(usage) != 0:
+        lines.append(f'経過時間 {elapsed:.2f}秒, ボトルネック: {max(usage, key=usage.get)}')
+
+    return '\n'.join(lines)
+
+class Pipeline:
+    """有限のキューでつないだステージで、投入したものを順に処理する。
+
+    ステージごとに指定した数のスレッドで処理する。OpenCVの処理はGILを解放するので、スレッドは並行に動く。
+    同じステージの中では処理が終わる順は投入した順と限らないので、submitが返すFutureを投入した順に待つ。
+    最後のステージの関数がFutureを返した場合は、その結果を待たずに次を処理する。(処理時間にはFutureの処理の時間を含まない)
+    """
+    def __init__(self, stages : list, max_queue : int = 8):
+        """
+        Args:
+            stages : ステージ名, 処理する関数, スレッドの数 のリスト。関数は前のステージの関数の戻り値を受け取る。
+            max_queue : ステージごとのキューに溜める最大数
+        """
+        self.stages = [ (name, func, max(1, threads)) for name, func, threads in stages ]
+        """ステージ名, 処理する関数, スレッドの数 のリスト"""
+
+        self.queues = [ queue.Queue(max(1, max_queue)) for _ in self.stages ]
+        """ステージごとの、処理を待つFutureと引数のキュー"""
+
+        self.items = [ 0 ] * len(self.stages)
+        """ステージごとの処理した数"""
+
+        self.busy = [ 0.0 ] * len(self.stages)
+        """ステージごとの処理時間の合計(秒)"""
+
+        self.blocked = [ 0.0 ] * len(self.stages)
+        """ステージごとの、次のステージのキューの空きを待った時間の合計(秒)"""
+
+        self.lock = threading.Lock()
+        """ステージごとの統計を更新するためのロック"""
+
+        self.closed = False
+        """閉じた後はTrue。キューに残っているものは処理しない。"""
+
+        self.threads = []
+        """ステージごとのスレッドのリスト"""
+
+        for idx, (name, func, threads) in enumerate(self.stages):
+            self.threads.append([ threading.Thread(target=self.run, args=(idx,), daemon=True) for _ in range(threads) ])
+
+            for thread in self.threads[-1]:
+                thread.start()
+
+    def submit(self, item) -> Future:
+        """最初のステージに投入する。最初のステージのキューが一杯の場合は空きを待つ。
+
+        Args:
+            item : 最初のステージの関数の引数
+
+        Returns: 最後のステージの関数の戻り値のFuture
+        """
+        future = Future()
+        self.queues[0].put((future, item))
+
+        return future
+
+    def run(self, idx : int):
+        """ステージのキューから取り出して処理する。(ステージのスレッドで実行する)
+
+        Args:
+            idx : ステージのインデックス
+        """
+        name, func, threads = self.stages[idx]
+
+        while True:
+            job = self.queues[idx].get()
+            if job is None:
+                # 終わりの印の場合
+                break
+
+            future, item = job
+
+            if self.closed:
+                continue
+
+            if idx == 0 and not future.set_running_or_notify_cancel():
+                # 処理を始める前にキャンセルされた場合
+                continue
+
+            start = time.perf_counter()
+            try:
+                result = func(item)
+
+            except BaseException as e:
+                future.set_exception(e)
+                continue
+
+            busy = time.perf_counter() - start
+
+            blocked = 0.0
+            if idx + 1 < len(self.stages):
+                # 次のステージのキューに入れる。
+                start = time.perf_counter()
+                self.queues[idx + 1].put((future, result))
+                blocked = time.perf_counter() - start
+
+            elif isinstance(result, Future):
+                # ワーカー プロセスのプールなどに投入した場合は、終わったときに結果をセットする。
+                result.add_done_callback(lambda done, future=future: self.chain(future, done))
+
+            else:
+                future.set_result(result)
+
+            with self.lock:
+                self.items[idx] += 1
+                self.busy[idx] += busy
+                self.blocked[idx] += blocked
+
+    def chain(self, future : Future, done : Future):
+        """最後のステージの関数が返したFutureの結果を、submitが返したFutureにセットする。
+
+        Args:
+            future : submitが返したFuture
+            done : 最後のステージの関数が返した、終わったFuture
+        """
+        if done.cancelled():
+            future.set_exception(CancelledError())
+
+        elif done.exception() is not None:
+            future.set_exception(done.exception())
+
+        else:
+            future.set_result(done.result())
+
+    def close(self):
+        """キューに残っているものは捨てて、スレッドを止める。ステージの統計を足す。
+        """
+        if self.closed:
+            return
+
+        self.closed = True
+
+        # 前のステージから順に、スレッドの数だけ終わりの印を入れて、終わるのを待つ。
+        for idx, threads in enumerate(self.threads):
+            for _ in threads:
+                self.queues[idx].put(None)
+
+            for thread in threads:
+                thread.join()
+
+        for idx, (name, func, threads) in enumerate(self.stages):
+            add_stats(name, threads, self.items[idx], self.busy[idx], self.blocked[idx])
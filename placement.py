@@ -0,0 +1,213 @@
+import math
+import time
+import numpy as np
+import cv2
+from geometry import random_transforms, rotate_corners_batch, transform_points
+import profiler
+
+stats = { "attempts" : 0, "placements" : 0, "seconds" : 0.0 }
+"""このプロセスでの配置の試行回数, 配置した物体の数, 配置にかかった時間(秒)"""
+
+def take_stats() -> dict:
+    """配置の統計を返して、0に戻す。
+
+    Returns: 配置の統計
+    """
+    global stats
+
+    ret = stats
+    stats = { "attempts" : 0, "placements" : 0, "seconds" : 0.0 }
+
+    return ret
+
+def add_stats(total : dict, delta : dict):
+    """配置の統計を足し合わせる。
+
+    Args:
+        total : 足し合わせる先の統計
+        delta : 足す統計
+    """
+    for key, val in delta.items():
+        total[key] = total.get(key, 0) + val
+
+def format_stats(total : dict) -> str:
+    """配置の統計を表示用の文字列にする。
+
+    Args:
+        total : 配置の統計
+
+    Returns: 表示用の文字列
+    """
+    rate = total["placements"] / total["seconds"] if 0 < total["seconds"] else 0
+
+    return f'配置: {total["placements"]}個 / 試行 {total["attempts"]}回, {rate:.1f}個/秒'
+
+class PlacementEngine:
+    """貼り付け先の画像の空き領域を格子で管理して、物体を重ならないように配置する。
+
+    物体の拡大率と回転角を決めてから、回転した外接矩形が置ける格子の中からだけ位置を選ぶので、
+    乱数で決めた変換行列を捨てることがほとんどない。
+    """
+    def __init__(self, img_size : int, grid_size : int = 64, gap_ratio : float = 0.02):
+        self.imgSize = img_size
+        """貼り付け先の画像のサイズ"""
+
+        self.gridSize = grid_size
+        """格子の縦と横の数"""
+
+        self.cell = img_size / grid_size
+        """格子の1辺の画素数"""
+
+        # 位置を格子の内部で動かす分と、物体どうしの間隔の分だけ、物体の領域を広げる格子の数
+        self.padCells = 1 + int(math.ceil(gap_ratio * img_size / self.cell))
+
+        self.occupied = np.zeros((grid_size, grid_size), dtype=np.uint8)
+        """物体が置かれた格子は1"""
+
+    def footprint_kernel(self, rel_corners : np.ndarray) -> np.ndarray:
+        """中心からの相対位置で表した回転した外接矩形を、格子の上のカーネルにする。
+
+        Args:
+            rel_corners : 外接矩形の頂点の中心からの相対位置
+
+        Returns: 物体の間隔の分だけ広げたカーネル
+        """
+        grid_corners = rel_corners / self.cell
+
+        # カーネルの中心から端までの格子の数
+        half = int(math.ceil(np.abs(grid_corners).max())) + self.padCells
+        kernel = np.zeros((2 * half + 1, 2 * half + 1), dtype=np.uint8)
+
+        # 外接矩形を塗りつぶす。(座標は1/16画素の精度で渡す)
+        pts = np.round((grid_corners + half) * 16).astype(np.int32)
+        cv2.fillConvexPoly(kernel, pts, 1, lineType=cv2.LINE_8, shift=4)
+
+        # 物体どうしの間隔の分だけ広げる。
+        size = 2 * self.padCells + 1
+        kernel = cv2.dilate(kernel, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (size, size)))
+
+        return kernel
+
+    def feasible_cells(self, kernel : np.ndarray, radius : float) -> np.ndarray:
+        """物体の中心を置ける格子のインデックスを返す。
+
+        Args:
+            kernel : 物体のカーネル
+            radius : 中心から外接矩形の頂点までの最大の距離
+
+        Returns: 中心を置ける格子の平らにしたインデックスの配列
+        """
+        # すでに置かれた物体と重ならない位置。(画像の外は空いているとみなす)
+        free = cv2.erode(1 - self.occupied, kernel, borderType=cv2.BORDER_CONSTANT, borderValue=1)
+
+        # 外接矩形が画像の内部に収まる位置
+        lo = int(math.ceil(radius / self.cell))
+        hi = int(math.floor((self.imgSize - radius) / self.cell))
+        if hi <= lo:
+            return np.zeros(0, dtype=np.int64)
+
+        inside = np.zeros_like(free)
+        inside[lo:hi, lo:hi] = 1
+
+        return np.flatnonzero(free & inside)
+
+    def place(self, contour : np.ndarray, box : np.ndarray, count : int, max_attempts : int = 20) -> list:
+        """物体を重ならないように配置する変換行列を返す。
+
+        Args:
+            contour : 輪郭
+            box : 回転を考慮した外接矩形の頂点
+            count : 配置する物体の数
+            max_attempts : 拡大率と回転角を決め直す最大の回数
+
+        Returns: 変換行列と変換後の外接矩形の頂点のペアのリスト。頂点は最初の頂点から2番目の頂点へ向かう辺の角度が±45°以下になる順番。
+        """
+        start = time.perf_counter()
+
+        # 最小外接円の中心と半径
+        (cx, cy), radius = cv2.minEnclosingCircle(contour)
+
+        # 物体の直径
+        diameter = 2 * radius
+
+        # 最大スケール = 画像の短辺の30% ÷ 物体の直径
+        max_scale = (0.3 * self.imgSize) / diameter
+
+        # 最小スケール = 画像の短辺の20% ÷ 物体の直径
+        min_scale = (0.2 * self.imgSize) / diameter
+
+        # すべての試行の分の変換行列をまとめて乱数で決める。平行移動は、後で格子から選んだ位置に置き換える。
+        candidates = random_transforms(contour, self.imgSize, max_attempts)
+
+        # 変換行列の拡大率が、スケールの範囲の中のどの位置か
+        scale_ratios = (np.hypot(candidates[:, 0, 0], candidates[:, 0, 1]) - min_scale) / (max_scale - min_scale)
+
+        # 変換後の外接矩形の頂点の、最小外接円の中心からの相対位置
+        centers = transform_points(candidates, [ (cx, cy) ])
+        all_rel_corners = transform_points(candidates, box) - centers
+
+        # 最初の頂点から2番目の頂点へ向かう辺の角度が±45°以下になるように、頂点の順番をまとめて変える。
+        all_rel_corners, all_ok = rotate_corners_batch(all_rel_corners)
+
+        placements = []
+        attempts = 0
+        while len(placements) < count and attempts < max_attempts:
+            M = candidates[attempts].copy()
+
+            # 置ける位置がなかった後は、スケールの範囲の中の同じ位置まで小さくする。
+            scale = min_scale + scale_ratios[attempts] * (max_scale - min_scale)
+            ratio = scale / np.hypot(M[0, 0], M[0, 1])
+
+            # 外接矩形の頂点の、最小外接円の中心からの相対位置
+            rel_corners = ratio * all_rel_corners[attempts]
+
+            ok = all_ok[attempts]
+
+            attempts += 1
+
+            if not ok:
+                print('slope is None')
+                profiler.count('配置: slope is None')
+
+                continue
+
+            # 中心から外接矩形の頂点と物体の端までの最大の距離
+            reach = max(float(np.sqrt((rel_corners ** 2).sum(axis=1)).max()), scale * radius)
+
+            with profiler.Stage('attempt'):
+                cells = self.feasible_cells(self.footprint_kernel(rel_corners), reach)
+
+            if len(cells) == 0:
+                # 置ける位置がない場合は、次はもっと小さくする。
+
+                profiler.count('配置: 置ける位置がない')
+
+                max_scale = max(min_scale, scale)
+                continue
+
+            # 置ける格子から乱数で選んで、格子の内部で位置を動かす。
+            row, col = divmod(cells[np.random.randint(len(cells))], self.gridSize)
+            jx, jy = np.random.random(2)
+            tx = min(max((col + jx) * self.cell, reach), self.imgSize - reach)
+            ty = min(max((row + jy) * self.cell, reach), self.imgSize - reach)
+
+            # 回転とスケールを変えて、最小外接円の中心が選んだ位置に移るように平行移動を置き換える。
+            M[:, :2] *= ratio
+            M[:, 2] = (tx, ty) - M[:, :2] @ (cx, cy)
+
+            corners2 = rel_corners + np.array([tx, ty])
+
+            # 物体が置かれた格子を記録する。
+            pts = np.round(corners2 / self.cell * 16).astype(np.int32)
+            cv2.fillConvexPoly(self.occupied, pts, 1, lineType=cv2.LINE_8, shift=4)
+
+            placements.append((M, corners2))
+
+        # 試行回数の上限までに配置できなかった物体の数
+        profiler.count('配置: 物体の数が足りない', count - len(placements))
+
+        stats["attempts"] += attempts
+        stats["placements"] += len(placements)
+        stats["seconds"] += time.perf_counter() - start
+
+        return placements
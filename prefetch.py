@@ -0,0 +1,369 @@
+import time
+import threading
+from collections import deque
+import cv2
+import profiler
+
+stats = { "frames" : 0, "decode" : 0.0, "consumer_stall" : 0.0, "producer_stall" : 0.0 }
+"""デコードしたフレームの数とデコードの時間と、フレームを取り出す側と溜める側が待った時間(秒)"""
+
+def take_stats() -> dict:
+    """先読みの統計を返して、0に戻す。
+
+    Returns: 先読みの統計
+    """
+    global stats
+
+    ret = stats
+    stats = { "frames" : 0, "decode" : 0.0, "consumer_stall" : 0.0, "producer_stall" : 0.0 }
+
+    return ret
+
+def format_stats(total : dict) -> str:
+    """先読みの統計を表示用の文字列にする。
+
+    Args:
+        total : 先読みの統計
+
+    Returns: 表示用の文字列
+    """
+    return f'先読み: {total["frames"]}フレーム, デコード {total["decode"]:.2f}秒, 取り出す側の待ち {total["consumer_stall"]:.2f}秒, デコードする側の待ち {total["producer_stall"]:.2f}秒'
+
+class RingBuffer:
+    """スレッドの間でフレームを受け渡す、固定長のリング バッファ。
+
+    いっぱいのときは溜める側が待ち、空のときは取り出す側が待つ。待った時間を記録する。
+    """
+    def __init__(self, size : int):
+        """
+        Args:
+            size : 溜めるフレームの最大数
+        """
+        self.slots = [ None ] * max(1, size)
+        """フレームを溜める枠"""
+
+        self.head = 0
+        """次に取り出す枠のインデックス"""
+
+        self.count = 0
+        """溜めているフレームの数"""
+
+        self.finished = False
+        """溜める側が終わったらTrue"""
+
+        self.closed = False
+        """取り出す側が止めたらTrue"""
+
+        self.cond = threading.Condition()
+        """枠の空きとフレームを待つための条件変数"""
+
+        self.producerStall = 0.0
+        """溜める側が空きを待った時間(秒)"""
+
+        self.consumerStall = 0.0
+        """取り出す側がフレームを待った時間(秒)"""
+
+    def put(self, item) -> bool:
+        """フレームを溜める。いっぱいの場合は空きができるまで待つ。
+
+        Args:
+            item : 溜めるもの
+
+        Returns: 取り出す側が止めた場合はFalse
+        """
+        with self.cond:
+            if self.count == len(self.slots) and not self.closed:
+                start = time.perf_counter()
+                while self.count == len(self.slots) and not self.closed:
+                    self.cond.wait()
+
+                self.producerStall += time.perf_counter() - start
+
+            if self.closed:
+                return False
+
+            self.slots[(self.head + self.count) % len(self.slots)] = item
+            self.count += 1
+            self.cond.notify_all()
+
+            return True
+
+    def get(self):
+        """フレームを取り出す。空の場合は溜まるまで待つ。
+
+        Returns: 溜めたもの (溜める側が終わった後で空の場合はNone)
+        """
+        with self.cond:
+            if self.count == 0 and not self.finished:
+                start = time.perf_counter()
+                while self.count == 0 and not self.finished:
+                    self.cond.wait()
+
+                self.consumerStall += time.perf_counter() - start
+
+            if self.count == 0:
+                return None
+
+            item = self.slots[self.head]
+            self.slots[self.head] = None
+            self.head = (self.head + 1) % len(self.slots)
+            self.count -= 1
+            self.cond.notify_all()
+
+            return item
+
+    def finish(self):
+        """溜める側が終わったことを知らせる。
+        """
+        with self.cond:
+            self.finished = True
+            self.cond.notify_all()
+
+    def close(self):
+        """溜めたフレームを捨てて、溜める側を止める。
+        """
+        with self.cond:
+            self.closed = True
+            self.slots = [ None ] * len(self.slots)
+            self.count = 0
+            self.cond.notify_all()
+
+class VideoPrefetcher:
+    """動画ファイルのフレームを、バックグラウンドのスレッドでデコードしてリング バッファに溜める。
+
+    positionsを指定した場合は、そのフレームだけを grab() と retrieve() で読む。
+    指定しない場合は、すべてのフレームを順に読む。この場合は cv2.VideoCapture の代わりに read(), get(), set() で使える。
+    OpenCVはデコード中はGILを解放するので、デコードと合成の処理が重なる。
+    """
+    def __init__(self, video_path : str, positions = None, size : int = 8):
+        """
+        Args:
+            video_path : 動画ファイルのパス
+            positions : 読むフレームのインデックスの昇順の配列。Noneならすべてのフレーム。
+            size : リング バッファに溜めるフレームの最大数
+        """
+        self.videoPath = video_path
+        """動画ファイルのパス"""
+
+        self.positions = positions
+        """読むフレームのインデックスの配列"""
+
+        self.size = size
+        """リング バッファに溜めるフレームの最大数"""
+
+        self.pos = 0
+        """最後に取り出したフレームの次のフレームのインデックス"""
+
+        self.end = None
+        """動画ファイルの終わりより後で読めなかった、最初のフレームのインデックス"""
+
+        self.frames = 0
+        """デコードしたフレームの数"""
+
+        self.decodeTime = 0.0
+        """デコードの時間(秒)"""
+
+        self.ring = None
+        """リング バッファ"""
+
+        self.thread = None
+        """デコードするスレッド"""
+
+        self.start(0)
+
+    def start(self, pos : int):
+        """デコードするスレッドを開始する。
+
+        Args:
+            pos : 最初に読むフレームのインデックス (positionsを指定しない場合)
+        """
+        self.ring = RingBuffer(self.size)
+        self.thread = threading.Thread(target=self.decode, args=(self.ring, pos), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """デコードするスレッドを止めて、統計を足す。
+        """
+        if self.thread is None:
+            return
+
+        self.ring.close()
+        self.thread.join()
+        self.thread = None
+
+        stats["frames"] += self.frames
+        stats["decode"] += self.decodeTime
+        stats["consumer_stall"] += self.ring.consumerStall
+        stats["producer_stall"] += self.ring.producerStall
+
+        self.frames, self.decodeTime = 0, 0.0
+
+    def decoded(self, start : float):
+        """1フレームのデコードの時間を記録する。
+
+        Args:
+            start : デコードを始めた時刻
+        """
+        sec = time.perf_counter() - start
+
+        self.frames += 1
+        self.decodeTime += sec
+
+        if profiler.enabled:
+            profiler.record('read', sec)
+
+    def decode(self, ring : RingBuffer, pos : int):
+        """フレームをデコードしてリング バッファに溜める。(デコードするスレッドで実行する)
+
+        Args:
+            ring : リング バッファ
+            pos : 最初に読むフレームのインデックス (positionsを指定しない場合)
+        """
+        cap = cv2.VideoCapture(self.videoPath)
+
+        try:
+            if self.positions is None:
+                # すべてのフレームを順に読む場合
+
+                if 0 < pos:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, pos)
+
+                while True:
+                    start = time.perf_counter()
+                    ret, frame = cap.read()
+                    if not ret:
+                        break
+
+                    self.decoded(start)
+
+                    if not ring.put((int(cap.get(cv2.CAP_PROP_POS_FRAMES)) - 1, frame)):
+                        break
+
+                return
+
+            # 次に読むフレームのインデックス
+            next_idx = 0
+
+            for frame_idx in self.positions:
+                if frame_idx == next_idx - 1:
+                    # 同じフレームが続く場合は、デコードした原画をもう一度溜める。
+                    if not ring.put((int(frame_idx), frame)):
+                        break
+
+                    continue
+
+                start = time.perf_counter()
+
+                # 使わないフレームはデコードせずに読み飛ばす。
+                while next_idx < frame_idx and cap.grab():
+                    next_idx += 1
+
+                if next_idx == frame_idx and cap.grab():
+                    ret, frame = cap.retrieve()
+                else:
+                    ret = False
+
+                if not ret:
+                    # 動画ファイルのフレーム数が実際より多い場合
+
+                    self.end = int(frame_idx)
+                    break
+
+                self.decoded(start)
+
+                next_idx += 1
+
+                if not ring.put((int(frame_idx), frame)):
+                    break
+
+        finally:
+            cap.release()
+            ring.finish()
+
+    def __iter__(self):
+        """溜めたフレームを順に取り出す。
+
+        Returns: フレームのインデックス, 原画 を返すジェネレータ
+        """
+        while True:
+            item = self.ring.get()
+            if item is None:
+                break
+
+            self.pos = item[0] + 1
+
+            yield item
+
+    def read(self):
+        """次のフレームを取り出す。(cv2.VideoCapture.read と同じ形)
+
+        Returns: 取り出せたらTrue, 原画
+        """
+        item = self.ring.get()
+        if item is None:
+            return False, None
+
+        self.pos = item[0] + 1
+
+        return True, item[1]
+
+    def get(self, prop_id : int) -> float:
+        """次に取り出すフレームの位置を返す。(cv2.CAP_PROP_POS_FRAMES だけ)
+        """
+        assert prop_id == cv2.CAP_PROP_POS_FRAMES
+
+        return self.pos
+
+    def set(self, prop_id : int, pos : float) -> bool:
+        """溜めたフレームを捨てて、指定した位置からデコードし直す。(cv2.CAP_PROP_POS_FRAMES だけ)
+        """
+        assert prop_id == cv2.CAP_PROP_POS_FRAMES and self.positions is None
+
+        self.stop()
+        self.pos = int(pos)
+        self.start(self.pos)
+
+        return True
+
+    def release(self):
+        """デコードするスレッドを止める。
+        """
+        self.stop()
+
+def prefetch_videos(jobs : list, threads : int = 1, size : int = 8):
+    """複数の動画ファイルの選んだフレームを、threads個の動画ファイルまで同時に先読みしながら、順に返す。
+
+    Args:
+        jobs : 動画ファイルのパスと、読むフレームのインデックスの昇順の配列 のリスト
+        threads : 同時にデコードする動画ファイルの数
+        size : 動画ファイルごとのリング バッファに溜めるフレームの最大数
+
+    Returns: jobsのインデックス, フレームのインデックス, 原画 を返すジェネレータ。
+        動画ファイルの終わりより後のフレームがあった場合は、最初のそのフレームのインデックスと原画の代わりにNoneを返す。
+    """
+    # 先読み中の動画ファイル
+    readers = deque()
+
+    # 次に先読みを始めるjobsのインデックス
+    next_job = 0
+
+    try:
+        for job_idx in range(len(jobs)):
+            while next_job < len(jobs) and len(readers) < max(1, threads):
+                readers.append(VideoPrefetcher(*jobs[next_job], size=size))
+                next_job += 1
+
+            reader = readers.popleft()
+            try:
+                for frame_idx, frame in reader:
+                    yield job_idx, frame_idx, frame
+
+                if reader.end is not None:
+                    yield job_idx, reader.end, None
+
+            finally:
+                reader.release()
+
+    finally:
+        for reader in readers:
+            reader.release()
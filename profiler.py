@@ -0,0 +1,165 @@
+import time
+import threading
+import numpy as np
+
+enabled = False
+"""Trueなら処理時間と棄却の回数を記録する。"""
+
+edges = np.logspace(-6, 1, 29)
+"""処理時間のヒストグラムの区間の境界(秒)。1マイクロ秒から10秒まで、1桁を4区間に分ける。"""
+
+timings = {}
+"""ステージ名から、処理時間のヒストグラムと合計時間と最大時間への辞書"""
+
+counts = {}
+"""棄却の理由から回数への辞書"""
+
+lock = threading.Lock()
+"""画像ファイルを書くスレッドからも記録するためのロック"""
+
+class Stage:
+    """with文の中の処理時間を、ステージの処理時間として記録する。
+    """
+    def __init__(self, name : str):
+        self.name = name
+        """ステージ名"""
+
+    def __enter__(self):
+        if enabled:
+            self.start = time.perf_counter()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if enabled:
+            record(self.name, time.perf_counter() - self.start)
+
+def record(name : str, seconds : float):
+    """ステージの処理時間を記録する。
+
+    Args:
+        name : ステージ名
+        seconds : 処理時間(秒)
+    """
+    with lock:
+        timing = timings.get(name)
+        if timing is None:
+            timing = { "hist" : np.zeros(len(edges) + 1, dtype=np.int64), "total" : 0.0, "max" : 0.0 }
+            timings[name] = timing
+
+        timing["hist"][np.searchsorted(edges, seconds)] += 1
+        timing["total"] += seconds
+        timing["max"] = max(timing["max"], seconds)
+
+def count(reason : str, n : int = 1):
+    """棄却の回数を記録する。
+
+    Args:
+        reason : 棄却の理由
+        n : 回数
+    """
+    if enabled and 0 < n:
+        with lock:
+            counts[reason] = counts.get(reason, 0) + n
+
+def take() -> dict:
+    """このプロセスで記録した処理時間と棄却の回数を返して、0に戻す。
+
+    Returns: 処理時間と棄却の回数
+    """
+    global timings, counts
+
+    with lock:
+        ret = { "timings" : timings, "counts" : counts }
+        timings, counts = {}, {}
+
+    return ret
+
+def merge(data : dict):
+    """ワーカー プロセスで記録した処理時間と棄却の回数を、このプロセスの記録に足す。
+
+    Args:
+        data : takeで得た処理時間と棄却の回数
+    """
+    with lock:
+        for name, timing in data["timings"].items():
+            total = timings.get(name)
+            if total is None:
+                timings[name] = { "hist" : timing["hist"].copy(), "total" : timing["total"], "max" : timing["max"] }
+            else:
+                total["hist"] += timing["hist"]
+                total["total"] += timing["total"]
+                total["max"] = max(total["max"], timing["max"])
+
+        for reason, n in data["counts"].items():
+            counts[reason] = counts.get(reason, 0) + n
+
+def percentile(hist : np.ndarray, q : float, max_sec : float) -> float:
+    """ヒストグラムから処理時間のパーセンタイルを求める。(区間の上端の値なので、実際より少し大きい)
+
+    Args:
+        hist : 処理時間のヒストグラム
+        q : 0から1の割合
+        max_sec : 処理時間の最大値(秒)。区間の上端がこれより大きい場合はこれを返す。
+
+    Returns: 処理時間(秒)
+    """
+    idx = int(np.searchsorted(np.cumsum(hist), q * hist.sum()))
+
+    return min(float(edges[min(idx, len(edges) - 1)]), max_sec)
+
+def to_json(data : dict) -> dict:
+    """処理時間と棄却の回数を、JSONに書ける形にする。
+
+    Args:
+        data : takeで得た処理時間と棄却の回数
+
+    Returns: JSONに書ける辞書
+    """
+    stages = {}
+    for name, timing in data["timings"].items():
+        hist = timing["hist"]
+        n = int(hist.sum())
+
+        stages[name] = {
+            "count" : n,
+            "total_sec" : timing["total"],
+            "mean_ms" : 1000 * timing["total"] / max(1, n),
+            "p50_ms" : 1000 * percentile(hist, 0.5, timing["max"]),
+            "p90_ms" : 1000 * percentile(hist, 0.9, timing["max"]),
+            "p99_ms" : 1000 * percentile(hist, 0.99, timing["max"]),
+            "max_ms" : 1000 * timing["max"],
+            "hist" : hist.tolist()
+        }
+
+    return { "edges_sec" : edges.tolist(), "stages" : stages, "rejections" : data["counts"] }
+
+def format_report(data : dict) -> str:
+    """処理時間のヒストグラムと棄却の回数を表示用の文字列にする。
+
+    Args:
+        data : takeで得た処理時間と棄却の回数
+
+    Returns: 表示用の文字列
+    """
+    obj = to_json(data)
+
+    lines = [ f'{"ステージ":<12} {"回数":>8} {"合計(秒)":>9} {"平均(ms)":>9} {"p50":>8} {"p90":>8} {"p99":>8} {"最大":>8}' ]
+
+    # 合計時間の長い順
+    for name, st in sorted(obj["stages"].items(), key=lambda x: -x[1]["total_sec"]):
+        lines.append(f'{name:<12} {st["count"]:>8} {st["total_sec"]:>9.2f} {st["mean_ms"]:>9.3f} {st["p50_ms"]:>8.3f} {st["p90_ms"]:>8.3f} {st["p99_ms"]:>8.3f} {st["max_ms"]:>8.3f}')
+
+        # 回数のある区間だけヒストグラムを表示する。
+        hist = np.array(st["hist"])
+        for i in np.flatnonzero(hist):
+            lo = 1000 * edges[i - 1] if 0 < i else 0
+            hi = f'{1000 * edges[i]:.3f}' if i < len(edges) else '-'
+            bar = '#' * int(np.ceil(40 * hist[i] / hist.max()))
+            lines.append(f'    {lo:>9.3f} - {hi:>9} ms {hist[i]:>8} {bar}')
+
+    lines.append('棄却:')
+    for reason, n in sorted(obj["rejections"].items(), key=lambda x: -x[1]):
+        lines.append(f'    {reason}: {n}')
+
+    return '\n'.join(lines)
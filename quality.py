@@ -0,0 +1,123 @@
+import threading
+import numpy as np
+import cv2
+
+local = threading.local()
+"""スレッドごとの画質の統計。パイプラインのスレッドで物体を切り抜く場合も、フレームごとの統計が分かる。"""
+
+def get_stats() -> dict:
+    """このスレッドで調べたフレームの数と、ぼけている・暗すぎる・明るすぎるとして棄却したフレームの数を返す。
+
+    Returns: 画質の統計
+    """
+    if not hasattr(local, "stats"):
+        local.stats = { "checked" : 0, "blurred" : 0, "dark" : 0, "bright" : 0 }
+
+    return local.stats
+
+def take_stats() -> dict:
+    """このスレッドの画質の統計を返して、0に戻す。
+
+    Returns: 画質の統計
+    """
+    ret = get_stats()
+    local.stats = { "checked" : 0, "blurred" : 0, "dark" : 0, "bright" : 0 }
+
+    return ret
+
+def add_stats(total : dict, delta : dict):
+    """画質の統計を足し合わせる。
+
+    Args:
+        total : 足し合わせる先の統計
+        delta : 足す統計
+    """
+    for key, val in delta.items():
+        total[key] = total.get(key, 0) + val
+
+def format_stats(total : dict) -> str:
+    """画質の統計を表示用の文字列にする。
+
+    Args:
+        total : 画質の統計
+
+    Returns: 表示用の文字列
+    """
+    return f'画質: {total.get("checked", 0)}フレーム中 ぼけ {total.get("blurred", 0)}, 暗すぎ {total.get("dark", 0)}, 明るすぎ {total.get("bright", 0)} を棄却'
+
+def measure(gray_img : np.ndarray, max_size : int = 512):
+    """グレー画像のシャープさと明るさを測る。
+
+    長辺がmax_size以下になるまで1/2に縮小してから測るので、画像のサイズによらずほぼ同じ値になる。
+
+    Args:
+        gray_img : グレー画像
+        max_size : 縮小した画像の長辺の最大の画素数
+
+    Returns: シャープさ (ラプラシアンの分散), 明るさ (平均)
+    """
+    small = gray_img
+    while max_size < max(small.shape[:2]):
+        # 1/2の縮小では、INTER_LINEARは2×2画素の平均になる。
+        small = cv2.resize(small, (small.shape[1] // 2, small.shape[0] // 2), interpolation=cv2.INTER_LINEAR)
+
+    mean, stddev = cv2.meanStdDev(cv2.Laplacian(small, cv2.CV_16S))
+
+    return float(stddev[0, 0]) ** 2, float(cv2.mean(small)[0])
+
+class QualityFilter:
+    """ぼけているフレームと、露出が合っていないフレームを、輪郭を探す前に棄却する。
+    """
+    messages = ('ぼけている。', '暗すぎる。', '明るすぎる。')
+    """棄却する理由のメッセージ"""
+
+    def __init__(self, min_sharpness : float = 0, min_brightness : int = 0, max_brightness : int = 255):
+        """
+        Args:
+            min_sharpness : シャープさ (縮小したグレー画像のラプラシアンの分散) の下限。0なら調べない。
+            min_brightness : 明るさ (グレー画像の平均) の下限
+            max_brightness : 明るさの上限
+        """
+        self.minSharpness = min_sharpness
+        """シャープさの下限"""
+
+        self.minBrightness = min_brightness
+        """明るさの下限"""
+
+        self.maxBrightness = max_brightness
+        """明るさの上限"""
+
+    def is_enabled(self) -> bool:
+        """どれかの閾値が指定されていればTrueを返す。
+        """
+        return 0 < self.minSharpness or 0 < self.minBrightness or self.maxBrightness < 255
+
+    def check(self, gray_img : np.ndarray) -> str:
+        """フレームの画質を調べる。
+
+        Args:
+            gray_img : 原画のグレー画像
+
+        Returns: 棄却する理由 (使える場合は空文字列)
+        """
+        if not self.is_enabled():
+            return ''
+
+        sharpness, brightness = measure(gray_img)
+
+        stats = get_stats()
+        stats["checked"] += 1
+
+        if sharpness < self.minSharpness:
+            stats["blurred"] += 1
+            return self.messages[0]
+
+        if brightness < self.minBrightness:
+            stats["dark"] += 1
+            return self.messages[1]
+
+        if self.maxBrightness < brightness:
+            stats["bright"] += 1
+            return self.messages[2]
+
+        return ''
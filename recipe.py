@@ -0,0 +1,80 @@
+import os
+import json
+
+RECIPE_VERSION = 1
+"""レシピ ファイルの形式のバージョン"""
+
+class RecipeWriter:
+    """合成画像の代わりに、合成画像を作り直すためのレシピを記録する。
+
+    レシピは 動画ファイル, フレーム(または保存された物体)のインデックス, 乱数のシード, 背景画像ファイル だけなので、
+    合成画像のJPEGよりずっと小さい。合成画像は dataset.RecipeDataset で作り直す。
+    """
+    def __init__(self, output_dir : str, image_classes : list, config : dict, resume : dict = None):
+        """
+        Args:
+            output_dir : レシピ ファイルの出力先のパス
+            image_classes : 画像のクラスのリスト
+            config : 合成画像を作り直すための引数とフォルダのパス
+            resume : チェックポイントから再開する場合は、チェックポイントの状態
+        """
+        self.path = f'{output_dir}/recipes.json'
+        """レシピ ファイルのパス"""
+
+        self.config = config
+        """合成画像を作り直すための引数とフォルダのパス"""
+
+        self.categories = [ { "supercategory" : f'super-{x.name}', "id" : idx, "name" : x.name } for idx, x in enumerate(image_classes) ]
+        """カテゴリーのリスト"""
+
+        self.videoDir = config["video_dir"]
+        """動画ファイルのフォルダのパス"""
+
+        self.bgImgDir = config["bg_img_dir"]
+        """背景画像ファイルのフォルダのパス"""
+
+        self.recipes = resume["images"] if resume is not None else []
+        """レシピのリスト"""
+
+        self.checkpointed = len(self.recipes)
+        """チェックポイントに保存したレシピの数"""
+
+    def add_recipe(self, class_idx : int, video_path : str, pos : int, recipe : tuple):
+        """レシピを追加する。
+
+        Args:
+            class_idx : クラスのインデックス
+            video_path : 動画ファイルのパス
+            pos : 動画の位置
+            recipe : フレーム(または保存された物体)のインデックス, 乱数のシード, 背景画像ファイルのパス
+        """
+        idx, seed, bg_img_path = recipe
+
+        self.recipes.append({
+            "id" : len(self.recipes) + 1,
+            "category_id" : class_idx,
+            "video" : os.path.relpath(os.path.abspath(video_path), self.videoDir).replace('\\', '/'),
+            "idx" : idx,
+            "pos" : pos,
+            "seed" : seed,
+            "bg" : os.path.relpath(os.path.abspath(bg_img_path), self.bgImgDir).replace('\\', '/')
+        })
+
+    def take_checkpoint(self):
+        """前回のチェックポイントから増えたレシピを返す。
+
+        Returns: 増えたレシピのリスト, 空のリスト, None (ODTK.take_checkpointと同じ形)
+        """
+        n_recipes = self.checkpointed
+        self.checkpointed = len(self.recipes)
+
+        return self.recipes[n_recipes:], [], None
+
+    def save(self):
+        """レシピ ファイルを書く。
+        """
+        with open(self.path, 'w') as f:
+            json.dump({ "version" : RECIPE_VERSION, "config" : self.config, "categories" : self.categories, "recipes" : self.recipes }, f)
+
+    def close(self):
+        pass
@@ -0,0 +1,171 @@
+import os
+import json
+import cv2
+import numpy as np
+
+def shard_path(shard_dir : str, shard : int) -> str:
+    """シャード ファイルのパスを返す。
+
+    Args:
+        shard_dir : シャード ファイルのフォルダのパス
+        shard : シャードの番号
+
+    Returns: シャード ファイルのパス
+    """
+    return f'{shard_dir}/shard-{shard:05d}.bin'
+
+class ShardWriter:
+    """圧縮した画像を、決まったサイズのシャード ファイルに追記する。
+
+    画像ごとのファイルを作らないので、画像が多くてもファイルの数はシャードの数だけになる。
+    """
+    def __init__(self, shard_dir : str, shard_size : int):
+        self.shardDir = shard_dir
+        """シャード ファイルのフォルダのパス"""
+
+        self.shardSize = shard_size
+        """1個のシャード ファイルの最大のバイト数"""
+
+        self.shard = -1
+        """書き込み中のシャードの番号"""
+
+        self.offset = 0
+        """書き込み中のシャード ファイルのサイズ"""
+
+        self.file = None
+        """書き込み中のシャード ファイル"""
+
+    def resume(self, shard : int, offset : int):
+        """シャード ファイルの途中から追記を再開する。
+
+        Args:
+            shard : 書き込み中だったシャードの番号
+            offset : 書き込み中だったシャード ファイルの有効なサイズ
+        """
+        self.close()
+
+        # 後のシャード ファイルを削除する。
+        next_shard = shard + 1
+        while os.path.isfile(shard_path(self.shardDir, next_shard)):
+            os.remove(shard_path(self.shardDir, next_shard))
+            next_shard += 1
+
+        self.shard, self.offset = shard, offset
+
+        if 0 <= shard:
+            # 有効なサイズの後を捨てて、その後に追記する。
+            self.file = open(shard_path(self.shardDir, shard), 'r+b')
+            self.file.truncate(offset)
+            self.file.seek(offset)
+
+    def append(self, data : bytes) -> tuple:
+        """シャード ファイルにデータを追記する。
+
+        Args:
+            data : 圧縮した画像のバイト列
+
+        Returns: シャードの番号, シャード ファイルの中の位置, バイト数
+        """
+        if self.file is None or (0 < self.offset and self.shardSize < self.offset + len(data)):
+            # シャード ファイルがないか、追記すると最大のバイト数を超える場合
+
+            # 次のシャード ファイルを作る。
+            self.close()
+            self.shard += 1
+            self.offset = 0
+            self.file = open(shard_path(self.shardDir, self.shard), 'wb')
+
+        self.file.write(data)
+
+        ret = (self.shard, self.offset, len(data))
+        self.offset += len(data)
+
+        return ret
+
+    def close(self):
+        """書き込み中のシャード ファイルを閉じる。
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class PackedDataset:
+    """main.pyで作った学習データを読む。
+
+    train.json の画像の情報に "shard", "offset", "length" がある場合はシャード ファイルから1回のpreadで読み、
+    ない場合は img フォルダの画像ファイルを読む。
+    """
+    def __init__(self, input_dir : str):
+        self.inputDir = input_dir
+        """学習データのフォルダのパス"""
+
+        with open(f'{input_dir}/train.json') as f:
+            obj = json.load(f)
+
+        self.categories = obj["categories"]
+        """カテゴリーのリスト"""
+
+        self.images = obj["images"]
+        """画像の情報のリスト"""
+
+        self.annotations = {}
+        """画像idからアノテーションのリストへの辞書"""
+
+        for ann in obj["annotations"]:
+            self.annotations.setdefault(ann["image_id"], []).append(ann)
+
+        self.files = {}
+        """シャードの番号からシャード ファイルのディスクリプタへの辞書"""
+
+    def __len__(self):
+        return len(self.images)
+
+    def read_bytes(self, img_inf : dict) -> bytes:
+        """圧縮した画像のバイト列を読む。
+
+        Args:
+            img_inf : 画像の情報
+
+        Returns: 圧縮した画像のバイト列
+        """
+        if "shard" not in img_inf:
+            # 画像ファイルの場合
+
+            with open(f'{self.inputDir}/img/{img_inf["file_name"]}', 'rb') as f:
+                return f.read()
+
+        fd = self.files.get(img_inf["shard"])
+        if fd is None:
+            fd = os.open(shard_path(f'{self.inputDir}/shards', img_inf["shard"]), os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+            self.files[img_inf["shard"]] = fd
+
+        return os.pread(fd, img_inf["length"], img_inf["offset"])
+
+    def read_image(self, img_inf : dict) -> np.ndarray:
+        """画像を読む。
+
+        Args:
+            img_inf : 画像の情報
+
+        Returns: BGRの画像
+        """
+        return cv2.imdecode(np.frombuffer(self.read_bytes(img_inf), dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    def __getitem__(self, idx : int):
+        """画像の情報と圧縮した画像のバイト列とアノテーションのリストを返す。
+        """
+        img_inf = self.images[idx]
+
+        return img_inf, self.read_bytes(img_inf), self.annotations.get(img_inf["id"], [])
+
+    def __iter__(self):
+        for idx in range(len(self.images)):
+            yield self[idx]
+
+    def close(self):
+        """開いているシャード ファイルを閉じる。
+        """
+        for fd in self.files.values():
+            os.close(fd)
+
+        self.files = {}
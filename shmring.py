@@ -0,0 +1,123 @@
+import threading
+from collections import deque
+from multiprocessing import shared_memory
+import numpy as np
+
+class FrameDesc:
+    """共有メモリの枠に置いた画像の記述子。プロセスの間では画像の代わりにこれを送る。
+    """
+    def __init__(self, slot : int, shape : tuple, class_idx : int = -1, video_idx : int = -1, pos : int = -1):
+        self.slot = slot
+        """枠のインデックス"""
+
+        self.shape = shape
+        """画像の形"""
+
+        self.classIdx = class_idx
+        """クラスのインデックス"""
+
+        self.videoIdx = video_idx
+        """動画ファイルのインデックス"""
+
+        self.pos = pos
+        """動画の位置"""
+
+class FrameRing:
+    """multiprocessing.shared_memory の上に並べた、固定のバイト数のuint8の画像の枠のリング。
+
+    枠を作ったプロセスが空いている枠を順に使い回す。ほかのプロセスは名前で同じ共有メモリを開いて、
+    記述子(FrameDesc)の枠の画像をnumpyの配列として読み書きする。
+    画像を枠に書くときはコピーする。枠を返した後も画像を使う場合は、viewの配列をコピーしておく。
+    """
+    def __init__(self, slots : int, slot_bytes : int, name : str = None):
+        """
+        Args:
+            slots : 枠の数
+            slot_bytes : 枠のバイト数
+            name : 共有メモリの名前。Noneなら共有メモリを作り、指定した場合は作られた共有メモリを開く。
+        """
+        self.slots = slots
+        """枠の数"""
+
+        self.slotBytes = slot_bytes
+        """枠のバイト数"""
+
+        self.owner = name is None
+        """共有メモリを作ったプロセスならTrue"""
+
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=slots * slot_bytes if self.owner else 0)
+        """共有メモリ"""
+
+        self.free = deque(range(slots))
+        """空いている枠のインデックスのキュー"""
+
+        self.cond = threading.Condition()
+        """空いている枠を待つための条件変数"""
+
+    def __reduce__(self):
+        # ほかのプロセスに送る場合は、名前で同じ共有メモリを開く。
+        return (FrameRing, (self.slots, self.slotBytes, self.shm.name))
+
+    def fits(self, img : np.ndarray) -> bool:
+        """画像が枠に入ればTrueを返す。
+
+        Args:
+            img : 画像
+        """
+        return img.dtype == np.uint8 and img.nbytes <= self.slotBytes
+
+    def acquire(self) -> int:
+        """空いている枠を取る。空いている枠がなければ空くまで待つ。
+
+        Returns: 枠のインデックス
+        """
+        with self.cond:
+            while len(self.free) == 0:
+                self.cond.wait()
+
+            return self.free.popleft()
+
+    def release(self, slot : int):
+        """使い終わった枠を返す。
+
+        Args:
+            slot : 枠のインデックス
+        """
+        with self.cond:
+            self.free.append(slot)
+            self.cond.notify()
+
+    def view(self, desc : FrameDesc) -> np.ndarray:
+        """記述子の枠の画像を、コピーせずにnumpyの配列として返す。
+
+        Args:
+            desc : 記述子
+
+        Returns: 共有メモリの上の画像
+        """
+        return np.ndarray(desc.shape, dtype=np.uint8, buffer=self.shm.buf, offset=desc.slot * self.slotBytes)
+
+    def put(self, slot : int, img : np.ndarray, class_idx : int = -1, video_idx : int = -1, pos : int = -1) -> FrameDesc:
+        """画像を枠に書く。
+
+        Args:
+            slot : 枠のインデックス
+            img : 画像
+            class_idx : クラスのインデックス
+            video_idx : 動画ファイルのインデックス
+            pos : 動画の位置
+
+        Returns: 記述子
+        """
+        desc = FrameDesc(slot, img.shape, class_idx, video_idx, pos)
+        self.view(desc)[...] = img
+
+        return desc
+
+    def close(self):
+        """共有メモリを閉じる。作ったプロセスの場合は共有メモリを削除する。
+        """
+        self.shm.close()
+
+        if self.owner:
+            self.shm.unlink()
@@ -61,6 +61,40 @@ def show_image(image_element, img : np.ndarray):
     image_element.update(data=image_tk, size=(dsp_size, dsp_size))
 
 
+def resize_bg_img(bg_img : np.ndarray, img_size : int) -> np.ndarray:
+    """背景画像を指定したサイズの正方形にする。
+
+    Args:
+        bg_img : 背景画像
+        img_size : 正方形の辺の長さ
+
+    Returns:
+        指定したサイズの正方形の背景画像
+    """
+    # 背景画像の高さと幅
+    h, w = bg_img.shape[:2]
+
+    if h == img_size and w == img_size:
+        # 背景画像のバンクから読んだ場合など、すでに指定したサイズの場合
+
+        return bg_img
+
+    # 高さと幅の小さい方
+    size = min(h, w)
+
+    # 正方形の画像の開始位置
+    y = (h - size) // 2
+    x = (w - size) // 2
+
+    # 背景画像を正方形にする。
+    bg_img = bg_img[ y:(y+size), x:(x+size), :]
+
+    # 指定したサイズにリサイズする。
+    bg_img = cv2.resize(bg_img, dsize=(img_size, img_size))
+
+    return bg_img
+
+
 def center_distance(cx, cy, contour):
     # 輪郭のモーメントを計算する。
     M = cv2.moments(contour)
@@ -100,14 +134,173 @@ def bounding_rect(img_width, img_height, contour):
 
     return x_ok and y_ok
 
-def getContour(bin_img: np.ndarray):
+def fill_holes(bin_img : np.ndarray) -> np.ndarray:
+    """二値画像の物体の内部の穴を塗りつぶす。
+
+    画像の端から塗りつぶせない背景が穴なので、穴のある物体と、穴の中の物体は1つの領域になる。
+
+    Args:
+        bin_img : 二値化画像
+
+    Returns: 穴を塗りつぶした二値画像
+    """
+    # 画像の周りに1画素の背景を足して、端から背景を塗りつぶす。
+    padded = cv2.copyMakeBorder(bin_img, 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=0)
+    cv2.floodFill(padded, None, (0, 0), 255)
+
+    # 塗りつぶせなかった背景が穴
+    return bin_img | (255 - padded[1:-1, 1:-1])
+
+def select_component(stats : np.ndarray, centroids : np.ndarray, img_width : int, img_height : int, margin : float):
+    """連結成分の統計から、物体の連結成分をまとめて選ぶ。
+
+    Args:
+        stats : connectedComponentsWithStatsの統計 (背景を除く)
+        centroids : connectedComponentsWithStatsの重心 (背景を除く)
+        img_width : 画像の幅
+        img_height : 画像の高さ
+        margin : 画像の周辺部の幅
+
+    Returns: getContourのメッセージ, 選んだ連結成分のインデックス
+    """
+    x, y, w, h, area = stats.T
+
+    # 面積が画像全体の10%以上の連結成分
+    large = 0.10 < np.sqrt(area / (img_width * img_height))
+    if not large.any():
+        return '面積が画像全体の10%以上の輪郭がない。', None
+
+    # 外接矩形が画像の周辺部にない連結成分
+    inside = large & (margin < x) & (x + w < img_width - margin) & (margin < y) & (y + h < img_height - margin)
+    if not inside.any():
+        return '輪郭が画像の周辺部にある。', None
+
+    # 重心と画像の中心との距離が最小の連結成分
+    dist = np.hypot(centroids[:, 0] - img_width / 2, centroids[:, 1] - img_height / 2)
+
+    return '', int(np.argmin(np.where(inside, dist, np.inf)))
+
+def connected_components(bin_img : np.ndarray):
+    """穴を塗りつぶした二値画像の連結成分を得る。
+
+    findContoursの外側の輪郭と同じく、物体は8近傍でつながり、穴の中の物体は外側の物体に含まれる。
+
+    Args:
+        bin_img : 二値化画像
+
+    Returns: ラベル画像, 連結成分の統計, 連結成分の重心 (統計と重心は背景を除く)
+    """
+    n, labels, stats, centroids = cv2.connectedComponentsWithStatsWithAlgorithm(fill_holes(bin_img), 8, cv2.CV_32S, cv2.CCL_BBDT)
+
+    return labels, stats[1:], centroids[1:]
+
+def search_downscaled(bin_img : np.ndarray, downscale : int):
+    """縮小した二値画像で物体を選んで、元の解像度で物体を含む範囲を返す。
+
+    Args:
+        bin_img : 二値化画像
+        downscale : 縮小率の逆数
+
+    Returns: 物体を含む範囲の左上と右下のXY座標 (物体がない場合はNone)
+    """
+    img_height, img_width = bin_img.shape[:2]
+
+    # 縦横ともdownscale画素ごとに間引く。
+    small = np.ascontiguousarray(bin_img[::downscale, ::downscale])
+
+    labels, stats, centroids = connected_components(small)
+
+    # 周辺部の幅は、縮小した画像の画素数で max(1, 10 // downscale)。
+    margin = max(1, 10 // downscale) * downscale
+
+    # 元の解像度での外接矩形と面積と重心にする。
+    msg, idx = select_component(stats * np.array([downscale, downscale, downscale, downscale, downscale * downscale]), centroids * downscale, img_width, img_height, margin)
+    if msg != '':
+        return None
+
+    # 外接矩形を間引いた分だけ広げる。
+    x, y, w, h = stats[idx, :4] * downscale
+
+    return max(0, x - downscale), max(0, y - downscale), min(img_width, x + w + downscale), min(img_height, y + h + downscale)
+
+def component_contour(bin_img: np.ndarray, downscale : int = 1):
+    """連結成分を使って、二値画像から輪郭とマスク画像を得る。
+
+    穴を塗りつぶした二値画像の連結成分の統計から物体をまとめて選び、選んだ物体の輪郭だけを得る。
+    小さなゴミが多くても、ゴミごとの輪郭は得ない。結果は findContours で輪郭ごとに調べる場合とほぼ同じになる。
+    ただし面積と重心は輪郭の contourArea とモーメントではなく連結成分の画素数と重心なので、
+    面積が10%の境目の物体や細い物体、中心からの距離が同じくらいの物体では、違う物体を選ぶことがある。
+
+    Args:
+        bin_img : 二値化画像
+        downscale : 2以上なら、縦横を1/downscaleに間引いた画像で物体を選んでから、その周りだけを元の解像度で調べる。
+
+    Returns: 輪郭とマスク画像
+    """
+    # 画像の高さと幅
+    img_height, img_width = bin_img.shape[:2]
+
+    # 連結成分を調べる範囲
+    rect = search_downscaled(bin_img, downscale) if 1 < downscale else None
+
+    msg = None
+    if rect is not None:
+        # 縮小した画像で物体を選んだ場合
+
+        x0, y0, x1, y1 = rect
+        labels, stats, centroids = connected_components(bin_img[y0:y1, x0:x1])
+
+        # 範囲の中で最も大きい連結成分が、縮小した画像で選んだ物体。
+        label = 1 + int(np.argmax(stats[:, cv2.CC_STAT_AREA]))
+        x, y, w, h = stats[label-1, :4]
+
+        # 間引いて見えなかった細い部分が、範囲の外に出ているかも知れない場合
+        clipped = (0 < x0 and x == 0) or (0 < y0 and y == 0) or (x1 < img_width and x + w == x1 - x0) or (y1 < img_height and y + h == y1 - y0)
+
+        if not clipped:
+            stats = stats[label-1:label] + np.array([x0, y0, 0, 0, 0])
+
+            # 元の解像度で確かめる。
+            msg, idx = select_component(stats, centroids[label-1:label] + np.array([x0, y0]), img_width, img_height, 10)
+
+    if msg != '':
+        # 縮小した画像で選ばないか、元の解像度で確かめて使えない場合は、画像全体を調べる。
+
+        x0, y0 = 0, 0
+        labels, stats, centroids = connected_components(bin_img)
+
+        msg, idx = select_component(stats, centroids, img_width, img_height, 10)
+        if msg != '':
+            return [ msg, None, None]
+
+        label = 1 + idx
+
+    # 選んだ連結成分の外接矩形の内部だけで、外側の輪郭を得る。
+    x, y, w, h = stats[idx, :4]
+    component = np.where(labels[(y-y0):(y-y0+h), (x-x0):(x-x0+w)] == label, np.uint8(255), np.uint8(0))
+    contours, hierarchy = cv2.findContours(component, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(int(x), int(y)))
+
+    # 1つの連結成分なので、外側の輪郭は1つ。
+    contour = contours[0]
+
+    # 輪郭から0と255のグレースケールの内部のマスク画像を作る。
+    mask_img = np.zeros(bin_img.shape, dtype=np.uint8)
+    cv2.drawContours(mask_img, [ contour ], -1, 255, -1)
+
+    return '', contour, mask_img
+
+def getContour(bin_img: np.ndarray, segment : str = 'contours', downscale : int = 1):
     """二値画像から輪郭とマスク画像を得る。
 
     Args:
         bin_img : 二値化画像
+        segment : 物体を選ぶ方法。'contours'ならfindContoursで得た輪郭ごとに調べ、'components'なら連結成分の統計からまとめて選ぶ。
+        downscale : segmentが'components'の場合に、2以上なら縦横を1/downscaleに間引いた画像で物体を選ぶ。
 
     Returns: 輪郭とマスク画像
     """
+    if segment == 'components':
+        return component_contour(bin_img, downscale)
 
     # 二値化画像から輪郭のリストを得る。
     contours, hierarchy = cv2.findContours(bin_img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)   #  RETR_TREE RETR_CCOMP 
@@ -1,11 +1,11 @@
 import os
 import sys
 import random
-import json
 import shutil
 import argparse
 
 from tqdm import tqdm
+from shard import PackedDataset
 
 def parse():
     """コマンドライン引数を解析する。
@@ -46,12 +46,11 @@ if __name__ == '__main__':
 
     datasets_dir = f'{outpu_dir}/datasets'
 
-    # COCO形式のアノテーションファイルを読む。
-    with open(f'{input_dir}/train.json') as f:
-        obj =json.load(f)
+    # COCO形式の学習データを読む。(画像はimgフォルダの画像ファイルかシャード ファイルから読む)
+    dataset = PackedDataset(input_dir)
 
     # クラスの名前のリスト
-    class_names = [x["name"] for x in obj["categories"]]
+    class_names = [x["name"] for x in dataset.categories]
 
     if os.path.exists(datasets_dir):
         shutil.rmtree(datasets_dir)
@@ -81,13 +80,13 @@ if __name__ == '__main__':
         f.write(f'names: {class_names}\n')
 
     # 画像ファイルのリストをシャッフルする。
-    random.shuffle(obj['images'])
+    random.shuffle(dataset.images)
 
-    # すべての画像ファイルに対して
-    for idx, img_inf in enumerate( tqdm(obj['images'], total=len(obj['images'])) ):
+    # すべての画像に対して
+    for idx, (img_inf, img_data, ann_list) in enumerate( tqdm(dataset, total=len(dataset)) ):
 
         # 95%をトレーニングに使い、5%をバリデーションに使う。
-        if idx < len(obj['images']) * 95 / 100:
+        if idx < len(dataset) * 95 / 100:
             # トレーニングの場合
 
             # YOLOv5用の画像ファイルとラベルファイルのパス
@@ -101,46 +100,38 @@ if __name__ == '__main__':
             images_dir = f'{datasets_dir}/images/val'
             labels_dir = f'{datasets_dir}/labels/val'
 
-        # 画像id
-        img_id = img_inf['id']
-
-        # コピー元の画像ファイルのパス
-        src_image_path = f'{input_dir}/img/{img_inf["file_name"]}'
-
-        # コピー元の画像ファイルをYOLOv5用の画像フォルダにコピーする。
-        shutil.copy(src_image_path, images_dir)
+        # 画像をYOLOv5用の画像フォルダに書く。
+        with open(f'{images_dir}/{img_inf["file_name"]}', 'wb') as f:
+            f.write(img_data)
 
         # 画像の高さと幅
         image_height = float(img_inf["height"])
         image_width  = float(img_inf["width"])
 
-        # 画像idに対応するアノテーションのリスト
-        ann_list = [x for x in obj['annotations'] if x["image_id"] == img_id]
+        # ラベルファイル名
+        label_file_name = img_inf["file_name"].replace('.jpg', '.txt')
 
-        # 画像idに対応するアノテーションに対して
-        for ann in ann_list:
+        # ラベルファイルのパス
+        label_file_path = f'{labels_dir}/{label_file_name}'
 
-            # 物体の位置とサイズと回転。 回転(theta)はYOLOv5では使わない。
-            x, y, w, h, theta = ann['bbox']
-            
-            # 以下で物体の位置とサイズは画像のサイズに対する比で表す。
+        # ラベルファイルをオープンする。
+        with open(label_file_path, 'w') as f:
 
-            # 物体の中心のXY座標
-            x_center = (x + 0.5 * w) / image_width
-            y_center = (y + 0.5 * h) / image_height
+            # 画像idに対応するアノテーションに対して
+            for ann in ann_list:
 
-            # 物体のサイズ
-            width    = w / image_width
-            height   = h / image_height
-
-            # ラベルファイル名
-            label_file_name = img_inf["file_name"].replace('.jpg', '.txt')
+                # 物体の位置とサイズと回転。 回転(theta)はYOLOv5では使わない。
+                x, y, w, h, theta = ann['bbox']
+            
+                # 以下で物体の位置とサイズは画像のサイズに対する比で表す。
 
-            # ラベルファイルのパス
-            label_file_path = f'{labels_dir}/{label_file_name}'
+                # 物体の中心のXY座標
+                x_center = (x + 0.5 * w) / image_width
+                y_center = (y + 0.5 * h) / image_height
 
-            # ラベルファイルをオープンする。
-            with open(label_file_path, 'w') as f:
+                # 物体のサイズ
+                width    = w / image_width
+                height   = h / image_height
 
                 # カテゴリー(クラス)のid, 物体の中心のXY座標, 物体のサイズを書く。
-                f.write(f'{ann["category_id"]} {x_center} {y_center} {width} {height}\n')
\ No newline at end of file
+                f.write(f'{ann["category_id"]} {x_center} {y_center} {width} {height}\n')